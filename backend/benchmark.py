@@ -0,0 +1,449 @@
+"""
+Load-test benchmark for the chat API.
+
+Starts local stand-ins for the OpenAI chat completions API and the Google Books
+volumes endpoints (configurable latency and error rates), runs the backend
+against them in a uvicorn subprocess and drives multi-turn conversations at a
+fixed concurrency. Reports throughput, latency percentiles and upstream calls
+per turn, and can fail the run when latency regresses.
+
+    python benchmark.py --concurrency 20 --conversations 200
+    python benchmark.py --duration 60 --json results.json --max-p95-ms 2500
+
+With --target the backend is not started; point that server's OPENAI_BASE_URL and
+GOOGLE_BOOKS_BASE_URL at the stub URLs printed on startup to count upstream calls.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+GENRES = ["fantasy", "science fiction", "mystery", "thriller", "romance", "historical fiction", "horror", "biography"]
+AUTHORS = ["Ursula K. Le Guin", "Agatha Christie", "Terry Pratchett", "Octavia Butler", "Stephen King", "Jane Austen"]
+BOOKS = ["The Hobbit", "Dune", "Gone Girl", "The Name of the Wind", "Project Hail Mary", "Rebecca"]
+MOODS = ["cozy", "dark", "funny", "thought-provoking", "fast-paced"]
+
+# Conversation templates; placeholders are filled per conversation so caches see a realistic mix of repeats
+CONVERSATIONS = [
+    ["hi", "I love {mood} {genre} books", "tell me more about #2", "Show different recommendations", "Books like {book}"],
+    ["Suggest Fantasy Books", "tell me more about #1", "Start Over", "Mystery Novels"],
+    ["recommend me a book", "something {mood} by {author}", "more detail on #3", "start over"],
+    ["Recommend Sci-Fi", "Show different recommendations", "{genre} novels similar to {book}"],
+]
+
+# --- Upstream Stubs ---
+
+class UpstreamStubs:
+    """
+    One aiohttp app serving the OpenAI chat completions endpoint (plain and streamed)
+    and the Google Books search and volume endpoints. Counts every call it receives.
+    """
+
+    def __init__(
+        self,
+        openai_latency: float,
+        google_latency: float,
+        openai_error_rate: float,
+        google_error_rate: float,
+        jitter: float
+    ):
+        self.openai_latency = openai_latency
+        self.google_latency = google_latency
+        self.openai_error_rate = openai_error_rate
+        self.google_error_rate = google_error_rate
+        self.jitter = jitter
+        self.calls: Dict[str, int] = {}
+        self.titles: Dict[str, str] = {}  # volume id -> title
+        self.ideas: Dict[str, tuple] = {}  # "title author" search query -> (title, author) of generated ideas
+        self.idea_queries: Dict[str, str] = {}  # title -> its "title author" search query
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/books/v1/volumes", self.search_volumes)
+        app.router.add_get("/books/v1/volumes/{volume_id}", self.get_volume)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        self.port = port or _free_port()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def _count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def _delay(self, latency: float):
+        if latency > 0:
+            await asyncio.sleep(latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        messages = body.get("messages", [])
+        system_prompt = messages[0].get("content", "") if messages else ""
+        user_prompt = messages[-1].get("content", "") if messages else ""
+        if "extract the intent and entities" in system_prompt:
+            kind, content = "openai_nlp", json.dumps(_stub_nlp(user_prompt))
+        elif "Analyze the user's message" in system_prompt:
+            ideas = self._ideas(user_prompt, 5)
+            kind, content = "openai_fused", json.dumps({**_stub_nlp(user_prompt), "recommendations": ideas})
+        else:
+            ideas = self._ideas(user_prompt, int(body.get("max_tokens", 1250)) // 250 or 5)
+            kind, content = "openai_recommendations", json.dumps({"recommendations": ideas})
+        if body.get("stream"):
+            kind += "_stream"
+        self._count(kind)
+
+        if random.random() < self.openai_error_rate:
+            await self._delay(self.openai_latency / 4)
+            return web.json_response(
+                {"error": {"message": "Stub upstream failure", "type": "server_error", "code": None}}, status=500
+            )
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body.get("model", "stub")}
+        if not body.get("stream"):
+            await self._delay(self.openai_latency)
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(user_prompt) // 4, "completion_tokens": len(content) // 4,
+                          "total_tokens": (len(user_prompt) + len(content)) // 4}
+            })
+
+        # Streamed: spread the latency over the chunks, like tokens arriving
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        pieces = [content[i:i + 40] for i in range(0, len(content), 40)]
+        for piece in pieces:
+            await self._delay(self.openai_latency / len(pieces))
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _ideas(self, user_prompt: str, count: int) -> List[Dict[str, str]]:
+        ideas = _stub_ideas(user_prompt, count)
+        for idea in ideas:
+            query = f"{idea['title']} {idea['author']}"
+            self.ideas[query] = (idea["title"], idea["author"])
+            self.idea_queries[idea["title"]] = query
+        return ideas
+
+    async def search_volumes(self, request: web.Request) -> web.Response:
+        query = request.query.get("q", "")
+        titles = re.findall(r'intitle:"([^"]*)"', query)
+        self._count("google_books_search_batch" if titles else "google_books_search")
+        await self._delay(self.google_latency)
+        if random.random() < self.google_error_rate:
+            return web.json_response({"error": {"code": 503, "message": "Stub upstream failure"}}, status=503)
+        if titles:  # OR-combined title query: the best match for each title
+            queries = [self.idea_queries.get(title, title) for title in titles]
+            per_query = 1
+        else:
+            queries = [query]
+            per_query = min(int(request.query.get("maxResults", "5")), 3)
+        full = request.query.get("projection") == "full"
+        items = []
+        for search in queries:
+            title, author = self.ideas.get(search, (search, "Stub Author"))
+            for index in range(per_query):
+                volume_id = hashlib.sha1(f"{search}:{index}".encode()).hexdigest()[:12]
+                self.titles[volume_id] = (title, author)
+                items.append(self._volume(volume_id) if full else
+                             {"id": volume_id, "volumeInfo": {"title": title, "authors": [author]}})
+        return web.json_response({"totalItems": len(items), "items": items})
+
+    async def get_volume(self, request: web.Request) -> web.Response:
+        self._count("google_books_volume")
+        await self._delay(self.google_latency)
+        if random.random() < self.google_error_rate:
+            return web.json_response({"error": {"code": 503, "message": "Stub upstream failure"}}, status=503)
+        return web.json_response(self._volume(request.match_info["volume_id"]))
+
+    def _volume(self, volume_id: str) -> Dict[str, Any]:
+        title, author = self.titles.get(volume_id, (f"Volume {volume_id}", "Stub Author"))
+        return {
+            "id": volume_id,
+            "volumeInfo": {
+                "title": title,
+                "authors": [author],
+                "description": f"A stand-in description for {title}. " * 8,
+                "categories": ["Fiction"],
+                "industryIdentifiers": [{"type": "ISBN_13", "identifier": "978" + str(int(volume_id, 16))[:10]}],
+                "imageLinks": {"thumbnail": f"http://books.google.com/books/content?id={volume_id}&printsec=frontcover&img=1&zoom=1"}
+            }
+        }
+
+def _stub_nlp(user_prompt: str) -> Dict[str, Any]:
+    text = user_prompt.lower()
+    if re.search(r"\b(hi|hello|hey)\b", text) and "book" not in text:
+        return {"intent": "GREETING", "entities": {}, "refined_message": user_prompt}
+    entities = {}
+    for genre in GENRES:
+        if genre in text:
+            entities["genre"] = genre
+            break
+    for author in AUTHORS:
+        if author.lower() in text:
+            entities["author"] = author
+    for book in BOOKS:
+        if book.lower() in text:
+            entities["similar_to"] = book
+    return {"intent": "REQUEST_RECOMMENDATION", "entities": entities, "refined_message": user_prompt}
+
+def _stub_ideas(user_prompt: str, count: int) -> List[Dict[str, str]]:
+    seed = hashlib.sha1(user_prompt.encode()).hexdigest()[:6]
+    return [
+        {"title": f"Stub Book {seed}-{index}", "author": f"Author {seed[:3]}", "reasoning": "It matches the requested preferences."}
+        for index in range(count)
+    ]
+
+# --- End Upstream Stubs ---
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def _build_conversation(rng: random.Random) -> List[str]:
+    template = rng.choice(CONVERSATIONS)
+    values = {"genre": rng.choice(GENRES), "author": rng.choice(AUTHORS), "book": rng.choice(BOOKS), "mood": rng.choice(MOODS)}
+    return [turn.format(**values) for turn in template]
+
+async def _wait_until_ready(session: aiohttp.ClientSession, target: str, process: subprocess.Popen, timeout: float = 30):
+    """Polls the readiness probe; returns the backend's reported startup timings."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited during startup with code {process.returncode}")
+        try:
+            async with session.get(f"{target}/api/ready") as response:
+                if response.status == 200:
+                    return (await response.json()).get("startup", {})
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Backend did not become ready within {timeout}s")
+
+def _start_backend(stub_url: str, port: int, extra_env: Dict[str, str]) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "benchmark"),
+        "GOOGLE_BOOKS_API_KEY": os.getenv("GOOGLE_BOOKS_API_KEY", "benchmark"),
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "GOOGLE_BOOKS_BASE_URL": f"{stub_url}/books/v1",
+        **extra_env
+    }
+    # Keep runs comparable unless the caller opts in: no shared Redis, catalog or pre-warming
+    env.setdefault("CACHE_REDIS_ENABLED", "false")
+    env.setdefault("SESSION_STORE", "memory")
+    env.setdefault("PREWARM_ENABLED", "false")
+    env.setdefault("BOOK_CATALOG_PATH", "")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+
+async def run_benchmark(
+    target: Optional[str] = None,
+    concurrency: int = 10,
+    conversations: int = 100,
+    duration: Optional[float] = None,
+    openai_latency: float = 0.8,
+    google_latency: float = 0.15,
+    openai_error_rate: float = 0.0,
+    google_error_rate: float = 0.0,
+    jitter: float = 0.25,
+    seed: int = 1,
+    stub_port: int = 0,
+    backend_env: Optional[Dict[str, str]] = None
+) -> Dict[str, Any]:
+    """
+    Runs the benchmark and returns its summary. `conversations` caps the number of
+    conversations started; `duration`, if given, stops starting new ones after that many seconds.
+    """
+    stubs = UpstreamStubs(openai_latency, google_latency, openai_error_rate, google_error_rate, jitter)
+    stub_url = await stubs.start(stub_port)
+    print(f"Benchmark: Stubs listening - OPENAI_BASE_URL={stub_url}/v1 GOOGLE_BOOKS_BASE_URL={stub_url}/books/v1")
+    process = None
+    if target is None:
+        port = _free_port()
+        target = f"http://127.0.0.1:{port}"
+        process = _start_backend(stub_url, port, backend_env or {})
+
+    rng = random.Random(seed)
+    latencies: Dict[str, List[float]] = {}  # turn message template position -> latencies
+    all_latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    counters = {"started": 0, "turns": 0}
+    backend_startup: Dict[str, Any] = {}
+    connector = aiohttp.TCPConnector(limit=concurrency * 2)
+    timeout = aiohttp.ClientTimeout(total=120)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            if process is not None:
+                backend_startup = await _wait_until_ready(session, target, process)
+            started = time.perf_counter()
+            stop_at = started + duration if duration else None
+
+            async def virtual_user():
+                while counters["started"] < conversations and (stop_at is None or time.perf_counter() < stop_at):
+                    counters["started"] += 1
+                    user_id = f"bench-{uuid.uuid4().hex[:12]}"
+                    for turn_index, message in enumerate(_build_conversation(rng)):
+                        turn_started = time.perf_counter()
+                        try:
+                            async with session.post(
+                                f"{target}/api/chat", json={"user_id": user_id, "message": message}
+                            ) as response:
+                                await response.read()
+                                if response.status != 200:
+                                    errors[str(response.status)] = errors.get(str(response.status), 0) + 1
+                                    continue
+                        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                            continue
+                        elapsed = time.perf_counter() - turn_started
+                        all_latencies.append(elapsed)
+                        latencies.setdefault(f"turn_{turn_index + 1}", []).append(elapsed)
+                        counters["turns"] += 1
+
+            await asyncio.gather(*(virtual_user() for _ in range(concurrency)))
+            wall_time = time.perf_counter() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await stubs.stop()
+
+    def summarize(values: List[float]) -> Dict[str, float]:
+        ordered = sorted(values)
+        return {
+            "count": len(ordered),
+            "p50_ms": round(_percentile(ordered, 50) * 1000, 1),
+            "p95_ms": round(_percentile(ordered, 95) * 1000, 1),
+            "p99_ms": round(_percentile(ordered, 99) * 1000, 1),
+            "max_ms": round(ordered[-1] * 1000, 1) if ordered else 0.0
+        }
+
+    turns = counters["turns"]
+    return {
+        "concurrency": concurrency,
+        "conversations": counters["started"],
+        "turns": turns,
+        "errors": errors,
+        "wall_time_seconds": round(wall_time, 2),
+        "requests_per_second": round(turns / wall_time, 2) if wall_time else 0.0,
+        "latency": summarize(all_latencies),
+        "latency_by_turn": {name: summarize(values) for name, values in sorted(latencies.items())},
+        "backend_startup": backend_startup,
+        "upstream_calls": dict(sorted(stubs.calls.items())),
+        "upstream_calls_per_turn": {
+            name: round(count / turns, 3) if turns else 0.0 for name, count in sorted(stubs.calls.items())
+        },
+        "stub_config": {
+            "openai_latency": openai_latency, "google_latency": google_latency,
+            "openai_error_rate": openai_error_rate, "google_error_rate": google_error_rate
+        }
+    }
+
+def _print_report(summary: Dict[str, Any]):
+    latency = summary["latency"]
+    print(f"\nConversations: {summary['conversations']}  Turns: {summary['turns']}  "
+          f"Concurrency: {summary['concurrency']}  Wall time: {summary['wall_time_seconds']}s")
+    print(f"Throughput: {summary['requests_per_second']} req/s  Errors: {summary['errors'] or 'none'}")
+    print(f"Latency: p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms max={latency['max_ms']}ms")
+    if summary["backend_startup"]:
+        startup = summary["backend_startup"]
+        print(f"Backend startup: import={startup.get('import_seconds')}s warm-up={startup.get('warmup_seconds')}s "
+              f"ready={startup.get('time_to_ready_seconds')}s")
+    print("\nBy turn position:")
+    for name, stats in summary["latency_by_turn"].items():
+        print(f"  {name:<8} n={stats['count']:<6} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+    print("\nUpstream calls (per turn):")
+    for name, count in summary["upstream_calls"].items():
+        print(f"  {name:<30} {count:<8} {summary['upstream_calls_per_turn'][name]}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark /api/chat against local OpenAI and Google Books stubs.")
+    parser.add_argument("--target", help="Benchmark an already running backend at this URL instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent simulated users")
+    parser.add_argument("--conversations", type=int, default=100, help="Total conversations to run")
+    parser.add_argument("--duration", type=float, help="Stop starting conversations after this many seconds")
+    parser.add_argument("--openai-latency", type=float, default=0.8, help="Mean OpenAI stub latency in seconds")
+    parser.add_argument("--google-latency", type=float, default=0.15, help="Mean Google Books stub latency in seconds")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="Share of OpenAI stub calls failing with 500")
+    parser.add_argument("--google-error-rate", type=float, default=0.0, help="Share of Google Books stub calls failing with 503")
+    parser.add_argument("--jitter", type=float, default=0.25, help="+/- fraction applied to each stub latency")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for conversation selection")
+    parser.add_argument("--stub-port", type=int, default=0, help="Fixed port for the stubs (useful with --target)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the started backend, e.g. --env NLP_PIPELINE_MODE=fused")
+    parser.add_argument("--json", dest="json_path", help="Also write the summary as JSON to this path")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit non-zero if p95 latency exceeds this")
+    parser.add_argument("--max-error-rate", type=float, help="Exit non-zero if the share of failed turns exceeds this")
+    args = parser.parse_args(argv)
+
+    backend_env = dict(item.split("=", 1) for item in args.env)
+    summary = asyncio.run(run_benchmark(
+        target=args.target.rstrip("/") if args.target else None,
+        concurrency=args.concurrency,
+        conversations=args.conversations,
+        duration=args.duration,
+        openai_latency=args.openai_latency,
+        google_latency=args.google_latency,
+        openai_error_rate=args.openai_error_rate,
+        google_error_rate=args.google_error_rate,
+        jitter=args.jitter,
+        seed=args.seed,
+        stub_port=args.stub_port,
+        backend_env=backend_env
+    ))
+    _print_report(summary)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as json_file:
+            json.dump(summary, json_file, indent=2)
+
+    failed = False
+    if args.max_p95_ms is not None and summary["latency"]["p95_ms"] > args.max_p95_ms:
+        print(f"\nFAIL: p95 {summary['latency']['p95_ms']}ms exceeds {args.max_p95_ms}ms")
+        failed = True
+    attempted = summary["turns"] + sum(summary["errors"].values())
+    error_rate = sum(summary["errors"].values()) / attempted if attempted else 0.0
+    if args.max_error_rate is not None and error_rate > args.max_error_rate:
+        print(f"\nFAIL: error rate {error_rate:.3f} exceeds {args.max_error_rate}")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
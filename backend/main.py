@@ -1,183 +1,2543 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # Import-time tracking; keep these two lines first
+
 import hmac
 import hashlib
-from fastapi import FastAPI, Request, HTTPException
-import uvicorn
+from fastapi import FastAPI, APIRouter, Request, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, Response
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
+from contextlib import asynccontextmanager
 import asyncio
+import functools
 import random
 import os
-import openai
-import aiohttp
+import sys
+import argparse
+import importlib.util
 import json
+import bisect
+import base64
+import math
+import re
+import sqlite3
+import difflib
+import unicodedata
+import uuid
+import threading
+import io
+from urllib.parse import quote, urljoin, urlsplit
+import zlib
+import gzip
+import contextvars
+import atexit
+import logging
+import logging.handlers
+import queue
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
-import redis
+
+def _lazy_import(name: str):
+    """
+    Imports a module whose body only runs on first attribute access. Keeps heavy
+    client libraries (openai alone is most of our import time) off the import path.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+openai = _lazy_import("openai")
+aiohttp = _lazy_import("aiohttp")
+
+# Optional speedups: orjson for JSON encoding, brotli for the "br" content encoding
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Optional: Pillow for resized thumbnail variants (originals are proxied without it).
+# Imported where it's used, in a worker thread, where the import lock makes that safe.
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OpenAI client
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    raise ValueError("Missing OpenAI API Key")
-else:
-    client = openai.AsyncOpenAI(api_key=openai_api_key)
+# OpenAI settings; the client itself is built on first use (see get_openai_client).
+# Retries are handled by call_upstream, within the request's deadline.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))  # Per-call cap when no request deadline applies
+openai_api_key = os.getenv("OPENAI_API_KEY")
+
+# Google Books API settings
+google_books_api_key = os.getenv("GOOGLE_BOOKS_API_KEY")
+google_books_base_url = os.getenv("GOOGLE_BOOKS_BASE_URL", "https://www.googleapis.com/books/v1").rstrip("/")
+
+# Redis settings; the asyncio client is created on first use (see get_redis_client)
+redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+
+# Recommendation enrichment tuning
+ENRICHMENT_CONCURRENCY = int(os.getenv("ENRICHMENT_CONCURRENCY", "5"))
+ENRICHMENT_DEADLINE_SECONDS = float(os.getenv("ENRICHMENT_DEADLINE_SECONDS", "8"))
+
+# Background pre-warming of the static suggestion buttons' results
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "true").lower() in ("1", "true", "yes")
+PREWARM_REFRESH_SECONDS = float(os.getenv("PREWARM_REFRESH_SECONDS", "3600"))
+PREWARM_MAX_STALE_SECONDS = float(os.getenv("PREWARM_MAX_STALE_SECONDS", "21600"))  # Never serve older than this
+PREWARM_JITTER = float(os.getenv("PREWARM_JITTER", "0.2"))  # +/- fraction applied to each refresh interval
+
+# Speculative prefetch of the next recommendation page ("Show different recommendations")
+# Opt-in: each prefetched page is a full extra LLM call plus enrichment, spent whether or not it's shown
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_SAMPLE_RATE = float(os.getenv("PREFETCH_SAMPLE_RATE", "1.0"))  # Share of shown pages that get one
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "900"))  # Unused pages are dropped after this
+PREFETCH_MAX_SESSIONS = int(os.getenv("PREFETCH_MAX_SESSIONS", "1000"))
+
+# NLP/recommendation pipeline mode: "serial" (NLP then recommendations),
+# "speculative" (recommendations start alongside NLP for detailed messages) or
+# "fused" (one LLM call returns intent, entities and recommendations)
+NLP_PIPELINE_MODE = os.getenv("NLP_PIPELINE_MODE", "serial").lower()
+
+# Shared HTTP client tuning
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+
+# Request deadline budget and upstream resilience
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "20"))
+UPSTREAM_MIN_BUDGET_SECONDS = float(os.getenv("UPSTREAM_MIN_BUDGET_SECONDS", "0.25"))  # Don't start calls with less left
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.2"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "1.0"))  # Used until enough latency samples exist
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))  # Consecutive failures before opening
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))  # Open time before a probe is let through
+
+# Google Books cache tuning
+CACHE_REDIS_ENABLED = os.getenv("CACHE_REDIS_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_REDIS_RETRY_SECONDS = float(os.getenv("CACHE_REDIS_RETRY_SECONDS", "30"))
+GB_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("GB_SEARCH_CACHE_MAX_ENTRIES", "2048"))
+GB_SEARCH_CACHE_TTL = int(os.getenv("GB_SEARCH_CACHE_TTL", "21600"))  # 6 hours
+GB_VOLUME_CACHE_MAX_ENTRIES = int(os.getenv("GB_VOLUME_CACHE_MAX_ENTRIES", "4096"))
+GB_VOLUME_CACHE_TTL = int(os.getenv("GB_VOLUME_CACHE_TTL", "86400"))  # 24 hours
+GB_NEGATIVE_CACHE_TTL = int(os.getenv("GB_NEGATIVE_CACHE_TTL", "900"))  # 15 minutes
+GB_BATCH_RESOLVE = os.getenv("GB_BATCH_RESOLVE", "true").lower() in ("1", "true", "yes")  # OR-combine idea lookups
+GB_BATCH_MAX_IDEAS = int(os.getenv("GB_BATCH_MAX_IDEAS", "5"))  # Titles per OR-combined query
+
+# Local book catalog (SQLite full-text index of every enriched volume); empty path disables it
+BOOK_CATALOG_PATH = os.getenv("BOOK_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "book_catalog.db"))
+BOOK_CATALOG_MAX_AGE = int(os.getenv("BOOK_CATALOG_MAX_AGE", str(30 * 86400)))  # Re-fetch entries older than 30 days
+BOOK_CATALOG_MIN_SCORE = float(os.getenv("BOOK_CATALOG_MIN_SCORE", "0.9"))
+
+# Thumbnail proxy (book covers served from /api/thumbnail); empty cache dir disables the disk cache
+THUMBNAIL_PROXY_ENABLED = os.getenv("THUMBNAIL_PROXY_ENABLED", "true").lower() in ("1", "true", "yes")
+THUMBNAIL_CACHE_DIR = os.getenv("THUMBNAIL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "thumbnail_cache"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv("THUMBNAIL_MAX_SOURCE_BYTES", str(2 * 1024 * 1024)))
+THUMBNAIL_MAX_REDIRECTS = int(os.getenv("THUMBNAIL_MAX_REDIRECTS", "3"))  # Each hop must stay on THUMBNAIL_ALLOWED_HOSTS
+THUMBNAIL_MAX_AGE = int(os.getenv("THUMBNAIL_MAX_AGE", str(30 * 86400)))  # Browser cache lifetime
+THUMBNAIL_WIDTHS = tuple(sorted(int(width) for width in os.getenv("THUMBNAIL_WIDTHS", "64,128,256").split(",") if width.strip()))
+THUMBNAIL_DEFAULT_WIDTH = int(os.getenv("THUMBNAIL_DEFAULT_WIDTH", "128"))  # Width requested by rewritten URLs
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_ALLOWED_HOSTS = tuple(
+    host.strip().lower()
+    for host in os.getenv("THUMBNAIL_ALLOWED_HOSTS", "books.google.com,books.googleusercontent.com").split(",")
+    if host.strip()
+)
+THUMBNAIL_PUBLIC_BASE_URL = os.getenv("THUMBNAIL_PUBLIC_BASE_URL", "").rstrip("/")  # Defaults to the request's base URL
+
+# Per-session record of books already shown, so repeat requests skip them
+SEEN_SET_EXACT_MAX = int(os.getenv("SEEN_SET_EXACT_MAX", "128"))  # Keys held exactly before switching to a Bloom filter
+SEEN_SET_BLOOM_CAPACITY = int(os.getenv("SEEN_SET_BLOOM_CAPACITY", "2000"))
+SEEN_SET_BLOOM_ERROR_RATE = float(os.getenv("SEEN_SET_BLOOM_ERROR_RATE", "0.01"))
+SEEN_PROMPT_MAX_TITLES = int(os.getenv("SEEN_PROMPT_MAX_TITLES", "25"))  # Most recent seen titles named in the prompt
+SEEN_OVERGENERATE_MAX = int(os.getenv("SEEN_OVERGENERATE_MAX", "3"))  # Extra ideas asked for to cover repeats
+
+# Recommendation (LLM) cache tuning
+REC_CACHE_MAX_ENTRIES = int(os.getenv("REC_CACHE_MAX_ENTRIES", "1024"))
+REC_CACHE_TTL = int(os.getenv("REC_CACHE_TTL", "86400"))  # 24 hours
+REC_CACHE_VARIANTS = int(os.getenv("REC_CACHE_VARIANTS", "3"))  # Distinct result sets kept per preference set
+
+# Session store configuration ("memory" or "redis")
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE", "memory").lower()
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "30"))
+SESSION_LOCK_WAIT = float(os.getenv("SESSION_LOCK_WAIT", "10"))
+SESSION_COMPRESS_THRESHOLD = int(os.getenv("SESSION_COMPRESS_THRESHOLD", "1024"))
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Response compression (complete bodies only; streamed responses pass through)
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
+
+# Webhook ingestion queue
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # Queued events beyond this get a 429
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_DEDUPE_TTL = float(os.getenv("WEBHOOK_DEDUPE_TTL", "86400"))  # How long processed event IDs are remembered
+WEBHOOK_DEDUPE_MAX_ENTRIES = int(os.getenv("WEBHOOK_DEDUPE_MAX_ENTRIES", "50000"))
+WEBHOOK_RETRY_AFTER_SECONDS = int(os.getenv("WEBHOOK_RETRY_AFTER_SECONDS", "1"))
+WEBHOOK_DRAIN_SECONDS = float(os.getenv("WEBHOOK_DRAIN_SECONDS", "5"))  # Shutdown grace for queued events
+
+# LLM admission control (per process; see LLM Admission Control)
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))  # Match to the OpenAI tier's rate limit
+USER_LLM_CALLS_PER_MINUTE = float(os.getenv("USER_LLM_CALLS_PER_MINUTE", "20"))  # Token refill rate per user_id
+USER_LLM_BURST = float(os.getenv("USER_LLM_BURST", "8"))  # Token bucket size per user_id
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))  # Waiting calls beyond this are shed
+ADMISSION_MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", "10000"))  # Token buckets kept (least recently used dropped)
+
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "text"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records beyond this are dropped, never waited on
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))  # Share of verbose payload dumps kept
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "200"))
+LOG_MAX_LIST_ITEMS = int(os.getenv("LOG_MAX_LIST_ITEMS", "10"))
+LOG_REDACT_KEYS = frozenset(
+    key.strip().lower()
+    for key in os.getenv("LOG_REDACT_KEYS", "key,api_key,secret,signature,token,password,authorization,email").split(",")
+    if key.strip()
+)
+
+# --- Structured Logging ---
+# Log calls only build a record and drop it on a bounded queue; formatting and
+# stdout writes happen on a background listener thread, so the event loop never
+# blocks on log I/O. Verbose payload dumps go through log_payload, which samples them.
+# Importing the module starts no thread: the app lifespan and the batch runner start
+# the listener and stop it (flushing the queue) on the way out.
+
+log_stats: Dict[str, int] = {"dropped": 0, "payloads_logged": 0, "payloads_skipped": 0}
+
+def _truncate_for_log(value, depth: int = 0):
+    """Returns a log-safe copy of `value` with secrets redacted and large fields truncated."""
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_CHARS:
+            return f"{value[:LOG_MAX_FIELD_CHARS]}...(+{len(value) - LOG_MAX_FIELD_CHARS} chars)"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= 4:
+        return "[...]"
+    if isinstance(value, dict):
+        return {
+            str(key): "[redacted]" if str(key).lower() in LOG_REDACT_KEYS else _truncate_for_log(item, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        items = [_truncate_for_log(item, depth + 1) for item in value[:LOG_MAX_LIST_ITEMS]]
+        if len(value) > LOG_MAX_LIST_ITEMS:
+            items.append(f"...(+{len(value) - LOG_MAX_LIST_ITEMS} items)")
+        return items
+    return _truncate_for_log(str(value) if isinstance(value, BaseException) else repr(value), depth)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and any structured fields."""
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks: a full queue drops the record instead. Message
+    formatting is left to the listener thread; only non-scalar arguments are rendered
+    (and truncated) here, so later mutation on the event loop can't race the writer.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg if isinstance(arg, (int, float)) else _truncate_for_log(arg) for arg in record.args)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"] += 1
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Blocking is fine here: only used on shutdown, while the writer drains
+
+def _configure_logging() -> queue.Queue:
+    """Routes the bookgpt logger into a bounded queue. Nothing is written until start_log_listener."""
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger = logging.getLogger("bookgpt")
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.handlers = [DroppingQueueHandler(log_queue)]
+    logger.propagate = False
+    return log_queue
+
+log = logging.getLogger("bookgpt")
+_log_queue = _configure_logging()
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def start_log_listener():
+    """Starts the thread writing queued records to stdout; a no-op once started."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(
+        JsonLogFormatter() if LOG_FORMAT == "json"
+        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    _log_listener = _LogListener(_log_queue, output)
+    _log_listener.start()
+    atexit.register(stop_log_listener)  # Flush what is queued if the process exits without a shutdown
+
+def stop_log_listener():
+    """Writes out what is queued and stops the writer thread."""
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+        atexit.unregister(stop_log_listener)
+
+def log_payload(message: str, payload, level: int = logging.DEBUG, **fields):
+    """
+    Logs a large payload (state, LLM output, webhook bodies) for a sampled share of
+    calls, redacted and truncated. Skipped calls cost one level check and a random draw.
+    """
+    if not log.isEnabledFor(level):
+        return
+    if random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        log_stats["payloads_skipped"] += 1
+        return
+    log_stats["payloads_logged"] += 1
+    log.log(level, message, extra={"fields": {**fields, "payload": _truncate_for_log(payload)}})
+
+# --- End Structured Logging ---
+
+# --- Metrics ---
+# Minimal in-process Prometheus metrics. Recording is a dict lookup plus a few
+# additions, so it is cheap enough for every request; formatting only happens
+# when /metrics is scraped.
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(label_names, label_values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    __slots__ = ("name", "help", "label_names", "values")
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name, self.help, self.label_names = name, help_text, label_names
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {value}" for labels, value in self.values.items()]
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def dec(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) - amount
+
+class Histogram:
+    __slots__ = ("name", "help", "label_names", "buckets", "series")
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = _LATENCY_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help_text, label_names, buckets
+        self.series: Dict[tuple, list] = {}  # labels -> [per-bucket counts, sum, count]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (bucket_counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names + ('le',), labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names + ('le',), labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Any] = []
+        self.collectors: List[Any] = []  # Callables returning (metric, labels, value) at scrape time
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                for metric, labels, value in collect():
+                    metric.values[labels] = value
+            except Exception as e:
+                log.warning("Metrics Error: Collector failed - %s", e)
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_LATENCY = metrics.register(Histogram(
+    "bookgpt_stage_duration_seconds", "Latency of each pipeline stage.", ("stage",)))
+STAGE_IN_FLIGHT = metrics.register(Gauge(
+    "bookgpt_stage_in_flight", "Pipeline stage calls currently running.", ("stage",)))
+CHAT_BRANCH_LATENCY = metrics.register(Histogram(
+    "bookgpt_chat_turn_duration_seconds", "Latency of a chat turn by state machine branch.", ("branch",)))
+HTTP_LATENCY = metrics.register(Histogram(
+    "bookgpt_http_request_duration_seconds", "HTTP request latency.", ("method", "path", "status")))
+HTTP_IN_FLIGHT = metrics.register(Gauge(
+    "bookgpt_http_requests_in_flight", "HTTP requests currently being served."))
+UPSTREAM_RESPONSES = metrics.register(Counter(
+    "bookgpt_upstream_responses_total", "Upstream responses by status code.", ("upstream", "call", "status")))
+OPENAI_TOKENS = metrics.register(Counter(
+    "bookgpt_openai_tokens_total", "OpenAI token usage.", ("call", "kind")))
+CACHE_EVENTS = metrics.register(Gauge(
+    "bookgpt_cache_events", "Cumulative cache lookups by result, read from the caches at scrape time.", ("cache", "result")))
+WEBHOOK_QUEUE_DEPTH = metrics.register(Gauge(
+    "bookgpt_webhook_queue_depth", "Webhook events waiting for a worker."))
+WEBHOOK_EVENTS = metrics.register(Counter(
+    "bookgpt_webhook_events_total", "Webhook events by outcome.", ("result",)))
+WEBHOOK_LATENCY = metrics.register(Histogram(
+    "bookgpt_webhook_duration_seconds", "Webhook queue wait per event and processing time per batch.", ("phase",)))
+LLM_ADMISSION = metrics.register(Counter(
+    "bookgpt_llm_admission_total", "LLM call admission decisions by call kind.", ("kind", "result")))
+LLM_ADMISSION_WAIT = metrics.register(Histogram(
+    "bookgpt_llm_admission_wait_seconds", "Time admitted LLM calls waited for a concurrency slot.", ("kind",)))
+COMPONENT_STATS = metrics.register(Gauge(
+    "bookgpt_component_stat", "Other component counters and sizes, read at scrape time.", ("component", "stat")))
+
+class timed_stage:
+    """
+    Records a stage's latency and in-flight count. Usable as a decorator on async
+    functions or as an async context manager.
+    """
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __call__(self, func):
+        stage = self.stage
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            STAGE_IN_FLIGHT.inc(stage)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                STAGE_IN_FLIGHT.dec(stage)
+                STAGE_LATENCY.observe(time.perf_counter() - started, stage)
+        return wrapper
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+        STAGE_IN_FLIGHT.inc(self.stage)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        STAGE_IN_FLIGHT.dec(self.stage)
+        STAGE_LATENCY.observe(time.perf_counter() - self.started, self.stage)
+
+def record_openai_response(call: str, response=None, error: Optional[Exception] = None):
+    """Counts an OpenAI call's outcome and, on success, its token usage."""
+    if error is not None:
+        UPSTREAM_RESPONSES.inc("openai", call, str(getattr(error, "status_code", None) or type(error).__name__))
+        return
+    UPSTREAM_RESPONSES.inc("openai", call, "200")
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        OPENAI_TOKENS.inc(call, "prompt", amount=getattr(usage, "prompt_tokens", 0) or 0)
+        OPENAI_TOKENS.inc(call, "completion", amount=getattr(usage, "completion_tokens", 0) or 0)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request. Requests are labelled with the matched
+    route template rather than the raw path so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "other"
+            HTTP_LATENCY.observe(time.perf_counter() - started, scope.get("method", ""), path, str(status["code"]))
+
+# --- End Metrics ---
+
+# --- Response Encoding ---
+
+def fast_json_dumps(value: Any, sort_keys: bool = False) -> bytes:
+    """Compact UTF-8 JSON; uses orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode("utf-8")
+
+def fast_json_loads(data: bytes) -> Any:
+    """Parses JSON bytes; raises ValueError on invalid input either way."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with fast_json_dumps (the app's default response class)."""
+
+    def render(self, content: Any) -> bytes:
+        return fast_json_dumps(content)
+
+_COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/css", "application/javascript", "image/svg+xml")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the content coding for an Accept-Encoding header: the supported coding with
+    the highest q-value above zero (brotli over gzip on a tie, when it is installed),
+    with "*" covering codings the header doesn't name. None means send it uncompressed.
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    supported = ("br", "gzip") if brotli is not None else ("gzip",)
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing complete response bodies of at least `minimum_size`
+    bytes with the coding negotiate_encoding picks from the client's Accept-Encoding.
+    Streamed bodies (server-sent events) and already-encoded responses pass through.
+    """
+
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = negotiate_encoding(accept)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        pending_start = None
+
+        async def send_wrapper(message):
+            nonlocal pending_start
+            if message["type"] == "http.response.start":
+                pending_start = message  # Held until we know whether the body gets compressed
+                return
+            if message["type"] != "http.response.body" or pending_start is None:
+                await send(message)
+                return
+            start, pending_start = pending_start, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            content_type = headers.get("content-type", "")
+            if (message.get("more_body") or len(body) < self.minimum_size
+                    or "content-encoding" in headers or not content_type.startswith(_COMPRESSIBLE_TYPES)):
+                await send(start)
+                await send(message)
+                return
+            if encoding == "br":
+                body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+            else:
+                body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+# --- End Response Encoding ---
+
+# --- Upstream Resilience ---
+# Each chat turn gets a deadline budget (a context variable, so tasks spawned during
+# the turn inherit it). Upstream calls go through call_upstream, which caps every
+# attempt at the remaining budget, retries transient failures with jittered backoff
+# while budget remains, hedges slow idempotent calls and fails fast behind a
+# per-upstream circuit breaker.
+
+_request_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+resilience_stats: Dict[str, int] = {"retries": 0, "hedges": 0, "hedge_wins": 0, "budget_exhausted": 0, "stale_served": 0}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+def start_request_deadline(seconds: float = REQUEST_DEADLINE_SECONDS) -> contextvars.Token:
+    return _request_deadline.set(time.monotonic() + seconds)
+
+def remaining_budget(cap: float) -> float:
+    """Seconds left for an upstream call: the request's remaining budget, at most `cap`."""
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return cap
+    return min(cap, deadline - time.monotonic())
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive transient failures and rejects calls
+    for `reset_seconds`, then lets a single probe through (half-open); the probe's
+    outcome closes or re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            log.info("Circuit Breaker (%s): Closed after successful probe", self.name)
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+            self.times_opened += 1
+            log.warning("Circuit Breaker (%s): Open after %s consecutive failures, failing fast for %ss",
+                        self.name, self.failures, self.reset_seconds)
+
+    def release_probe(self):
+        """Called when a probe is cancelled before it had an outcome."""
+        self.probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+class LatencyTracker:
+    """Rolling window of call latencies; the hedge delay is its p95."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self._p95 = HEDGE_DEFAULT_DELAY
+        self._observed = 0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._observed += 1
+        if len(self.samples) >= self.min_samples and self._observed % 10 == 0:
+            ordered = sorted(self.samples)
+            self._p95 = ordered[int(0.95 * (len(ordered) - 1))]
+
+    def hedge_delay(self) -> float:
+        return max(HEDGE_MIN_DELAY, self._p95)
+
+openai_breaker = CircuitBreaker("openai")
+google_books_breaker = CircuitBreaker("google_books")
+google_books_search_latency = LatencyTracker()
+google_books_volume_latency = LatencyTracker()
+
+def _is_transient_upstream_error(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, openai.APIConnectionError)):
+        return True
+    status = getattr(error, "status", None) if isinstance(error, aiohttp.ClientResponseError) else \
+        getattr(error, "status_code", None) if isinstance(error, openai.APIStatusError) else None
+    return status is not None and (status == 429 or status >= 500)
+
+async def _hedged(breaker: CircuitBreaker, attempt, budget: float, hedge_delay: float):
+    """
+    Runs `attempt()`, starting a duplicate if it hasn't finished after `hedge_delay`; the
+    first success wins. Only hedges while `breaker` is closed, so a probe stays single.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget
+    first = asyncio.ensure_future(attempt())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=min(hedge_delay, budget))
+        if not done and breaker.state == "closed" and deadline - loop.time() >= UPSTREAM_MIN_BUDGET_SECONDS:
+            resilience_stats["hedges"] += 1
+            tasks.append(asyncio.ensure_future(attempt()))
+        error: Optional[BaseException] = None
+        while tasks:
+            remaining = deadline - loop.time()
+            done, _ = await asyncio.wait(tasks, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+            for task in done:
+                tasks.remove(task)
+                if task.exception() is None:
+                    if task is not first:
+                        resilience_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def call_upstream(breaker: CircuitBreaker, attempt, max_timeout: float, latency: Optional[LatencyTracker] = None):
+    """
+    Calls `attempt()` (a coroutine factory) within the current request's remaining budget.
+    Transient failures are retried with full-jitter backoff while budget remains; with a
+    `latency` tracker (idempotent calls only) slow attempts are hedged past their p95.
+    Raises CircuitOpenError when the breaker is open, or the last error.
+    """
+    for attempt_number in range(UPSTREAM_MAX_ATTEMPTS):
+        budget = remaining_budget(max_timeout)
+        if budget < UPSTREAM_MIN_BUDGET_SECONDS:
+            resilience_stats["budget_exhausted"] += 1
+            raise asyncio.TimeoutError()
+        if not breaker.allow():
+            raise CircuitOpenError(f"{breaker.name} circuit is open, failing fast")
+        started = time.monotonic()
+        try:
+            if latency is not None and HEDGE_ENABLED:
+                result = await _hedged(breaker, attempt, budget, latency.hedge_delay())
+            else:
+                result = await asyncio.wait_for(attempt(), budget)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not _is_transient_upstream_error(e):
+                breaker.record_success()  # The upstream answered; the request itself was bad
+                raise
+            breaker.record_failure()
+            backoff = random.uniform(0, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt_number)
+            if attempt_number + 1 >= UPSTREAM_MAX_ATTEMPTS or remaining_budget(max_timeout) - backoff < UPSTREAM_MIN_BUDGET_SECONDS:
+                raise
+            resilience_stats["retries"] += 1
+            log.debug("Upstream (%s): Retrying in %.2fs after %s", breaker.name, backoff, type(e).__name__)
+            await asyncio.sleep(backoff)
+            continue
+        breaker.record_success()
+        if latency is not None:
+            latency.observe(time.monotonic() - started)
+        return result
+
+# --- End Upstream Resilience ---
+
+# --- LLM Admission Control ---
+# Every OpenAI completion waits for one of OPENAI_MAX_CONCURRENCY slots. Calls made
+# for a chat turn are charged to its user_id's token bucket, so a client spamming
+# /api/chat gets a 429 instead of filling the rate limit for everyone else. Waiting
+# calls are served by class (NLP first, then recommendation generation, then
+# background work) and round robin across users within a class. A call that would
+# wait past its request budget is shed with a 503 up front rather than timing out.
+
+_llm_user: contextvars.ContextVar = contextvars.ContextVar("llm_user", default=None)  # None: background work
+# Set in shared (single-flight) calls made for chat turns: no user, but not background either
+_llm_interactive: contextvars.ContextVar = contextvars.ContextVar("llm_interactive", default=False)
+
+ADMISSION_PRIORITIES = {"nlp": 0, "recommendations": 1}
+ADMISSION_COSTS = {"nlp": 1.0, "recommendations": 2.0}  # Bucket tokens charged per call
+_BACKGROUND_PRIORITY = 2
+
+class AdmissionRejected(Exception):
+    """Raised instead of making an LLM call that is over its user's rate or can't be served in time."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"LLM call not admitted ({reason})")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status_code = 429 if reason == "rate_limited" else 503
+        self.detail = "Too many requests, please slow down" if reason == "rate_limited" else \
+            "The assistant is busy right now, please try again shortly"
+
+def start_llm_user(user_id: Optional[str]) -> contextvars.Token:
+    return _llm_user.set(user_id)
+
+class AdmissionController:
+    """
+    Concurrency cap, per-user token buckets and a fair priority queue in front of OpenAI.
+    Use `async with controller.slot(kind)`, or `acquire()` and `release()` to hold a
+    slot across a stream.
+    """
+
+    def __init__(self, max_concurrency: int = OPENAI_MAX_CONCURRENCY, calls_per_minute: float = USER_LLM_CALLS_PER_MINUTE,
+                 burst: float = USER_LLM_BURST, max_queue: int = ADMISSION_MAX_QUEUE, max_users: int = ADMISSION_MAX_USERS):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = calls_per_minute / 60.0
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_users = max_users
+        self.active = 0
+        # Per priority: user_id -> waiter futures, rotated so each user gets a turn
+        self._queues: List["OrderedDict[Optional[str], deque]"] = [OrderedDict() for _ in range(_BACKGROUND_PRIORITY + 1)]
+        self._waiting = [0] * (_BACKGROUND_PRIORITY + 1)
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # user_id -> [tokens, updated_at]
+        self._service_ewma: Optional[float] = None  # Moving average of how long a slot is held
+        self.counters = {"admitted": 0, "queued": 0, "rate_limited": 0, "shed_overloaded": 0, "shed_deadline": 0,
+                         "wait_seconds_total": 0.0}
+
+    def _take_tokens(self, user: str, cost: float, now: float) -> float:
+        """Charges `cost` to the user's bucket; returns 0, or the seconds until it could be afforded."""
+        bucket = self._buckets.pop(user, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        short = cost - tokens
+        if short <= 0:
+            tokens -= cost
+        self._buckets[user] = [tokens, now]
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return max(0.0, short) / self.rate
+
+    def _refund_tokens(self, user: str, cost: float):
+        bucket = self._buckets.get(user)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + cost)
+
+    def refund(self, cost: float):
+        """Gives back what `charge` took when the call was shed before reaching OpenAI."""
+        user = _llm_user.get()
+        if cost and user is not None:
+            self._refund_tokens(user, cost)
+
+    def _expected_wait(self, priority: int) -> float:
+        """Rough queueing delay for a new call: the calls served before it, spread over the slots."""
+        if self._service_ewma is None:
+            return 0.0
+        ahead = sum(self._waiting[:priority + 1])
+        return (ahead + 1) * self._service_ewma / self.max_concurrency
+
+    def _reject(self, kind: str, reason: str, retry_after: float):
+        self.counters[reason] += 1
+        LLM_ADMISSION.inc(kind, reason)
+        log.warning("Admission: Rejected %s call for user %s (%s)", kind, _llm_user.get(), reason)
+        raise AdmissionRejected(reason.replace("shed_", ""), retry_after)
+
+    def _admitted(self, kind: str, waited: float):
+        self.counters["admitted"] += 1
+        self.counters["wait_seconds_total"] += waited
+        LLM_ADMISSION.inc(kind, "admitted")
+        LLM_ADMISSION_WAIT.observe(waited, kind)
+
+    def _forget(self, priority: int, user: Optional[str], waiter: asyncio.Future):
+        waiters = self._queues[priority].get(user)
+        if waiters is None or waiter not in waiters:
+            return  # Already handed a slot by _wake_next
+        waiters.remove(waiter)
+        self._waiting[priority] -= 1
+        if not waiters:
+            del self._queues[priority][user]
+
+    def _wake_next(self):
+        while self.active < self.max_concurrency:
+            priority = next((index for index, queue in enumerate(self._queues) if queue), None)
+            if priority is None:
+                return
+            queue = self._queues[priority]
+            user, waiters = next(iter(queue.items()))
+            waiter = waiters.popleft()
+            self._waiting[priority] -= 1
+            if waiters:
+                queue.move_to_end(user)  # This user's next call goes behind the other users'
+            else:
+                del queue[user]
+            if waiter.done():
+                continue  # Gave up (timed out or cancelled) but hasn't been removed yet
+            self.active += 1
+            waiter.set_result(None)
+
+    def charge(self, kind: str) -> float:
+        """
+        Charges an LLM call of this kind to the current user's token bucket and returns
+        the tokens taken. Raises AdmissionRejected when the user is over their rate.
+        """
+        user = _llm_user.get()
+        if not ADMISSION_ENABLED or user is None or self.rate <= 0:
+            return 0.0
+        cost = min(ADMISSION_COSTS.get(kind, 1.0), self.burst)
+        retry_after = self._take_tokens(user, cost, time.monotonic())
+        if retry_after > 0:
+            self._reject(kind, "rate_limited", retry_after)
+        return cost
+
+    async def acquire(self, kind: str, charge: bool = True) -> float:
+        """
+        Waits for a slot for an LLM call of this kind and returns when it was admitted
+        (pass that to `release`). Raises AdmissionRejected if the call is shed. With
+        `charge=False` the callers have already been charged (see `charge`).
+        """
+        now = time.monotonic()
+        if not ADMISSION_ENABLED:
+            return now
+        user = _llm_user.get()
+        interactive = user is not None or _llm_interactive.get()
+        priority = ADMISSION_PRIORITIES.get(kind, _BACKGROUND_PRIORITY) if interactive else _BACKGROUND_PRIORITY
+        cost = self.charge(kind) if charge else 0.0
+        if self.active < self.max_concurrency and not any(self._waiting):
+            self.active += 1
+            self._admitted(kind, 0.0)
+            return now
+
+        # Calls outside a request (batch runner, prewarm loop) just wait their turn
+        bounded = _request_deadline.get() is not None
+        budget = remaining_budget(OPENAI_TIMEOUT_SECONDS) - UPSTREAM_MIN_BUDGET_SECONDS
+        expected_wait = self._expected_wait(priority)
+        if bounded and (sum(self._waiting) >= self.max_queue or expected_wait > budget):
+            if cost:
+                self._refund_tokens(user, cost)  # Nothing was spent on the user's behalf
+            reason = "shed_overloaded" if sum(self._waiting) >= self.max_queue else "shed_deadline"
+            self._reject(kind, reason, expected_wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(user, deque()).append(waiter)
+        self._waiting[priority] += 1
+        self.counters["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, max(0.0, budget) if bounded else None)
+        except asyncio.TimeoutError:
+            self._forget(priority, user, waiter)
+            if cost:
+                self._refund_tokens(user, cost)  # Timed out in the queue, so the call never ran
+            self._reject(kind, "shed_deadline", self._expected_wait(priority))
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.active -= 1  # The slot arrived just as the caller was cancelled; pass it on
+                self._wake_next()
+            self._forget(priority, user, waiter)
+            if cost:
+                self._refund_tokens(user, cost)
+            raise
+        admitted_at = time.monotonic()
+        self._admitted(kind, admitted_at - now)
+        return admitted_at
+
+    def release(self, admitted_at: float):
+        if not ADMISSION_ENABLED:
+            return
+        held = time.monotonic() - admitted_at
+        self._service_ewma = held if self._service_ewma is None else 0.9 * self._service_ewma + 0.1 * held
+        self.active -= 1
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, kind: str, charge: bool = True):
+        admitted_at = await self.acquire(kind, charge)
+        try:
+            yield
+        finally:
+            self.release(admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "wait_seconds_total": round(self.counters["wait_seconds_total"], 3),
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "waiting": sum(self._waiting),
+            "waiting_users": sum(len(queue) for queue in self._queues),
+            "tracked_users": len(self._buckets),
+            "service_seconds_avg": round(self._service_ewma, 4) if self._service_ewma is not None else None
+        }
+
+llm_admission = AdmissionController()
+
+# --- End LLM Admission Control ---
+
+# Application-scoped HTTP session, opened and closed by the app lifespan
+http_session: Optional["aiohttp.ClientSession"] = None
+
+def _create_http_session() -> "aiohttp.ClientSession":
+    """
+    Builds the pooled aiohttp session used for all Google Books calls.
+    Connections are kept alive and reused, and DNS lookups are cached.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=False)
+
+def get_http_session() -> "aiohttp.ClientSession":
+    """
+    Returns the shared HTTP session, creating it on first use when running outside the app lifespan.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = _create_http_session()
+    return http_session
+
+async def close_http_session():
+    """Closes the shared HTTP session if it is open."""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+_openai_client = None
+_redis_client = None
+
+def get_openai_client():
+    """Returns the shared OpenAI client, building it on first use. None without an API key."""
+    global _openai_client
+    if _openai_client is None and openai_api_key:
+        _openai_client = openai.AsyncOpenAI(api_key=openai_api_key, max_retries=0, timeout=OPENAI_TIMEOUT_SECONDS)
+    return _openai_client
+
+def get_redis_client():
+    """
+    Returns the shared asyncio Redis client (so cache and state lookups never block the
+    event loop), creating it and importing redis on first use.
+    """
+    global _redis_client
+    if _redis_client is None:
+        import redis.asyncio as aioredis
+        _redis_client = aioredis.from_url(
+            redis_url,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_timeout=REDIS_SOCKET_TIMEOUT
+        )
+    return _redis_client
+
+async def _close_redis_client():
+    """Closes the Redis connection pool, if one was opened, tolerating older redis-py versions."""
+    global _redis_client
+    if _redis_client is None:
+        return
+    close = getattr(_redis_client, "aclose", None) or _redis_client.close
+    try:
+        await close()
+    except Exception as e:
+        log.warning("Redis: Error while closing client: %s", e)
+    _redis_client = None
+
+# --- Startup and Readiness ---
+# Startup only opens the HTTP session and schedules a background warm-up; the app
+# accepts traffic immediately and /api/ready reports 200 once the warm-up has run.
+
+startup_timings: Dict[str, Optional[float]] = {
+    "import_seconds": None, "startup_seconds": None, "warmup_seconds": None, "time_to_ready_seconds": None
+}
+readiness_checks: Dict[str, str] = {}
+_warmup_task: Optional[asyncio.Task] = None
+
+async def _warm_check(name: str, check):
+    try:
+        await check()
+        readiness_checks[name] = "ok"
+    except Exception as e:
+        readiness_checks[name] = f"error: {type(e).__name__}"
+        log.warning("Startup: Warm-up of %s failed - %s", name, e)
+
+async def _warm_openai():
+    client = get_openai_client()  # Pays the deferred openai import here rather than on a request
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    try:
+        await client.with_options(timeout=5).models.list()  # Opens a pooled TLS connection
+    except openai.APIStatusError:
+        pass  # Any HTTP answer means the connection is warm
+
+async def _warm_google_books():
+    if not google_books_api_key:
+        raise RuntimeError("GOOGLE_BOOKS_API_KEY is not set")
+    # Unauthenticated HEAD: costs no quota but leaves a warm connection in the pool
+    async with get_http_session().head(google_books_base_url, timeout=aiohttp.ClientTimeout(total=5)):
+        pass
+
+async def _warm_redis():
+    await get_redis_client().ping()
+
+async def _warm_catalog():
+    book_catalog._connect()
+
+async def _warm_up():
+    started = time.perf_counter()
+    checks = [("openai", _warm_openai), ("google_books", _warm_google_books), ("catalog", _warm_catalog)]
+    if CACHE_REDIS_ENABLED or SESSION_STORE_BACKEND == "redis":
+        checks.append(("redis", _warm_redis))
+    await asyncio.gather(*(_warm_check(name, check) for name, check in checks))
+    startup_timings["warmup_seconds"] = round(time.perf_counter() - started, 4)
+    startup_timings["time_to_ready_seconds"] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+    log.info("Startup: Warm in %.3fs, ready %.3fs after import began (%s)",
+             startup_timings["warmup_seconds"], startup_timings["time_to_ready_seconds"], readiness_checks)
+
+def start_warm_up() -> asyncio.Task:
+    global _warmup_task
+    if _warmup_task is None:
+        _warmup_task = asyncio.create_task(_warm_up())
+    return _warmup_task
+
+def is_ready() -> bool:
+    # Missing API keys keep an instance out of rotation; a failed network warm-up doesn't,
+    # since the circuit breakers already deal with unhealthy upstreams
+    return (
+        _warmup_task is not None and _warmup_task.done()
+        and bool(openai_api_key) and bool(google_books_api_key)
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    start_log_listener()
+    get_http_session()
+    log.info("HTTP client: Shared session ready (pool=%s, per_host=%s)", HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST)
+    if not openai_api_key or not google_books_api_key:
+        log.error("Startup: OPENAI_API_KEY and GOOGLE_BOOKS_API_KEY must both be set; reporting not ready")
+    warmup_task = start_warm_up()
+    prewarm_task = start_prewarming()
+    start_webhook_workers()
+    startup_timings["startup_seconds"] = round(time.perf_counter() - started, 4)
+    try:
+        yield
+    finally:
+        await cancel_all_page_prefetches()
+        global _warmup_task
+        for task in (warmup_task, prewarm_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        _warmup_task = None
+        await stop_webhook_workers()
+        await close_http_session()
+        log.info("HTTP client: Shared session closed")
+        await _close_redis_client()
+        stop_log_listener()
+
+# --- End Startup and Readiness ---
+
+class ChatRequest(BaseModel):
+    user_id: str
+    message: str
+    known_books: List[str] = []  # Delta mode: volume IDs or ETags of books the client already holds
+
+class ChatResponse(BaseModel):
+    user_id: str
+    bot_message: str
+    suggestions: List[str] = []
+    books: List[dict] = []  # Placeholder for book data
+
+def parse_book_fields(fields: Optional[str]) -> Optional[frozenset]:
+    """Parses a `fields=title,thumbnail` projection; None means every field. "id" is always kept."""
+    if not fields:
+        return None
+    return frozenset(name.strip() for name in fields.split(",") if name.strip()) | {"id", "etag"}
+
+def book_etag(book: Dict[str, Any]) -> str:
+    """Short content hash identifying this version of a book's data."""
+    return hashlib.sha1(fast_json_dumps(book, sort_keys=True)).hexdigest()[:16]
+
+def shape_book(
+    book: Dict[str, Any],
+    fields: Optional[frozenset] = None,
+    known: Optional[set] = None,
+    thumbnail_base: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Shapes one book for the client: books it already holds (by volume ID or ETag)
+    shrink to a stub, the rest are projected onto `fields`. Unknown field names are ignored.
+    With a `thumbnail_base`, the thumbnail points at our proxy (see Thumbnail Proxy).
+    """
+    etag = book_etag(book)
+    if known and (book.get("id") in known or etag in known):
+        return {"id": book.get("id"), "etag": etag, "unchanged": True}
+    shaped = {key: value for key, value in book.items() if fields is None or key in fields}
+    if thumbnail_base and shaped.get("thumbnail"):
+        shaped["thumbnail"] = proxied_thumbnail_url(shaped["thumbnail"], thumbnail_base)
+    shaped["etag"] = etag
+    return shaped
+
+def shape_books(
+    books: List[Dict[str, Any]],
+    fields: Optional[frozenset] = None,
+    known: Optional[set] = None,
+    thumbnail_base: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    return [shape_book(book, fields, known, thumbnail_base) for book in books]
+
+# Routes are registered on this router and mounted by create_app
+router = APIRouter()
+
+# --- Session State Store ---
+# Conversation state lives behind a pluggable store so the API can run on several
+# workers or replicas. Each chat turn holds the session lock while it reads,
+# modifies and writes the state, making the turn an atomic read-modify-write.
+
+def _new_session_state() -> Dict[str, Any]:
+    return {"history": [], "stage": "INIT", "details": {}}
+
+class SessionBusyError(Exception):
+    """Raised when a session's lock can't be taken in time because another turn holds it."""
+
+SESSION_BUSY_DETAIL = "A previous message in this conversation is still being processed, please retry"
+
+class SessionStore:
+    """Interface for conversation state storage."""
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def save(self, session_id: str, state: Dict[str, Any]):
+        raise NotImplementedError
+
+    async def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        """Reports the store's current footprint."""
+        return {}
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        """Serializes read-modify-write cycles on a single session."""
+        raise NotImplementedError
+        yield
+
+# Book fields kept in a compact session state, in tuple order. Anything else a book
+# carries is kept in a trailing dict (None when there is nothing).
+SESSION_BOOK_FIELDS = ("id", "title", "authors", "description", "thumbnail", "isbn13", "categories", "reasoning", "amazon_link")
+_ABSENT = object()  # A field the book doesn't have, as opposed to one set to None
+
+class CompactSessionState:
+    """
+    Memory-lean form of a session state. History turns are stored as tuples and
+    recommendations as tuples of SESSION_BOOK_FIELDS, so a load rebuilds them without
+    any lookups and the books (and their ETags) are exactly what was shown.
+    """
+    __slots__ = ("stage", "history", "details", "recommendations", "size")
+
+    def __init__(self, stage, history, details, recommendations):
+        self.stage = stage
+        self.history = history
+        self.details = details
+        self.recommendations = recommendations
+        self.size = self._estimate_size()
+
+    @staticmethod
+    def _pack_book(book: Dict[str, Any]) -> tuple:
+        values = tuple(
+            tuple(value) if isinstance(value, list) else value
+            for value in (book.get(field, _ABSENT) for field in SESSION_BOOK_FIELDS)
+        )
+        extra = {key: value for key, value in book.items() if key not in SESSION_BOOK_FIELDS}
+        return values + (extra or None,)
+
+    @staticmethod
+    def _unpack_book(packed: tuple) -> Dict[str, Any]:
+        book = {
+            field: list(value) if isinstance(value, tuple) else value
+            for field, value in zip(SESSION_BOOK_FIELDS, packed)
+            if value is not _ABSENT
+        }
+        if packed[-1]:
+            book.update(packed[-1])
+        return book
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "CompactSessionState":
+        details = dict(state.get("details", {}))
+        books = details.pop("last_recommendations", None)
+        recommendations = tuple(cls._pack_book(book) for book in books) if books is not None else None
+        history = tuple((turn.get("role"), turn.get("content")) for turn in state.get("history", []))
+        return cls(state.get("stage", "INIT"), history, details, recommendations)
+
+    def to_state(self) -> Dict[str, Any]:
+        details = dict(self.details)
+        if self.recommendations is not None:
+            details["last_recommendations"] = [self._unpack_book(packed) for packed in self.recommendations]
+        return {
+            "history": [{"role": role, "content": content} for role, content in self.history],
+            "stage": self.stage,
+            "details": details
+        }
+
+    def _estimate_size(self) -> int:
+        # Rough byte count: string payloads plus a fixed per-object overhead
+        size = 256 + len(json.dumps(self.details, separators=(",", ":")))
+        for role, content in self.history:
+            size += 120 + len(role or "") + len(content or "")
+        for packed in self.recommendations or ():
+            size += 160 + sum(len(str(value)) for value in packed if value is not _ABSENT)
+        return size
+
+class InMemorySessionStore(SessionStore):
+    """
+    Process-local store. Only suitable for a single worker.
+    Sessions are kept in compact form in an LRU that evicts sessions idle for longer
+    than `ttl` seconds and keeps the total within `max_entries` and `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = SESSION_CACHE_MAX_ENTRIES,
+        max_bytes: int = SESSION_CACHE_MAX_BYTES,
+        ttl: int = SESSION_TTL_SECONDS
+    ):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sessions: "OrderedDict[str, tuple]" = OrderedDict()  # session_id -> (last_access, CompactSessionState)
+        self.total_bytes = 0
+        self.evictions = 0
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+
+    def _remove(self, session_id: str):
+        entry = self.sessions.pop(session_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1].size
+
+    def _evict(self):
+        # Least recently used sessions sit at the front, so idle ones expire from there.
+        # The most recently saved session is always kept, even if it alone exceeds the budget.
+        expire_before = time.monotonic() - self.ttl
+        while len(self.sessions) > 1:
+            session_id, (last_access, compact) = next(iter(self.sessions.items()))
+            over_budget = len(self.sessions) > self.max_entries or self.total_bytes > self.max_bytes
+            if last_access >= expire_before and not over_budget:
+                break
+            self._remove(session_id)
+            self.evictions += 1
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        last_access, compact = entry
+        if last_access < time.monotonic() - self.ttl:
+            self._remove(session_id)
+            self.evictions += 1
+            return None
+        self.sessions[session_id] = (time.monotonic(), compact)
+        self.sessions.move_to_end(session_id)
+        return compact.to_state()
+
+    async def save(self, session_id: str, state: Dict[str, Any]):
+        self._remove(session_id)
+        compact = CompactSessionState.from_state(state)
+        self.sessions[session_id] = (time.monotonic(), compact)
+        self.total_bytes += compact.size
+        self._evict()
+
+    async def delete(self, session_id: str):
+        self._remove(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions
+        }
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        session_lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._lock_users[session_id] = self._lock_users.get(session_id, 0) + 1
+        try:
+            async with session_lock:
+                yield
+        finally:
+            self._lock_users[session_id] -= 1
+            if not self._lock_users[session_id]:  # Drop idle locks so they don't accumulate
+                del self._lock_users[session_id]
+                del self._locks[session_id]
+
+# Releases the lock only if it still holds our token
+_REDIS_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class RedisSessionStore(SessionStore):
+    """
+    Shared store on asyncio Redis. States are stored as compact JSON, zlib-compressed
+    above SESSION_COMPRESS_THRESHOLD bytes, and expire after `ttl` seconds of inactivity.
+    """
+
+    def __init__(self, redis_factory, ttl: int = SESSION_TTL_SECONDS, prefix: str = "bookgpt:session"):
+        self._redis_factory = redis_factory
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @property
+    def redis(self):
+        return self._redis_factory()
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:{session_id}"
+
+    @staticmethod
+    def _encode(state: Dict[str, Any]) -> bytes:
+        raw = json.dumps(state, separators=(",", ":")).encode()
+        if len(raw) > SESSION_COMPRESS_THRESHOLD:
+            return b"z" + zlib.compress(raw)
+        return b"j" + raw
+
+    @staticmethod
+    def _decode(data: bytes) -> Dict[str, Any]:
+        if data[:1] == b"z":
+            return json.loads(zlib.decompress(data[1:]))
+        return json.loads(data[1:])
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        data = await self.redis.get(self._key(session_id))
+        if data is None:
+            return None
+        try:
+            return self._decode(data)
+        except (ValueError, zlib.error) as e:
+            log.warning("Session Store: Discarding unreadable state for %s - %s", session_id, e)
+            return None
+
+    async def save(self, session_id: str, state: Dict[str, Any]):
+        await self.redis.set(self._key(session_id), self._encode(state), ex=self.ttl)
+
+    async def delete(self, session_id: str):
+        await self.redis.delete(self._key(session_id))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "ttl": self.ttl}
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        lock_key = f"{self._key(session_id)}:lock"
+        token = uuid.uuid4().hex
+        wait_until = time.monotonic() + SESSION_LOCK_WAIT
+        delay = 0.05
+        # The lock expires on its own, so a crashed holder can't wedge the session forever
+        while not await self.redis.set(lock_key, token, nx=True, px=int(SESSION_LOCK_TIMEOUT * 1000)):
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                log.warning("Session Store: Could not lock session %s within %ss", session_id, SESSION_LOCK_WAIT)
+                raise SessionBusyError(f"session {session_id} is locked by another turn")
+            await asyncio.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(delay * 2, 0.5)
+        try:
+            yield
+        finally:
+            try:
+                await self.redis.eval(_REDIS_UNLOCK_SCRIPT, 1, lock_key, token)
+            except Exception as e:
+                log.warning("Session Store: Failed to release lock for %s - %s", session_id, e)
+
+def _create_session_store() -> SessionStore:
+    if SESSION_STORE_BACKEND == "redis":
+        log.info("Session Store: Using Redis session store")
+        return RedisSessionStore(get_redis_client)
+    return InMemorySessionStore()
+
+session_store = _create_session_store()
+
+# --- End Session State Store ---
+
+# Configure CORS
+origins = [
+    "http://localhost",
+    "http://localhost:8080",
+    "http://localhost:8081", 
+    "https://bookgpt.vercel.app",  # Main Vercel deployment URL
+    "https://bookgpt-*.vercel.app",  # Preview deployments
+    "*",  # Allow all origins - will be restricted by the webhook secret
+    "null"  # Allow local file:// origin
+]
+
+
+@timed_stage("nlp")
+async def process_nlp(text: str, current_stage: str) -> dict:
+    """
+    Process user input using OpenAI's GPT-3.5-turbo for intent recognition and entity extraction.
+    Input: user message, current conversation stage.
+    Output: dict e.g., {'intent': 'REQUEST_RECOMMENDATION', 'entities': {'genre': 'sci-fi'}, 'refined_message': '...'}
+    """
+    log.debug("NLP: Processing text: '%s' in stage: %s", text, current_stage)
+    
+    client = get_openai_client()
+    if not client:
+        log.error("Error: OpenAI client not initialized.")
+        return {"intent": "UNKNOWN", "entities": {}, "refined_message": text}
+    
+    system_prompt = """You are an AI assistant. Analyze the user's message and extract the intent and entities.
+Respond with a JSON object containing:
+- "intent": The user's intent (e.g., REQUEST_RECOMMENDATION, GREETING).
+- "entities": A dictionary of extracted entities (e.g., {'genre': 'sci-fi'}).
+- "refined_message": The refined user message for further processing."""
+    
+    user_prompt = f"User message: '{text}'\nCurrent stage: '{current_stage}'"
+    
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    
+    try:
+        async with llm_admission.slot("nlp"):
+            response = await call_upstream(
+                openai_breaker,
+                lambda: client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=messages,
+                    temperature=0.5,
+                    max_tokens=150,
+                    n=1,
+                    stop=None
+                ),
+                OPENAI_TIMEOUT_SECONDS
+            )
+        record_openai_response("nlp", response)
+        content = response.choices[0].message.content
+        log_payload("NLP Response", content)
+        
+        nlp_result = json.loads(content)
+        return nlp_result
+    
+    except openai.APIError as e:
+        record_openai_response("nlp", error=e)
+        log.error("NLP Error: OpenAI API returned an API Error: %s", e)
+    except CircuitOpenError as e:
+        log.warning("NLP: Skipping OpenAI call - %s", e)
+    except asyncio.TimeoutError:
+        log.warning("NLP: OpenAI call ran out of time budget")
+    except AdmissionRejected:
+        raise  # Shed calls end the turn with a fast 429/503 rather than a degraded answer
+    except Exception as e:
+        log.error("NLP Error: An unexpected error occurred: %s", e)
+    
+    return {"intent": "UNKNOWN", "entities": {}, "refined_message": text}
+
+@timed_stage("nlp_fused")
+async def process_nlp_with_recommendations(text: str, current_stage: str, max_recommendations: int = 5) -> Optional[dict]:
+    """
+    Fused NLP + recommendation call: one JSON-mode completion returning the intent,
+    entities and refined message together with recommendation ideas.
+    Output: dict like process_nlp's plus a 'recommendations' list, or None on error.
+    """
+    client = get_openai_client()
+    if not client:
+        log.error("Error: OpenAI client not initialized.")
+        return None
+
+    system_prompt = f"""You are a book recommendation assistant. Analyze the user's message and respond ONLY with a valid JSON object containing:
+- "intent": The user's intent (e.g., REQUEST_RECOMMENDATION, GREETING).
+- "entities": A dictionary of extracted entities (e.g., {{'genre': 'sci-fi'}}).
+- "refined_message": The refined user message for further processing.
+- "recommendations": If the intent is REQUEST_RECOMMENDATION, an array of {max_recommendations} diverse books matching the message, otherwise an empty array. Each object must have "title" (exact book title), "author" and "reasoning" (1-2 sentences on WHY it fits the user's preferences)."""
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"User message: '{text}'\nCurrent stage: '{current_stage}'"}
+    ]
+
+    try:
+        async with llm_admission.slot("recommendations"):
+            response = await call_upstream(
+                openai_breaker,
+                lambda: client.chat.completions.create(
+                    model="gpt-3.5-turbo-1106",  # Model with JSON mode support
+                    response_format={"type": "json_object"},
+                    messages=messages,
+                    temperature=0.6,
+                    max_tokens=150 + 250 * max_recommendations,
+                    n=1,
+                    stop=None
+                ),
+                OPENAI_TIMEOUT_SECONDS
+            )
+        record_openai_response("nlp_fused", response)
+        content = response.choices[0].message.content
+        log_payload("Fused NLP Response", content)
+        result = json.loads(content)
+        if isinstance(result, dict):
+            return result
+        log.error("Fused NLP Error: Response was not a JSON object")
+    except openai.APIError as e:
+        record_openai_response("nlp_fused", error=e)
+        log.error("Fused NLP Error: OpenAI API returned an API Error: %s", e)
+    except CircuitOpenError as e:
+        log.warning("Fused NLP: Skipping OpenAI call - %s", e)
+    except asyncio.TimeoutError:
+        log.warning("Fused NLP: OpenAI call ran out of time budget")
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        log.error("Fused NLP Error: An unexpected error occurred: %s", e)
+
+    return None
+
+# --- Local Intent Classifier ---
+# Resolves obvious turns (greetings, suggestion buttons, follow-ups on shown
+# recommendations) without an LLM round trip. Anything ambiguous still goes to process_nlp.
+
+# Keyword lists behind the vagueness heuristics, by category
+REQUEST_KEYWORDS: Dict[str, List[str]] = {
+    "genre": [
+        "fiction", "mystery", "romance", "biography", "history", 
+        "children", "young adult", "ya", "fantasy", "sci-fi", 
+        "science fiction", "thriller", "horror", "literary", 
+        "contemporary", "classic", "crime", "non-fiction", 
+        "memoir", "poetry", "adventure", "dystopian", "historical"
+    ],
+    "author": [
+        "by author", "written by", "books by", "author", "writer", 
+        "novels by", "works by", "published by", "wrote"
+    ],
+    "book_reference": [
+        "like", "similar to", "resembles", "reminds me of", "same as", 
+        "in the style of", "comparable to", "books like", "series like",
+        "enjoyed", "loved", "read", "finished", "recommend"
+    ],
+    "mood": [
+        "happy", "sad", "uplifting", "dark", "funny", "humorous", 
+        "serious", "light", "deep", "thought-provoking", "inspiring", 
+        "relaxing", "exciting", "suspenseful", "scary", "romantic"
+    ],
+    "time": [
+        "modern", "contemporary", "classic", "ancient", "medieval", 
+        "19th century", "20th century", "victorian", "recent", 
+        "new", "old", "latest", "antique", "retro", "futuristic"
+    ]
+}
+
+# Suggestion buttons the bot offers, with the entities each one stands for
+SUGGESTION_BUTTON_ENTITIES: Dict[str, Dict[str, str]] = {
+    "suggest fantasy books": {"genre": "Fantasy"},
+    "recommend sci-fi": {"genre": "Science Fiction"},
+    "books like the hobbit": {"similar_to": "The Hobbit"},
+    "mystery novels": {"genre": "Mystery"},
+    "popular mystery novels": {"genre": "Mystery"},
+    "contemporary fiction": {"genre": "Contemporary Fiction"},
+    "bestsellers this year": {"category": "Bestsellers"},
+    "historical fiction": {"genre": "Historical Fiction"},
+    "books by female authors": {"author_attribute": "Female"},
+    "fantasy books": {"genre": "Fantasy"},
+    "fantasy recommendations": {"genre": "Fantasy"},
+    "try fantasy genre": {"genre": "Fantasy"},
+    "sci-fi books": {"genre": "Science Fiction"},
+    "suggest popular sci-fi": {"genre": "Science Fiction"},
+    "popular thrillers": {"genre": "Thriller"},
+    "recommend thriller books": {"genre": "Thriller"}
+}
+
+def _compile_keyword_matcher(keywords: Dict[str, List[str]]):
+    """
+    Compiles all keyword lists into one regex that finds every keyword occurrence,
+    including overlapping ones, in a single pass. Returns the pattern and a map from
+    each matched phrase to every category it implies.
+    """
+    phrase_categories: Dict[str, set] = {}
+    for category, phrases in keywords.items():
+        for phrase in phrases:
+            phrase_categories.setdefault(phrase, set()).add(category)
+    # At any position only the longest alternative is reported, so a phrase also
+    # implies the categories of every shorter phrase that is a prefix of it
+    for phrase, categories in phrase_categories.items():
+        for other, other_categories in phrase_categories.items():
+            if other != phrase and phrase.startswith(other):
+                categories |= other_categories
+    alternatives = "|".join(re.escape(phrase) for phrase in sorted(phrase_categories, key=len, reverse=True))
+    return re.compile(f"(?=({alternatives}))"), {phrase: frozenset(cats) for phrase, cats in phrase_categories.items()}
+
+_KEYWORD_PATTERN, _KEYWORD_PHRASE_CATEGORIES = _compile_keyword_matcher(REQUEST_KEYWORDS)
+
+def _match_keyword_categories(lower_message: str) -> set:
+    """Returns the keyword categories with at least one phrase occurring in the message."""
+    categories = set()
+    for match in _KEYWORD_PATTERN.finditer(lower_message):
+        categories |= _KEYWORD_PHRASE_CATEGORIES[match.group(1)]
+    return categories
+
+def _normalize_button_text(message: str) -> str:
+    return " ".join(message.lower().split()).rstrip(".!")
+
+_GREETING_PATTERN = re.compile(
+    r"^(hi|hello|hey|hiya|howdy|greetings|good (morning|afternoon|evening))( there)?( bookgpt)?[\s!.,]*$"
+)
+_MORE_DETAIL_PATTERN = re.compile(r"^(tell me )?more( details?| info)?( about| on)? #?(?P<index>\d+)[\s?!.]*$")
+_SHOW_DIFFERENT_PATTERN = re.compile(
+    r"^(show |give |suggest )?(me )?(some )?(different|other|new) (recommendations|books|ones|suggestions)[\s!.]*$"
+)
+_START_OVER_PATTERN = re.compile(r"^(start over|start again|restart|reset)[\s!.]*$")
+
+classifier_stats: Dict[str, int] = {"local": 0, "llm": 0}
+
+def classify_locally(text: str, current_stage: str) -> Optional[dict]:
+    """
+    High-confidence intent/entity recognition without a network call.
+    Output: dict shaped like process_nlp's result, or None if the message is ambiguous.
+    """
+    lower_message = text.lower().strip()
+
+    if not lower_message or _GREETING_PATTERN.match(lower_message):
+        return {"intent": "GREETING", "entities": {}, "refined_message": text}
+
+    button_entities = SUGGESTION_BUTTON_ENTITIES.get(_normalize_button_text(text))
+    if button_entities is not None:
+        return {"intent": "REQUEST_RECOMMENDATION", "entities": dict(button_entities), "refined_message": text}
+
+    # Follow-ups on shown recommendations are resolved by the state machine's own string checks
+    if current_stage == "SHOWING_RECOMMENDATIONS":
+        detail_match = _MORE_DETAIL_PATTERN.match(lower_message)
+        if detail_match:
+            return {"intent": "REQUEST_DETAILS", "entities": {"book_index": int(detail_match.group("index"))}, "refined_message": text}
+        if _SHOW_DIFFERENT_PATTERN.match(lower_message):
+            return {"intent": "REQUEST_DIFFERENT", "entities": {}, "refined_message": text}
+        if _START_OVER_PATTERN.match(lower_message):
+            return {"intent": "START_OVER", "entities": {}, "refined_message": text}
+
+    return None
+
+# --- End Local Intent Classifier ---
+
+# --- Speculative / Fused Recommendation Pipeline ---
+# For messages the local heuristics already consider detailed, the recommendation
+# LLM call doesn't have to wait for process_nlp. See NLP_PIPELINE_MODE.
+
+pipeline_stats: Dict[str, Any] = {
+    "speculative_started": 0,
+    "speculative_kept": 0,
+    "speculative_cancelled": 0,
+    "fused_calls": 0,
+    "fused_kept": 0,
+    "fused_discarded": 0,
+    "saved_seconds_total": 0.0
+}
+_nlp_latency_ewma: Optional[float] = None  # Moving average of serial process_nlp latency
+
+def _record_nlp_latency(duration: float):
+    global _nlp_latency_ewma
+    _nlp_latency_ewma = duration if _nlp_latency_ewma is None else 0.8 * _nlp_latency_ewma + 0.2 * duration
+
+class PendingRecommendations:
+    """
+    Recommendation ideas produced before the state machine asked for them, either by a
+    speculative get_chatgpt_recommendations task or by a fused NLP call. The state machine
+    calls `take()` if the turn needs recommendations; otherwise the turn ends with
+    `discard()`, which cancels a still-running speculative call. `variant` is the
+    recommendation variant the ideas were generated for.
+    """
+
+    def __init__(self, mode: str, task: Optional[asyncio.Task] = None,
+                 ideas: Optional[List[Dict[str, Any]]] = None, nlp_duration: float = 0.0, variant: int = 0):
+        self.mode = mode
+        self.task = task
+        self.ideas = ideas or []
+        self.nlp_duration = nlp_duration
+        self.variant = variant
+        self.settled = False
+
+    async def take(self) -> List[Dict[str, Any]]:
+        self.settled = True
+        if self.task is not None:
+            self.ideas, recommendation_duration = await self.task
+            # Serially these calls would have cost nlp + recommendation; overlapped, the shorter is hidden
+            saved = min(self.nlp_duration, recommendation_duration)
+        else:
+            saved = _nlp_latency_ewma or 0.0  # The fused call skipped a separate process_nlp round trip
+        pipeline_stats[f"{self.mode}_kept"] += 1
+        pipeline_stats["saved_seconds_total"] += saved
+        log.debug("Pipeline: Using %s recommendations, saved ~%.2fs", self.mode, saved)
+        return self.ideas
+
+    def discard(self):
+        if self.settled:
+            return
+        self.settled = True
+        if self.task is not None:
+            self.task.cancel()
+            pipeline_stats["speculative_cancelled"] += 1
+        else:
+            pipeline_stats["fused_discarded"] += 1
+        log.debug("Pipeline: Discarded unused %s recommendations", self.mode)
+
+async def _timed_recommendations(preferences, history, max_recommendations, variant=0, exclude_titles=None):
+    started = time.perf_counter()
+    ideas = await get_chatgpt_recommendations(preferences, history, max_recommendations, variant, exclude_titles)
+    return ideas, time.perf_counter() - started
+
+async def _analyze_message(
+    text: str,
+    current_stage: str,
+    history: List[Dict[str, str]],
+    max_recs: int = 5,
+    served_variants: Optional[Dict[str, int]] = None,
+    seen: Optional["SeenSet"] = None
+):
+    """
+    Runs NLP for a turn: the local classifier first, then the LLM according to NLP_PIPELINE_MODE.
+    A speculative call asks for the session's next variant of the raw message's results,
+    leaving out books in its `seen` set (`served_variants` is its recommendation_variants).
+    Returns the NLP result and PendingRecommendations (or None when nothing was started early).
+    """
+    local_result = classify_locally(text, current_stage)
+    if local_result is not None:
+        classifier_stats["local"] += 1
+        log.debug("NLP: Resolved locally as %s, skipping LLM", local_result['intent'])
+        return local_result, None
+    classifier_stats["llm"] += 1
+
+    speculate = (
+        NLP_PIPELINE_MODE in ("speculative", "fused")
+        and current_stage in ("INIT", "AWAITING_PREFERENCES")
+        and not _is_vague_request(text, {})
+    )
+
+    if speculate and NLP_PIPELINE_MODE == "fused":
+        fused_result = await process_nlp_with_recommendations(text, current_stage, max_recs)
+        if fused_result is not None:
+            pipeline_stats["fused_calls"] += 1
+            ideas = fused_result.pop("recommendations", None) or []
+            return fused_result, PendingRecommendations("fused", ideas=ideas[:max_recs])
+        # Fall through to a plain NLP call if the fused call failed
+
+    task = None
+    variant = 0
+    if speculate and NLP_PIPELINE_MODE == "speculative":
+        # NLP entities aren't known yet, so the speculative call works from the raw message
+        preferences = {"raw_query": text}
+        variant = (served_variants or {}).get(recommendation_preferences_key(preferences), 0)
+        exclude_titles = seen.recent_titles if seen is not None else None
+        task = asyncio.create_task(_timed_recommendations(preferences, list(history), max_recs, variant, exclude_titles))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())  # Seen by take() if used
+        pipeline_stats["speculative_started"] += 1
+
+    started = time.perf_counter()
+    try:
+        nlp_result = await process_nlp(text, current_stage)
+    except BaseException:
+        if task is not None:
+            task.cancel()
+        raise
+    nlp_duration = time.perf_counter() - started
+    _record_nlp_latency(nlp_duration)
+
+    if task is None:
+        return nlp_result, None
+    return nlp_result, PendingRecommendations("speculative", task=task, nlp_duration=nlp_duration, variant=variant)
+
+@router.get("/api/pipeline/stats")
+async def pipeline_statistics():
+    return {
+        "mode": NLP_PIPELINE_MODE,
+        "classifier": {
+            **classifier_stats,
+            "bypass_rate": round(classifier_stats["local"] / max(1, sum(classifier_stats.values())), 4)
+        },
+        "nlp_latency_avg_seconds": round(_nlp_latency_ewma, 4) if _nlp_latency_ewma is not None else None,
+        **pipeline_stats,
+        "saved_seconds_total": round(pipeline_stats["saved_seconds_total"], 3)
+    }
+
+# --- End Speculative / Fused Recommendation Pipeline ---
+
+@router.get("/")
+async def root():
+    return {"message": "Book Recommendation Bot API"}
+
+@router.get("/api/ready")
+async def readiness():
+    """Readiness probe: 503 until the background warm-up has run (and API keys are set)."""
+    start_warm_up()  # No-op once started; covers servers run without the lifespan
+    ready = is_ready()
+    return JSONResponse(
+        {"ready": ready, "checks": readiness_checks, "startup": startup_timings},
+        status_code=200 if ready else 503
+    )
+
+def _resolve_from_catalog(idea) -> Optional[Dict[str, Any]]:
+    # Books we've enriched before resolve from the local catalog without calling Google;
+    # while Google Books is failing, stale entries are better than nothing
+    return book_catalog.resolve(
+        idea.get('title', ''), idea.get('author'), allow_stale=google_books_breaker.state != "closed"
+    )
+
+async def _prefetch_idea_details(recommendation_ideas) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    Looks every idea up in the catalog, then resolves the rest with batched Google Books
+    queries. Returns index -> details (None where still unresolved) for every idea.
+    """
+    prefetched = {index: _resolve_from_catalog(idea) for index, idea in enumerate(recommendation_ideas)}
+    missing = [index for index, details in prefetched.items() if details is None]
+    if len(missing) > 1:
+        batch = await resolve_google_books_batch([recommendation_ideas[index] for index in missing])
+        for index, details in zip(missing, batch):
+            prefetched[index] = details
+    return prefetched
+
+async def _enrich_recommendation_idea(idea, amazon_tag, book_details=None, catalog_checked=False):
+    """
+    Resolves a single LLM recommendation idea to enriched Google Books details.
+    `book_details` may already have been prefetched; `catalog_checked` skips the catalog.
+    Returns the book details dict, or None if the idea could not be resolved.
+    """
+    log.debug("Processing recommendation idea: %s", idea)
+    if book_details is None and not catalog_checked:
+        book_details = _resolve_from_catalog(idea)
+    if book_details is None:
+        book_details = await resolve_google_book(idea.get('title', ''), idea.get('author'))
+        if not book_details:
+            return None
+    book_details["reasoning"] = idea.get("reasoning", "No specific reason provided.")
+    isbn = book_details.get('isbn13', '')
+    if isbn:
+        book_details["amazon_link"] = f"https://www.amazon.com/s?k={isbn}&tag={amazon_tag}"
+    else:
+        book_details["amazon_link"] = None
+    return book_details
+
+@timed_stage("enrichment")
+async def _enrich_recommendation_ideas(
+    recommendation_ideas,
+    amazon_tag,
+    concurrency: int = ENRICHMENT_CONCURRENCY,
+    deadline: float = ENRICHMENT_DEADLINE_SECONDS,
+    on_book=None
+):
+    """
+    Enriches all recommendation ideas concurrently, at most `concurrency` at a time.
+    `recommendation_ideas` may be a list or an async iterator of ideas; streamed ideas
+    start enriching as soon as they arrive. Ideas still unresolved `deadline` seconds
+    after the last idea arrived are cancelled and dropped.
+    `on_book(index, book)` is called as each book resolves, if given.
+    Returns the enriched book dicts in the LLM's original order.
+    """
+    if not recommendation_ideas:
+        return []
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    prefetch = None
+    if isinstance(recommendation_ideas, list) and GB_BATCH_RESOLVE:
+        # A task the ideas wait on, so the batch resolve counts against the deadline below
+        prefetch = asyncio.ensure_future(_prefetch_idea_details(recommendation_ideas))
+
+    async def enrich_with_limit(index, idea):
+        prefetched = {}
+        if prefetch is not None:
+            try:
+                prefetched = await asyncio.shield(prefetch)
+            except Exception:
+                pass  # Logged once below; each idea falls back to resolving on its own
+        async with semaphore:
+            book_details = await _enrich_recommendation_idea(
+                idea, amazon_tag, prefetched.get(index), catalog_checked=index in prefetched
+            )
+        if book_details and on_book is not None:
+            on_book(index, book_details)
+        return book_details
+
+    tasks = []
+    if isinstance(recommendation_ideas, list):
+        for idea in recommendation_ideas:
+            tasks.append(asyncio.create_task(enrich_with_limit(len(tasks), idea)))
+    else:
+        try:
+            async for idea in recommendation_ideas:
+                tasks.append(asyncio.create_task(enrich_with_limit(len(tasks), idea)))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    if not tasks:
+        return []
+
+    deadline = max(0.0, remaining_budget(deadline))  # Never outlive the request's own deadline
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    if pending:
+        log.warning("Enrichment deadline of %.2fs reached, dropping %s of %s ideas", deadline, len(pending), len(tasks))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if prefetch is not None:
+        if not prefetch.done():
+            prefetch.cancel()
+            await asyncio.gather(prefetch, return_exceptions=True)
+        elif not prefetch.cancelled() and prefetch.exception() is not None:
+            log.error("Enrichment Error: Batch resolve failed - %s", prefetch.exception())
+
+    book_results = []
+    for task in tasks:  # Preserve the LLM's ordering
+        if task not in done or task.cancelled():
+            continue
+        if task.exception() is not None:
+            log.error("Enrichment Error: An unexpected error occurred: %s", task.exception())
+            continue
+        book_details = task.result()
+        if book_details:
+            book_results.append(book_details)
+    return book_results
+
+async def _fetch_and_process_recommendations(
+    preferences, history, max_recs, amazon_tag, events=None, pending=None, variant=0, seen=None
+):
+    """
+    Helper to fetch recommendations from ChatGPT, then search Google Books and enrich results.
+    Ideas already produced by the speculative or fused pipeline are taken from `pending`.
+    `variant` selects which cached result set to serve for repeated preferences.
+    With an `events` queue, each book is emitted as it resolves (and the completion is streamed),
+    and the returned list is in that order, so each event's `index` is the book's final position.
+    Books in the session's `seen` set are left out, before enrichment where possible.
+    Returns a list of book result dicts.
+    """
+    streamed: List[Dict[str, Any]] = []  # Books emitted so far, in the order the client got them
+
+    def emit_book(_, book):
+        if seen is not None and seen.has_seen_book(book):
+            return
+        _emit_event(events, "book", {"index": len(streamed), "book": book})
+        streamed.append(book)
+
+    on_book = emit_book if events is not None else None
+    exclude_titles = seen.recent_titles if seen is not None else None
+
+    # First requests for a suggestion button's preferences come from the warm set
+    prewarmed_books = get_prewarmed_books(preferences, amazon_tag) if variant == 0 else None
+    if prewarmed_books and seen is not None:
+        prewarmed_books = [book for book in prewarmed_books if not seen.has_seen_book(book)]
+    if prewarmed_books:
+        log.debug("Prewarm: Serving warm result set for %s", preferences)
+        if on_book is not None:
+            for index, book in enumerate(prewarmed_books):
+                on_book(index, book)
+        return prewarmed_books
+
+    if pending is not None and pending.variant != variant:
+        pending.discard()  # Generated for a page of these results the session has already seen
+        pending = None
+    if pending is not None:
+        recommendation_ideas = await pending.take()
+    elif events is not None:
+        recommendation_ideas = stream_chatgpt_recommendations(
+            preferences=preferences,
+            history=history,
+            max_recommendations=max_recs,
+            variant=variant,
+            exclude_titles=exclude_titles
+        )
+    else:
+        recommendation_ideas = await get_chatgpt_recommendations(
+            preferences=preferences,
+            history=history,
+            max_recommendations=max_recs,
+            variant=variant,
+            exclude_titles=exclude_titles
+        )
+    recommendation_ideas = _unseen_ideas(recommendation_ideas, seen, max_recs)
+    book_results = await _enrich_recommendation_ideas(recommendation_ideas, amazon_tag, on_book=on_book)
+    if seen is not None:  # An idea under a new title can still resolve to a volume already shown
+        book_results = [book for book in book_results if not seen.has_seen_book(book)]
+    if on_book is not None:
+        book_results = streamed  # The same books, in the order their events went out
+    if not book_results and openai_breaker.state != "closed":
+        fallback_books = get_fallback_prewarmed_books(preferences, amazon_tag)
+        if fallback_books:
+            log.warning("Degraded: OpenAI unavailable, serving a related warm result set for %s", preferences)
+            resilience_stats["stale_served"] += 1
+            if on_book is not None:
+                for index, book in enumerate(fallback_books):
+                    on_book(index, book)
+                return streamed
+            return fallback_books
+    return book_results
+
+# --- Suggestion Button Pre-warming ---
+# The greeting and fallback buttons map to a handful of fixed entity sets that make
+# up a large share of traffic. A background task keeps an enriched result set for
+# each one warm; first clicks are served from it (stale-while-revalidate).
+
+prewarmed_results: Dict[str, Dict[str, Any]] = {}  # preferences key -> {"books", "amazon_tag", "refreshed_at", "entities"}
+prewarm_stats: Dict[str, int] = {"hits": 0, "stale_hits": 0, "refreshes": 0, "failed_refreshes": 0}
+_prewarm_background = set()
+
+def _prewarm_entity_sets() -> List[Dict[str, str]]:
+    unique = {}
+    for entities in SUGGESTION_BUTTON_ENTITIES.values():
+        unique.setdefault(recommendation_preferences_key(entities), entities)
+    return list(unique.values())
+
+def _jittered(seconds: float) -> float:
+    return seconds * random.uniform(1 - PREWARM_JITTER, 1 + PREWARM_JITTER)
+
+async def _refresh_prewarmed(entities: Dict[str, str], max_recs: int = 5):
+    amazon_tag = os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
+    deadline_token = start_request_deadline()  # Each refresh gets a full budget of its own
+    try:
+        ideas = await get_chatgpt_recommendations(preferences=entities, history=[], max_recommendations=max_recs)
+        books = await _enrich_recommendation_ideas(ideas, amazon_tag)
+    except AdmissionRejected as e:
+        prewarm_stats["failed_refreshes"] += 1
+        log.warning("Prewarm: Refresh for %s shed by admission control (%s)", entities, e.reason)
+        return
+    finally:
+        _request_deadline.reset(deadline_token)
+    if not books:
+        prewarm_stats["failed_refreshes"] += 1
+        log.warning("Prewarm: No books for %s, keeping previous result set", entities)
+        return
+    prewarmed_results[recommendation_preferences_key(entities)] = {
+        "books": books, "amazon_tag": amazon_tag, "refreshed_at": time.monotonic(), "entities": entities
+    }
+    prewarm_stats["refreshes"] += 1
+    log.info("Prewarm: Refreshed %s books for %s", len(books), entities)
+
+def _revalidate_prewarmed(entities: Dict[str, str]):
+    """Starts a background refresh, coalesced so concurrent stale hits trigger only one."""
+    key = recommendation_preferences_key(entities)
+    # Started in an empty context: the refresh is background work, not part of (or
+    # charged to, or limited by the deadline of) the turn whose stale hit triggered it
+    task = contextvars.Context().run(
+        asyncio.create_task, upstream_single_flight.do("prewarm", key, lambda: _refresh_prewarmed(entities))
+    )
+    _prewarm_background.add(task)
+    task.add_done_callback(_prewarm_background.discard)
+
+def get_prewarmed_books(preferences: Dict[str, Any], amazon_tag: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Returns a copy of the warm result set for these preferences, or None.
+    Entries past their refresh interval are still served while a refresh runs in the background.
+    """
+    entry = prewarmed_results.get(recommendation_preferences_key(preferences))
+    if entry is None or entry["amazon_tag"] != amazon_tag:
+        return None
+    age = time.monotonic() - entry["refreshed_at"]
+    if age > PREWARM_MAX_STALE_SECONDS:
+        return None
+    if age > PREWARM_REFRESH_SECONDS:
+        prewarm_stats["stale_hits"] += 1
+        _revalidate_prewarmed(preferences)
+    else:
+        prewarm_stats["hits"] += 1
+    return [dict(book) for book in entry["books"]]
+
+def get_fallback_prewarmed_books(preferences: Dict[str, Any], amazon_tag: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Degraded mode for when OpenAI is unavailable: the warm result set sharing the most
+    preference values (e.g. the same genre), however old, or None if none overlaps.
+    """
+    wanted = {str(value).lower() for value in preferences.values()}
+    best_entry, best_overlap = None, 0
+    for entry in prewarmed_results.values():
+        if entry["amazon_tag"] != amazon_tag:
+            continue
+        overlap = len(wanted & {str(value).lower() for value in entry["entities"].values()})
+        if overlap > best_overlap:
+            best_entry, best_overlap = entry, overlap
+    if best_entry is None:
+        return None
+    return [dict(book) for book in best_entry["books"]]
+
+async def _prewarm_loop():
+    # Stagger the first run so replicas starting together don't all hit upstream at once
+    await asyncio.sleep(random.uniform(0, 5))
+    while True:
+        for entities in _prewarm_entity_sets():
+            try:
+                await upstream_single_flight.do("prewarm", recommendation_preferences_key(entities),
+                                                lambda e=entities: _refresh_prewarmed(e))
+            except Exception as e:
+                prewarm_stats["failed_refreshes"] += 1
+                log.error("Prewarm Error: Refresh failed for %s - %s", entities, e)
+        await asyncio.sleep(_jittered(PREWARM_REFRESH_SECONDS))
+
+def start_prewarming() -> Optional[asyncio.Task]:
+    if not PREWARM_ENABLED:
+        return None
+    log.info("Prewarm: Warming %s suggestion result sets every ~%.0fs", len(_prewarm_entity_sets()), PREWARM_REFRESH_SECONDS)
+    return asyncio.create_task(_prewarm_loop())
+
+# --- End Suggestion Button Pre-warming ---
+
+# --- Next Page Prefetch ---
+# After a result set is shown, the next action is usually "Show different
+# recommendations". A background task fetches and enriches the next variant for the
+# session's preferences (minus books it has seen) right away, so that follow-up is
+# answered from it. Pages are held per process (a session served by another replica
+# just doesn't get one), replaced by the next shown page and cancelled on start over.
+# Off by default (PREFETCH_ENABLED): pages nobody asks for still cost a full LLM call.
+
+_page_prefetches: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # session ID -> {"task", "key", "started_at"}
+prefetch_stats: Dict[str, int] = {"started": 0, "sampled_out": 0, "served": 0, "cancelled": 0, "expired": 0, "unusable": 0}
+
+def _session_preferences(details: Dict[str, Any]) -> Dict[str, Any]:
+    """The preferences the session's last recommendations were fetched for."""
+    return details.get("nlp_entities") or {"raw_query": details.get("preferences_text", "")}
+
+async def _prefetch_page(preferences, history, variant, seen, amazon_tag):
+    deadline_token = start_request_deadline()  # Own budget, not what is left of the turn that started it
+    user_token = start_llm_user(None)  # Queued behind interactive calls and not charged to the user
+    try:
+        return await _fetch_and_process_recommendations(preferences, history, 5, amazon_tag, variant=variant, seen=seen)
+    finally:
+        _llm_user.reset(user_token)
+        _request_deadline.reset(deadline_token)
+
+def cancel_page_prefetch(session_id: str):
+    entry = _page_prefetches.pop(session_id, None)
+    if entry is not None and not entry["task"].done():
+        entry["task"].cancel()
+        prefetch_stats["cancelled"] += 1
+
+def start_page_prefetch(session_id: str, user_state: Dict[str, Any]):
+    """Starts fetching the page "Show different recommendations" would show next, replacing any earlier one."""
+    cancel_page_prefetch(session_id)
+    if not PREFETCH_ENABLED:
+        return
+    if random.random() >= PREFETCH_SAMPLE_RATE:
+        prefetch_stats["sampled_out"] += 1
+        return
+    details = user_state["details"]
+    preferences = _session_preferences(details)
+    key = recommendation_preferences_key(preferences)
+    variant = details.get("recommendation_variants", {}).get(key, 0)  # Next variant; counted once served
+    seen = SeenSet.from_state(details.get("seen"))  # Includes the page now showing
+    task = asyncio.create_task(_prefetch_page(
+        preferences, list(user_state["history"]), variant, seen, os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
+    ))
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())  # Failures surface as unusable pages
+    _page_prefetches[session_id] = {"task": task, "key": key, "started_at": time.monotonic()}
+    prefetch_stats["started"] += 1
+    while len(_page_prefetches) > PREFETCH_MAX_SESSIONS:
+        cancel_page_prefetch(next(iter(_page_prefetches)))
+
+async def take_page_prefetch(session_id: str, preferences: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Returns the session's prefetched page for these preferences, waiting (within the
+    request budget) if it is still being fetched. None if there is no usable page.
+    """
+    entry = _page_prefetches.pop(session_id, None)
+    if entry is None:
+        return None
+    task = entry["task"]
+    if entry["key"] != recommendation_preferences_key(preferences) or \
+            time.monotonic() - entry["started_at"] > PREFETCH_TTL_SECONDS:
+        task.cancel()
+        prefetch_stats["expired"] += 1
+        return None
+    try:
+        books = await asyncio.wait_for(task, max(0.0, remaining_budget(REQUEST_DEADLINE_SECONDS)))
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise  # This request itself was cancelled
+        books = None
+    except Exception as e:  # Includes running out of budget, which cancels the task
+        log.warning("Prefetch: Next page for session %s unavailable - %s", session_id, e)
+        books = None
+    if not books:
+        prefetch_stats["unusable"] += 1
+        return None
+    prefetch_stats["served"] += 1
+    return books
+
+async def cancel_all_page_prefetches():
+    tasks = [entry["task"] for entry in _page_prefetches.values()]
+    _page_prefetches.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# --- End Next Page Prefetch ---
+
+# --- Chat Event Streaming ---
+# Server-sent events for /api/chat/stream. A turn pushes (event, data) pairs onto an
+# asyncio.Queue: "message" with the bot's interim reply, "book" for each enriched
+# book as it resolves, then "done" with the final ChatResponse fields (or "error").
+# Books in both are shaped like /api/chat's: `fields` projection and `known_books` delta.
+
+def _emit_event(events: Optional[asyncio.Queue], event: str, data: Dict[str, Any]):
+    if events is not None:
+        events.put_nowait((event, data))
 
-# Initialize Google Books API key
-google_books_api_key = os.getenv("GOOGLE_BOOKS_API_KEY")
-if not google_books_api_key:
-    raise ValueError("Missing Google Books API Key")
+def _format_sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {fast_json_dumps(data).decode('utf-8')}\n\n"
 
-# Initialize Redis client
-redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_client = redis.from_url(redis_url)
+# Keeps streamed turns alive if the client disconnects, so their state is still saved
+_background_turns = set()
 
-class ChatRequest(BaseModel):
-    user_id: str
-    message: str
+@router.post("/api/chat/stream")
+async def handle_chat_stream(request: ChatRequest, http_request: Request, fields: Optional[str] = None):
+    log.info("Received (stream): user_id=%s, message='%s'", request.user_id, request.message)
+    book_fields = parse_book_fields(fields)
+    known_books = set(request.known_books)
+    thumbnail_base = thumbnail_base_url(http_request)
 
-class ChatResponse(BaseModel):
-    user_id: str
-    bot_message: str
-    suggestions: List[str] = []
-    books: List[dict] = []  # Placeholder for book data
+    events: asyncio.Queue = asyncio.Queue()
 
-app = FastAPI()
+    async def run_turn():
+        try:
+            response, stage = await _complete_chat_turn(request, events)
+            _emit_event(events, "done", {**response.model_dump(), "stage": stage})
+        except AdmissionRejected as e:
+            _emit_event(events, "error", {"detail": e.detail, "status": e.status_code, "retry_after": e.retry_after})
+        except SessionBusyError:
+            _emit_event(events, "error", {"detail": SESSION_BUSY_DETAIL, "status": 409, "retry_after": 1})
+        except Exception as e:
+            log.error("Stream Error: An unexpected error occurred: %s", e)
+            _emit_event(events, "error", {"detail": "Failed to process chat message"})
 
-# In-memory session state management
-session_states: Dict[str, Dict[str, Any]] = {}
+    turn = asyncio.create_task(run_turn())
+    _background_turns.add(turn)
+    turn.add_done_callback(_background_turns.discard)
 
-# Configure CORS
-origins = [
-    "http://localhost",
-    "http://localhost:8080",
-    "http://localhost:8081", 
-    "https://bookgpt.vercel.app",  # Main Vercel deployment URL
-    "https://bookgpt-*.vercel.app",  # Preview deployments
-    "*",  # Allow all origins - will be restricted by the webhook secret
-    "null"  # Allow local file:// origin
-]
+    async def event_stream():
+        while True:
+            event, data = await events.get()
+            if event == "book":
+                data = {**data, "book": shape_book(data["book"], book_fields, known_books, thumbnail_base)}
+            elif event == "done":
+                data = {**data, "books": shape_books(data["books"], book_fields, known_books, thumbnail_base)}
+            yield _format_sse(event, data)
+            if event in ("done", "error"):
+                break
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-async def process_nlp(text: str, current_stage: str) -> dict:
+# --- End Chat Event Streaming ---
+
+def _is_vague_request(message: str, entities: Dict[str, Any]) -> bool:
     """
-    Process user input using OpenAI's GPT-3.5-turbo for intent recognition and entity extraction.
-    Input: user message, current conversation stage.
-    Output: dict e.g., {'intent': 'REQUEST_RECOMMENDATION', 'entities': {'genre': 'sci-fi'}, 'refined_message': '...'}
+    Local heuristics deciding whether a recommendation request has enough context
+    to act on. Pass empty entities to judge the raw message before NLP has run.
     """
-    print(f"NLP: Processing text: '{text}' in stage: {current_stage}")
-    
-    if not client:
-        print("Error: OpenAI client not initialized.")
-        return {"intent": "UNKNOWN", "entities": {}, "refined_message": text}
-    
-    system_prompt = """You are an AI assistant. Analyze the user's message and extract the intent and entities.
-Respond with a JSON object containing:
-- "intent": The user's intent (e.g., REQUEST_RECOMMENDATION, GREETING).
-- "entities": A dictionary of extracted entities (e.g., {'genre': 'sci-fi'}).
-- "refined_message": The refined user message for further processing."""
-    
-    user_prompt = f"User message: '{text}'\nCurrent stage: '{current_stage}'"
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-    
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.5,
-            max_tokens=150,
-            n=1,
-            stop=None
-        )
-        content = response.choices[0].message.content
-        print(f"NLP Response: {content}")
-        
-        nlp_result = json.loads(content)
-        return nlp_result
-    
-    except openai.APIError as e:
-        print(f"NLP Error: OpenAI API returned an API Error: {e}")
-    except Exception as e:
-        print(f"NLP Error: An unexpected error occurred: {e}")
-    
-    return {"intent": "UNKNOWN", "entities": {}, "refined_message": text}
+    is_vague = True  # Default assumption
 
-@app.get("/")
-async def root():
-    return {"message": "Book Recommendation Bot API"}
+    # Check message length - longer messages tend to have more context
+    message_len = len(message.split())
+    categories = _match_keyword_categories(message.lower())
+
+    # 1. Check for specific entities from NLP
+    has_entities = bool(entities.get("genre") or entities.get("author") or entities.get("similar_book"))
+    # 2-6. Genre keywords, author references, book references, mood/tone and time period
+    has_genre = "genre" in categories
+    has_author = "author" in categories
+    has_book_reference = "book_reference" in categories and message_len > 3
+    has_mood = "mood" in categories
+    has_time_reference = "time" in categories
+    # 7. Check if message is longer than threshold
+    is_detailed_request = message_len > 6
+
+    # Determine if request has sufficient context based on multiple factors
+    if has_entities or has_genre or has_author or has_book_reference or has_mood or has_time_reference or is_detailed_request:
+        is_vague = False
+
+    # Log the vagueness check results
+    log.debug(
+        "Vagueness check: is_vague=%s, has_entities=%s, has_genre=%s, has_author=%s, has_book_reference=%s, "
+        "has_mood=%s, has_time_reference=%s, is_detailed_request=%s",
+        is_vague, has_entities, has_genre, has_author, has_book_reference, has_mood, has_time_reference, is_detailed_request
+    )
+
+    return is_vague
 
-async def _fetch_and_process_recommendations(preferences, history, max_recs, amazon_tag):
+@router.post("/api/chat", response_model=ChatResponse)
+async def handle_chat(request: ChatRequest, http_request: Request, fields: Optional[str] = None):
+    log.info("Received: user_id=%s, message='%s'", request.user_id, request.message)  # Basic logging
+    try:
+        response, _ = await _complete_chat_turn(request)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except SessionBusyError:
+        raise HTTPException(status_code=409, detail=SESSION_BUSY_DETAIL, headers={"Retry-After": "1"})
+    response.books = shape_books(
+        response.books, parse_book_fields(fields), set(request.known_books), thumbnail_base_url(http_request)
+    )
+    return response
+
+async def _complete_chat_turn(request: ChatRequest, events: Optional[asyncio.Queue] = None):
     """
-    Helper to fetch recommendations from ChatGPT, then search Google Books and enrich results.
-    Returns a list of book result dicts.
+    Loads the session, runs one chat turn and saves the session, all under the session lock.
+    Returns the ChatResponse and the new conversation stage.
     """
-    recommendation_ideas = await get_chatgpt_recommendations(
-        preferences=preferences,
-        history=history,
-        max_recommendations=max_recs
+    session_id = request.user_id
+    started = time.perf_counter()
+    deadline_token = start_request_deadline()  # Budget shared by every upstream call this turn makes
+    user_token = start_llm_user(session_id)  # LLM calls this turn makes are charged to this user
+    try:
+        async with session_store.lock(session_id):
+            # Retrieve/Initialize State
+            user_state = await session_store.load(session_id) or _new_session_state()
+            user_state, bot_message, response_suggestions, branch = await _run_chat_turn(request, user_state, events)
+            showing_new_page = user_state["stage"] == "SHOWING_RECOMMENDATIONS" and branch != "book_details"
+            if showing_new_page:
+                remember_shown_books(user_state)
+            # Prepare final response
+            final_books_data = user_state["details"].get("last_recommendations", []) if user_state["stage"] == "SHOWING_RECOMMENDATIONS" else []
+            # Append bot response to history
+            user_state["history"].append({"role": "assistant", "content": bot_message})
+            # Save updated state
+            await session_store.save(session_id, user_state)
+            if showing_new_page:
+                start_page_prefetch(session_id, user_state)  # A new page is showing: get the one after it
+            elif user_state["stage"] != "SHOWING_RECOMMENDATIONS":
+                cancel_page_prefetch(session_id)
+    finally:
+        _llm_user.reset(user_token)
+        _request_deadline.reset(deadline_token)
+    CHAT_BRANCH_LATENCY.observe(time.perf_counter() - started, branch)
+    log_payload("Saved new state", user_state, user_id=session_id)
+    response = ChatResponse(
+        user_id=session_id,
+        bot_message=bot_message,
+        suggestions=response_suggestions,
+        books=final_books_data  # Send book data only when showing recommendations
     )
+    return response, user_state["stage"]
 
-    book_results = []
-    if recommendation_ideas:
-        for idea in recommendation_ideas:
-            print(f"Processing recommendation idea: {idea}")
-            search_query = f"{idea.get('title', '')} {idea.get('author', '')}"
-            search_results = await search_google_books(query=search_query.strip(), max_results=1)
-            if search_results:
-                book_id = search_results[0].get("id")
-                if book_id:
-                    book_details = await get_book_details_by_id(book_id)
-                    if book_details:
-                        book_details["reasoning"] = idea.get("reasoning", "No specific reason provided.")
-                        isbn = book_details.get('isbn13', '')
-                        if isbn:
-                            book_details["amazon_link"] = f"https://www.amazon.com/s?k={isbn}&tag={amazon_tag}"
-                        else:
-                            book_details["amazon_link"] = None
-                        book_results.append(book_details)
-    return book_results
-
-@app.post("/api/chat", response_model=ChatResponse)
-async def handle_chat(request: ChatRequest):
-    print(f"Received: user_id={request.user_id}, message='{request.message}'")  # Basic logging
-    
-    # Retrieve/Initialize State
+async def _run_chat_turn(request: ChatRequest, user_state: Dict[str, Any], events: Optional[asyncio.Queue] = None):
+    """
+    Runs one turn of the conversation state machine against the loaded session state.
+    Progress is pushed onto `events` when the turn is being streamed.
+    Returns the (possibly replaced) user state, the bot message, the suggestions and
+    the name of the state machine branch taken.
+    """
     session_id = request.user_id
-    user_state = session_states.get(session_id, {"history": [], "stage": "INIT", "details": {}})
     current_stage = user_state.get("stage", "INIT")
-    print(f"User {session_id} - Current Stage: {current_stage}, State: {user_state}")
+    log.debug("User %s - Current Stage: %s", session_id, current_stage)
     
     # Append user message for context
     user_state["history"].append({"role": "user", "content": request.message})
     # Keep history concise for MVP if needed
     user_state["history"] = user_state["history"][-10:]  # Keep last 10 turns max for example
     
-    # Process user message with NLP placeholder
-    nlp_result = await process_nlp(request.message, current_stage)
+    # Process user message with NLP, possibly starting recommendations alongside it
+    seen = SeenSet.from_state(user_state["details"].get("seen"))
+    nlp_result, pending_recommendations = await _analyze_message(
+        request.message, current_stage, user_state["history"],
+        served_variants=user_state["details"].get("recommendation_variants"), seen=seen
+    )
     intent = nlp_result.get("intent", "UNKNOWN")
     entities = nlp_result.get("entities", {})
     refined_message = nlp_result.get("refined_message")
 
-    print(f"NLP Result - Intent: {intent}, Entities: {entities}")
+    log.debug("NLP Result - Intent: %s, Entities: %s", intent, entities)
 
     # Initialize variables for response
     bot_message = ""
     response_suggestions = []
+    branch = "unknown"  # State machine branch taken, for latency metrics
     
     # Core Conversation Logic - State Machine
     if intent == "GREETING" and current_stage == "INIT":
+        branch = "greeting"
         # Handle simple initial greeting
         bot_message = "Hi! I'm here to help you discover your next great read. How can I help? You can tell me about genres you like, authors, or a book you recently enjoyed."
         response_suggestions = [
@@ -194,76 +2554,17 @@ async def handle_chat(request: ChatRequest):
 
     elif intent == "REQUEST_RECOMMENDATION" and (current_stage == "INIT" or current_stage == "AWAITING_PREFERENCES"):
         # --- ENHANCED VAGUENESS CHECK ---
-        is_vague = True  # Default assumption
-        
-        # Check message length - longer messages tend to have more context
-        message_words = request.message.split()
-        message_len = len(message_words)
-        lower_message = request.message.lower()
-        
-        # 1. Check for specific entities from NLP
-        has_entities = bool(entities.get("genre") or entities.get("author") or entities.get("similar_book"))
-        
-        # 2. Check for genre keywords - expanded list
-        genre_keywords = [
-            "fiction", "mystery", "romance", "biography", "history", 
-            "children", "young adult", "ya", "fantasy", "sci-fi", 
-            "science fiction", "thriller", "horror", "literary", 
-            "contemporary", "classic", "crime", "non-fiction", 
-            "memoir", "poetry", "adventure", "dystopian", "historical"
-        ]
-        has_genre = any(word in lower_message for word in genre_keywords)
-        
-        # 3. Check for author references
-        author_phrases = [
-            "by author", "written by", "books by", "author", "writer", 
-            "novels by", "works by", "published by", "wrote"
-        ]
-        has_author = any(phrase in lower_message for phrase in author_phrases)
-        
-        # 4. Check for specific book references or "similar to" phrases
-        book_reference_phrases = [
-            "like", "similar to", "resembles", "reminds me of", "same as", 
-            "in the style of", "comparable to", "books like", "series like",
-            "enjoyed", "loved", "read", "finished", "recommend"
-        ]
-        has_book_reference = any(phrase in lower_message for phrase in book_reference_phrases) and message_len > 3
-        
-        # 5. Check for mood/tone preferences
-        mood_phrases = [
-            "happy", "sad", "uplifting", "dark", "funny", "humorous", 
-            "serious", "light", "deep", "thought-provoking", "inspiring", 
-            "relaxing", "exciting", "suspenseful", "scary", "romantic"
-        ]
-        has_mood = any(phrase in lower_message for phrase in mood_phrases)
-        
-        # 6. Check for time period references
-        time_phrases = [
-            "modern", "contemporary", "classic", "ancient", "medieval", 
-            "19th century", "20th century", "victorian", "recent", 
-            "new", "old", "latest", "antique", "retro", "futuristic"
-        ]
-        has_time_reference = any(phrase in lower_message for phrase in time_phrases)
-        
-        # 7. Check if message is longer than threshold
-        is_detailed_request = message_len > 6
-        
-        # Determine if request has sufficient context based on multiple factors
-        if has_entities or has_genre or has_author or has_book_reference or has_mood or has_time_reference or is_detailed_request:
-            is_vague = False
-            
-        # Log the vagueness check results
-        print(f"Vagueness check: is_vague={is_vague}, has_entities={has_entities}, has_genre={has_genre}, " 
-              f"has_author={has_author}, has_book_reference={has_book_reference}, has_mood={has_mood}, "
-              f"has_time_reference={has_time_reference}, is_detailed_request={is_detailed_request}")
-        
+        # Suggestion buttons are ours and always specific enough, even with few keywords
+        is_button = _normalize_button_text(request.message) in SUGGESTION_BUTTON_ENTITIES
+        is_vague = not is_button and _is_vague_request(request.message, entities)
+
         if is_vague:
+            branch = "clarify"
             # Request is too vague, ask for clarification with enhanced options
             bot_message = "I'd love to help you find your next great read! To provide the most relevant recommendations, could you tell me a bit more about what you're looking for?"
             
             # Create dynamic rotating suggestion options based on current timestamp
             # This ensures different options appear each time
-            import time
             seed = int(time.time()) % 4  # Use time as a simple rotation mechanism (0-3)
             
             # Define suggestion sets
@@ -307,16 +2608,23 @@ async def handle_chat(request: ChatRequest):
             # Store the vague request in history
             user_state["details"]["last_vague_request"] = request.message
         else:
+            branch = "recommend"
             bot_message = f"Okay, searching for recommendations based on: '{request.message}'..."
+            _emit_event(events, "message", {"bot_message": bot_message})
             user_state["details"]["preferences_text"] = request.message
             user_state["details"]["nlp_entities"] = entities
 
             # --- Use helper function for recommendations ---
+            preferences = entities or {"raw_query": request.message}
             book_results = await _fetch_and_process_recommendations(
-                entities or {"raw_query": request.message},
+                preferences,
                 user_state["history"],
                 5,
-                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
+                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20'),
+                events,
+                pending_recommendations,
+                _next_recommendation_variant(user_state, preferences),
+                seen
             )
 
             if book_results:
@@ -334,6 +2642,7 @@ async def handle_chat(request: ChatRequest):
         lower_message = request.message.lower()
 
         if "more" in lower_message or "detail" in lower_message or "#1" in lower_message:
+            branch = "book_details"
             # Attempt to retrieve stored recommendations
             last_recs = user_state["details"].get("last_recommendations", [])
             if last_recs:
@@ -348,11 +2657,25 @@ async def handle_chat(request: ChatRequest):
             # Keep stage SHOWING_RECOMMENDATIONS
 
         elif "different" in lower_message or "other" in lower_message or "new" in lower_message:
-            bot_message = "Okay, what else are you looking for? Please tell me about genres, authors, or books you enjoy."
-            response_suggestions = ["Fantasy recommendations", "Sci-Fi books", "Popular Thrillers"]
-            user_state["stage"] = "AWAITING_PREFERENCES"
+            branch = "show_different"
+            preferences = _session_preferences(user_state["details"])
+            prefetched_books = await take_page_prefetch(request.user_id, preferences)
+            if prefetched_books:
+                _next_recommendation_variant(user_state, preferences)  # Count the page we're serving
+                for index, book in enumerate(prefetched_books):
+                    _emit_event(events, "book", {"index": index, "book": book})
+                bot_message = "Here are some different recommendations:"
+                user_state["details"]["last_recommendations"] = prefetched_books
+                response_suggestions = ["Tell me more about #1", "Show different recommendations", "Start Over"]
+                # Keep stage SHOWING_RECOMMENDATIONS
+            else:
+                bot_message = "Okay, what else are you looking for? Please tell me about genres, authors, or books you enjoy."
+                response_suggestions = ["Fantasy recommendations", "Sci-Fi books", "Popular Thrillers"]
+                user_state["stage"] = "AWAITING_PREFERENCES"
 
         elif "start" in lower_message or "reset" in lower_message or "over" in lower_message:
+            branch = "start_over"
+            cancel_page_prefetch(request.user_id)
             user_state = {"history": [{"role": "user", "content": request.message}], "stage": "INIT", "details": {}} # Keep user message for context maybe?
             bot_message = "Let's start over! How can I help you find your next great read?"
             response_suggestions = [
@@ -369,235 +2692,1262 @@ async def handle_chat(request: ChatRequest):
 
         else:
             # If input after showing recommendations doesn't match follow-ups, assume it's a new request
+            branch = "new_request"
             bot_message = f"Okay, let me see if I can find recommendations based on: '{request.message}'..."
+            _emit_event(events, "message", {"bot_message": bot_message})
             user_state["details"]["preferences_text"] = request.message
             user_state["details"]["nlp_entities"] = entities
 
             # --- Use helper function for recommendations ---
+            preferences = entities or {"raw_query": request.message}
+            book_results = await _fetch_and_process_recommendations(
+                preferences,
+                user_state["history"],
+                5,
+                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20'),
+                events,
+                pending_recommendations,
+                _next_recommendation_variant(user_state, preferences),
+                seen
+            )
+
+            if book_results:
+                bot_message = "Based on your new request, here are some recommendations:"
+                user_state["details"]["last_recommendations"] = book_results
+                response_suggestions = ["Tell me more about #1", "Show different recommendations", "Start Over"]
+                user_state["stage"] = "SHOWING_RECOMMENDATIONS"
+            else:
+                bot_message = "Sorry, I couldn't find specific details for that new request..."
+                response_suggestions = ["Try Fantasy genre", "Suggest popular Sci-Fi"]
+                user_state["stage"] = "AWAITING_PREFERENCES" # Go back
+
+    else:
+        # IMPROVED FALLBACK LOGIC:
+        # Check if the message matches any of our common suggestion buttons
+        # This acts as a safety net in case our NLP process failed to catch the intent
+        button_entities = SUGGESTION_BUTTON_ENTITIES.get(_normalize_button_text(request.message))
+        if button_entities is not None:
+            # This is a button click that our NLP missed - treat it as a recommendation request
+            branch = "button_fallback"
+            log.info("Fallback logic: Recognized '%s' as a suggestion button click", request.message)
+            bot_message = f"Looking for {request.message}, one moment..."
+            _emit_event(events, "message", {"bot_message": bot_message})
+            # Extract appropriate entities based on the message
+            entities.update(button_entities)
+            # Process as a recommendation request with the extracted entity
+            user_state["details"]["preferences_text"] = request.message
+            user_state["details"]["nlp_entities"] = entities
+            # Use helper function for recommendations
+            preferences = entities or {"raw_query": request.message}
             book_results = await _fetch_and_process_recommendations(
-                entities or {"raw_query": request.message},
+                preferences,
                 user_state["history"],
                 5,
-                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
+                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20'),
+                events,
+                pending_recommendations,
+                _next_recommendation_variant(user_state, preferences),
+                seen
+            )
+            if book_results:
+                bot_message = f"Here are some {request.message} that you might enjoy:"
+                user_state["details"]["last_recommendations"] = book_results
+                response_suggestions = ["Tell me more about #1", "Show different recommendations", "Start Over"]
+                user_state["stage"] = "SHOWING_RECOMMENDATIONS"
+            else:
+                bot_message = f"I'm sorry, I couldn't find specific {request.message} at the moment. Could you try another category?"
+                response_suggestions = ["Fantasy Books", "Mystery Novels", "Books by Female Authors"]
+                user_state["stage"] = "AWAITING_PREFERENCES"
+        else:
+            # Default / Real Fallback for any unhandled stage/intent combination
+            branch = "fallback"
+            bot_message = "Sorry, I wasn't sure how to proceed from there. Could you clarify? You can ask for recommendations by genre, author, or similar books."
+            # Provide more diverse options to maintain a better chat flow
+            response_suggestions = [
+                "Suggest Fantasy Books", 
+                "Recommend Sci-Fi", 
+                "Books like The Hobbit",
+                "Popular mystery novels"
+            ]
+            user_state["stage"] = "AWAITING_PREFERENCES" # Default back to expecting preferences
+    if pending_recommendations is not None:
+        pending_recommendations.discard()  # No-op if the turn used them
+    return user_state, bot_message, response_suggestions, branch
+
+# --- Google Books Response Cache ---
+# Read-through cache with a bounded in-process LRU tier in front of a shared Redis tier.
+
+_CACHE_MISS = object()
+
+class TwoTierCache:
+    """
+    Bounded in-process LRU cache backed by an optional shared Redis tier.
+    Values must be JSON serializable. A cached None is a valid (negative) entry;
+    `get` returns `_CACHE_MISS` when nothing is cached.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: int, negative_ttl: int, redis_factory=None):
+        self.name = name
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._redis_factory = redis_factory  # Returns the Redis client; None disables the shared tier
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._redis_retry_at = 0.0
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f"bookgpt:cache:{self.name}:{key}"
+
+    @property
+    def redis(self):
+        return self._redis_factory()
+
+    def _redis_available(self) -> bool:
+        return self._redis_factory is not None and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, e: Exception):
+        # Back off so an unreachable Redis doesn't add a timeout to every lookup
+        log.warning("Cache (%s): Redis unavailable, using local tier only for %ss - %s", self.name, CACHE_REDIS_RETRY_SECONDS, e)
+        self._redis_retry_at = time.monotonic() + CACHE_REDIS_RETRY_SECONDS
+
+    def _set_local(self, key: str, value: Any, ttl: int):
+        self._local[key] = (time.monotonic() + ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str) -> Any:
+        entry = self._local.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._local.move_to_end(key)
+                self.local_hits += 1
+                return value
+            del self._local[key]
+
+        if self._redis_available():
+            try:
+                raw = await self.redis.get(self._redis_key(key))
+            except Exception as e:
+                self._redis_failed(e)
+                raw = None
+            if raw is not None:
+                try:
+                    value = json.loads(raw)
+                except (json.JSONDecodeError, TypeError):
+                    value = _CACHE_MISS
+                if value is not _CACHE_MISS:
+                    self.redis_hits += 1
+                    self._set_local(key, value, self.negative_ttl if value is None else self.ttl)
+                    return value
+
+        self.misses += 1
+        return _CACHE_MISS
+
+    async def set(self, key: str, value: Any):
+        ttl = self.negative_ttl if value is None else self.ttl
+        self._set_local(key, value, ttl)
+        if self._redis_available():
+            try:
+                await self.redis.set(self._redis_key(key), json.dumps(value, separators=(",", ":")), ex=ttl)
+            except Exception as e:
+                self._redis_failed(e)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "entries": len(self._local),
+            "max_entries": self.max_entries,
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.local_hits + self.redis_hits) / lookups, 4) if lookups else 0.0
+        }
+
+_cache_redis_backend = get_redis_client if CACHE_REDIS_ENABLED else None
+google_books_search_cache = TwoTierCache(
+    "gb_search", GB_SEARCH_CACHE_MAX_ENTRIES, GB_SEARCH_CACHE_TTL, GB_NEGATIVE_CACHE_TTL, _cache_redis_backend
+)
+google_books_volume_cache = TwoTierCache(
+    "gb_volume", GB_VOLUME_CACHE_MAX_ENTRIES, GB_VOLUME_CACHE_TTL, GB_NEGATIVE_CACHE_TTL, _cache_redis_backend
+)
+
+def _normalize_search_query(query: str) -> str:
+    """Casefolds and collapses whitespace so equivalent queries share a cache entry."""
+    return " ".join(query.casefold().split())
+
+@router.get("/api/cache/stats")
+async def cache_stats():
+    return {
+        "google_books_search": google_books_search_cache.stats(),
+        "google_books_volume": google_books_volume_cache.stats(),
+        "recommendations": {**recommendation_cache.stats(), **recommendation_cache_stats},
+        "coalescing": upstream_single_flight.stats,
+        "catalog": book_catalog.stats(),
+        "thumbnails": thumbnail_cache.stats(),
+        "prewarm": {**prewarm_stats, "entries": len(prewarmed_results)},
+        "prefetch": {**prefetch_stats, "sessions": len(_page_prefetches)},
+        "sessions": session_store.stats(),
+        "admission": llm_admission.stats(),
+        "resilience": {
+            **resilience_stats,
+            "openai_breaker": openai_breaker.stats(),
+            "google_books_breaker": google_books_breaker.stats(),
+            "hedge_delay_seconds": {
+                "search": round(google_books_search_latency.hedge_delay(), 3),
+                "volume": round(google_books_volume_latency.hedge_delay(), 3)
+            }
+        }
+    }
+
+def _collect_component_metrics():
+    """Exports the existing stats dictionaries as gauges at scrape time."""
+    for name, cache in (
+        ("gb_search", google_books_search_cache),
+        ("gb_volume", google_books_volume_cache),
+        ("recommendations", recommendation_cache)
+    ):
+        cache_stats = cache.stats()
+        for result in ("local_hits", "redis_hits", "misses"):
+            yield CACHE_EVENTS, (name, result), cache_stats[result]
+        yield COMPONENT_STATS, (f"cache_{name}", "entries"), cache_stats["entries"]
+    catalog_stats = book_catalog.stats()
+    for result in ("hits", "misses"):
+        yield CACHE_EVENTS, ("catalog", result), catalog_stats[result]
+    thumbnail_stats = thumbnail_cache.stats()
+    for result in ("hits", "misses"):
+        yield CACHE_EVENTS, ("thumbnails", result), thumbnail_stats[result]
+    yield COMPONENT_STATS, ("cache_thumbnails", "bytes"), thumbnail_stats["bytes"]
+    yield COMPONENT_STATS, ("cache_thumbnails", "evictions"), thumbnail_stats["evictions"]
+    yield CACHE_EVENTS, ("prewarm", "hits"), prewarm_stats["hits"]
+    yield CACHE_EVENTS, ("prewarm", "stale_hits"), prewarm_stats["stale_hits"]
+    sources = (
+        ("sessions", session_store.stats()),
+        ("recommendation_cache", recommendation_cache_stats),
+        ("classifier", classifier_stats),
+        ("pipeline", pipeline_stats),
+        ("prewarm", prewarm_stats),
+        ("logging", log_stats),
+        ("startup", {phase: value for phase, value in startup_timings.items() if value is not None}),
+        ("resilience", resilience_stats),
+        ("webhooks", webhook_stats),
+        ("prefetch", prefetch_stats),
+        ("admission", llm_admission.stats()),
+        ("breaker_openai", {**openai_breaker.stats(), "open": int(openai_breaker.state != "closed")}),
+        ("breaker_google_books", {**google_books_breaker.stats(), "open": int(google_books_breaker.state != "closed")})
+    )
+    for flight_name, flight_stats in upstream_single_flight.stats.items():
+        sources += ((f"coalescing_{flight_name}", flight_stats),)
+    for component, values in sources:
+        for stat, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield COMPONENT_STATS, (component, stat), value
+
+metrics.collectors.append(_collect_component_metrics)
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- End Google Books Response Cache ---
+
+# --- Single-Flight Request Coalescing ---
+# Concurrent identical upstream calls (same function, same key) share one in-flight
+# task instead of each hitting OpenAI or Google Books. The shared task starts in an
+# empty context, so it belongs to no single caller: it isn't charged to the first
+# caller's user and gets its own deadline budget rather than inheriting theirs, while
+# each caller still waits for it no longer than its own remaining budget.
+
+async def _run_flight(call, bounded: bool, interactive: bool):
+    if bounded:
+        start_request_deadline()  # Only this flight's task sees it
+    if interactive:
+        _llm_interactive.set(True)
+    return await call()
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time; callers arriving while it is in flight
+    await the same result. Exceptions propagate to every waiter and the key is freed
+    so the next call retries. A cancelled or timed-out waiter doesn't affect the
+    others; the shared call is only cancelled once every waiter has gone.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, list] = {}  # key -> [task, waiter count]
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, name: str, key: str, call):
+        stats = self.stats.setdefault(name, {"calls": 0, "coalesced": 0})
+        stats["calls"] += 1
+        flight_key = f"{name}:{key}"
+        deadline = _request_deadline.get()
+        entry = self._calls.get(flight_key)
+        if entry is None:
+            interactive = _llm_user.get() is not None or _llm_interactive.get()
+            task = contextvars.Context().run(
+                asyncio.create_task, _run_flight(call, deadline is not None, interactive)
             )
+            entry = [task, 0]
+            self._calls[flight_key] = entry
+            task.add_done_callback(functools.partial(self._finish, flight_key, entry))
+        else:
+            stats["coalesced"] += 1
+        entry[1] += 1
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            return await asyncio.wait_for(asyncio.shield(entry[0]), timeout)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()  # Every waiter was cancelled
+
+    def _finish(self, flight_key: str, entry: list, task: asyncio.Task):
+        if self._calls.get(flight_key) is entry:
+            del self._calls[flight_key]
+        if not task.cancelled():
+            task.exception()  # Mark retrieved so abandoned failures aren't logged as unhandled
+
+upstream_single_flight = SingleFlight()
+
+def coalesce(name: str, key_func, copy_result=None):
+    """
+    Decorator coalescing concurrent calls whose `key_func(*args, **kwargs)` match.
+    `copy_result` gives each caller its own copy of a shared mutable result.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            result = await upstream_single_flight.do(name, key_func(*args, **kwargs), lambda: func(*args, **kwargs))
+            return copy_result(result) if copy_result is not None and result is not None else result
+        return wrapper
+    return decorator
+
+def _copy_dict_list(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [dict(item) for item in items]
+
+# --- End Single-Flight Request Coalescing ---
+
+# --- Recommendation Cache ---
+# LLM recommendation ideas cached by a canonical form of the preferences dict, so
+# {"Genre": "Fantasy"} and {"genre": " fantasy"} share an entry. Each entry holds up
+# to REC_CACHE_VARIANTS distinct result sets; sessions asking again for the same
+# preferences are handed the next variant so repeat requests still vary.
+
+recommendation_cache = TwoTierCache(
+    "recommendations", REC_CACHE_MAX_ENTRIES, REC_CACHE_TTL, GB_NEGATIVE_CACHE_TTL, _cache_redis_backend
+)
+recommendation_cache_stats: Dict[str, int] = {"served_cached": 0, "generated": 0}
+
+def canonicalize_preferences(value: Any) -> Any:
+    """Normalizes keys, casefolds string values and sorts dict keys, recursively."""
+    if isinstance(value, dict):
+        normalized = {
+            "_".join(str(key).casefold().replace("-", " ").split()): canonicalize_preferences(item)
+            for key, item in value.items()
+        }
+        return {key: normalized[key] for key in sorted(normalized)}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize_preferences(item) for item in value]
+    if isinstance(value, str):
+        return " ".join(value.casefold().split())
+    return value
+
+def recommendation_preferences_key(preferences: Dict[str, Any]) -> str:
+    canonical = json.dumps(canonicalize_preferences(preferences), separators=(",", ":"), sort_keys=True)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+def _recommendation_cache_key(preferences: Dict[str, Any], max_recommendations: int) -> str:
+    return f"{max_recommendations}:{recommendation_preferences_key(preferences)}"
+
+def _pick_recommendation_variant(variants: List[List[Dict[str, Any]]], variant: int) -> Optional[List[Dict[str, Any]]]:
+    """Returns the requested cached variant, cycling once all variant slots are filled."""
+    if variant < len(variants):
+        return variants[variant]
+    if variants and len(variants) >= REC_CACHE_VARIANTS:
+        return variants[variant % len(variants)]
+    return None  # Generate a new variant
+
+async def _load_recommendation_variants(cache_key: str) -> List[List[Dict[str, Any]]]:
+    cached = await recommendation_cache.get(cache_key)
+    return cached if isinstance(cached, list) else []
+
+async def _store_recommendation_variant(cache_key: str, recommendations: List[Dict[str, Any]]):
+    variants = await _load_recommendation_variants(cache_key)
+    if len(variants) < REC_CACHE_VARIANTS:
+        await recommendation_cache.set(cache_key, variants + [recommendations])
+
+def _next_recommendation_variant(user_state: Dict[str, Any], preferences: Dict[str, Any]) -> int:
+    """
+    Returns how many times this session has already been served recommendations for
+    these preferences, and counts this request. Only the most recent keys are kept.
+    """
+    served = user_state["details"].setdefault("recommendation_variants", {})
+    key = recommendation_preferences_key(preferences)
+    variant = served.pop(key, 0)
+    served[key] = variant + 1
+    while len(served) > 20:
+        served.pop(next(iter(served)))
+    return variant
+
+# --- End Recommendation Cache ---
+
+# --- Session Seen-Set ---
+# Each session remembers the books it has been shown, by volume ID and by a
+# normalized title/author key, in user_state["details"]["seen"]. Ideas the session
+# has seen are dropped before enrichment, and the most recent titles are named in
+# the recommendation prompt so the LLM avoids them in the first place.
+
+def _seen_idea_key(title: Any, author: Any) -> str:
+    """'The Hobbit' by 'J.R.R. Tolkien' -> 'hobbit|tolkien': title key plus the first author's surname."""
+    if isinstance(author, (list, tuple)):
+        author = author[0] if author else ""
+    first_author = re.split(r",| and | & ", str(author or ""))[0]
+    surname = (_catalog_author_key(first_author).split() or [""])[-1]
+    return f"{_catalog_title_key(str(title or ''))}|{surname}"
+
+class SeenSet:
+    """
+    Compact set of seen-book keys, stored as 8-byte hashes. Up to SEEN_SET_EXACT_MAX
+    keys are kept exactly; past that they move into a Bloom filter sized for
+    SEEN_SET_BLOOM_CAPACITY keys, whose rare false positives only skip an unseen book.
+    A filter that outgrows its capacity starts over rather than let that rate climb.
+    Round-trips through the session state with from_state / to_state.
+    """
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None):
+        state = state or {}
+        self.digests = set(state.get("keys", []))  # Hex digests while exact
+        self.bloom = bytearray(base64.b64decode(state["bloom"])) if state.get("bloom") else None
+        self.bits = state.get("m", 0)
+        self.hashes = state.get("k", 0)
+        self.count = state.get("count", len(self.digests))
+        self.recent_titles: List[str] = list(state.get("titles", []))
+
+    @classmethod
+    def from_state(cls, state: Optional[Dict[str, Any]]) -> "SeenSet":
+        return cls(state if isinstance(state, dict) else None)
+
+    def to_state(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {"count": self.count, "titles": self.recent_titles}
+        if self.bloom is not None:
+            state.update(bloom=base64.b64encode(bytes(self.bloom)).decode("ascii"), m=self.bits, k=self.hashes)
+        else:
+            state["keys"] = sorted(self.digests)
+        return state
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+    def _positions(self, digest: str):
+        value = int(digest, 16)
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1  # Double hashing from the two halves
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    @staticmethod
+    def _bloom_capacity() -> int:
+        return max(SEEN_SET_BLOOM_CAPACITY, SEEN_SET_EXACT_MAX * 2)
+
+    def _to_bloom(self):
+        capacity = self._bloom_capacity()
+        self.bits = max(64, int(-capacity * math.log(SEEN_SET_BLOOM_ERROR_RATE) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.bloom = bytearray((self.bits + 7) // 8)
+        for digest in self.digests:
+            self._add_digest(digest)
+        self.digests = set()
+
+    def _add_digest(self, digest: str):
+        if self.bloom is None:
+            self.digests.add(digest)
+            return
+        for position in self._positions(digest):
+            self.bloom[position >> 3] |= 1 << (position & 7)
+
+    def _contains_digest(self, digest: str) -> bool:
+        if self.bloom is None:
+            return digest in self.digests
+        return all(self.bloom[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+    def add(self, key: str):
+        digest = self._digest(key)
+        if self._contains_digest(digest):
+            return
+        if self.bloom is not None and self.count >= self._bloom_capacity():
+            self.count = 0
+            self._to_bloom()  # Starts an empty filter
+        self._add_digest(digest)
+        self.count += 1
+        if self.bloom is None and len(self.digests) > SEEN_SET_EXACT_MAX:
+            self._to_bloom()
+
+    def __contains__(self, key: str) -> bool:
+        return self._contains_digest(self._digest(key))
+
+    def add_book(self, book: Dict[str, Any]):
+        if book.get("id"):
+            self.add(f"id:{book['id']}")
+        if book.get("title"):
+            self.add(_seen_idea_key(book["title"], book.get("authors")))
+            if book["title"] in self.recent_titles:
+                self.recent_titles.remove(book["title"])
+            self.recent_titles = (self.recent_titles + [book["title"]])[-SEEN_PROMPT_MAX_TITLES:]
+
+    def has_seen_idea(self, idea: Dict[str, Any]) -> bool:
+        return bool(idea.get("title")) and _seen_idea_key(idea["title"], idea.get("author")) in self
+
+    def has_seen_book(self, book: Dict[str, Any]) -> bool:
+        if book.get("id") and f"id:{book['id']}" in self:
+            return True
+        return bool(book.get("title")) and _seen_idea_key(book["title"], book.get("authors")) in self
+
+def remember_shown_books(user_state: Dict[str, Any]):
+    """Adds the session's current recommendations to its seen-set."""
+    details = user_state["details"]
+    seen = SeenSet.from_state(details.get("seen"))
+    for book in details.get("last_recommendations", []):
+        seen.add_book(book)
+    details["seen"] = seen.to_state()
+
+async def _unseen_ideas_stream(ideas, seen: SeenSet, limit: int):
+    """
+    Passes streamed ideas through, minus seen ones, up to `limit`. The source is read
+    to its end (it stops itself once the page is full) so it still caches the result set.
+    """
+    kept = 0
+    try:
+        async for idea in ideas:
+            if kept >= limit or seen.has_seen_idea(idea):
+                continue
+            yield idea
+            kept += 1
+    finally:
+        await ideas.aclose()
+
+def _unseen_ideas(ideas, seen: Optional[SeenSet], limit: int):
+    if seen is None:
+        return ideas
+    if isinstance(ideas, list):
+        return [idea for idea in ideas if not seen.has_seen_idea(idea)][:limit]
+    return _unseen_ideas_stream(ideas, seen, limit)
+
+# --- End Session Seen-Set ---
+
+# --- Local Book Catalog ---
+# Every volume returned by get_book_details_by_id is indexed in SQLite (FTS5), so
+# LLM ideas for books we've already enriched resolve locally by fuzzy title+author
+# match instead of a Google Books search plus detail fetch. Lookups are indexed
+# point queries that take microseconds, so they run inline on the event loop.
+
+_TITLE_ARTICLES = ("the ", "a ", "an ")
+
+def _catalog_key(text: str) -> str:
+    """Casefolds, strips accents and punctuation and collapses whitespace."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def _catalog_title_key(title: str) -> str:
+    """Title key without a subtitle or leading article: 'The Hobbit: Or There and Back Again' -> 'hobbit'."""
+    key = _catalog_key((title or "").split(":")[0])
+    for article in _TITLE_ARTICLES:
+        if key.startswith(article):
+            return key[len(article):]
+    return key
+
+def _catalog_author_key(author: Any) -> str:
+    if isinstance(author, (list, tuple)):
+        author = " ".join(str(name) for name in author)
+    return _catalog_key(str(author or ""))
+
+def _author_similarity(wanted: str, candidate: str) -> float:
+    """Token overlap tolerant of initials and ordering ('J.R.R. Tolkien' vs 'Tolkien, J. R. R.')."""
+    if not wanted or not candidate:
+        return 0.0
+    wanted_tokens = {token for token in wanted.split() if len(token) > 1}
+    candidate_tokens = {token for token in candidate.split() if len(token) > 1}
+    if wanted_tokens and wanted_tokens <= candidate_tokens:
+        return 1.0
+    return difflib.SequenceMatcher(None, wanted, candidate).ratio()
+
+class BookCatalog:
+    """
+    Persistent SQLite catalog of enriched volumes with fuzzy title+author lookup.
+    Writes run in a worker thread (see `add`), serialized by a lock; lookups are
+    indexed reads and run inline.
+    """
+
+    def __init__(self, path: str, max_age: int = BOOK_CATALOG_MAX_AGE, min_score: float = BOOK_CATALOG_MIN_SCORE):
+        self.path = path
+        self.max_age = max_age
+        self.min_score = min_score
+        self._db: Optional[sqlite3.Connection] = None
+        self._disabled = not path
+        self._lock = threading.Lock()  # Serializes opening and write transactions across threads
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # Opened on first use so importing the app stays cheap
+        if self._db is not None or self._disabled:
+            return self._db
+        with self._lock:
+            if self._db is None and not self._disabled:
+                self._open()
+        return self._db
+
+    def _open(self):
+        try:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS volumes (
+                id TEXT PRIMARY KEY, title_key TEXT NOT NULL, author_key TEXT NOT NULL,
+                details TEXT NOT NULL, updated_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS volumes_title_key ON volumes (title_key)")
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS volumes_fts USING fts5(id UNINDEXED, title, authors)")
+            db.commit()
+            self._db = db
+        except sqlite3.Error as e:
+            log.warning("Book Catalog: Disabled, could not open '%s' - %s", self.path, e)
+            self._disabled = True
+
+    async def add(self, details: Dict[str, Any]):
+        """Indexes (or refreshes) a volume returned by get_book_details_by_id, off the event loop."""
+        if self._disabled or not details.get("id") or not details.get("title"):
+            return
+        await asyncio.to_thread(self._add, details)
+
+    def _add(self, details: Dict[str, Any]):
+        db = self._connect()
+        if db is None:
+            return
+        authors = _catalog_author_key(details.get("authors"))
+        try:
+            with self._lock, db:
+                db.execute(
+                    "INSERT OR REPLACE INTO volumes (id, title_key, author_key, details, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (details["id"], _catalog_title_key(details["title"]), authors,
+                     json.dumps(details, separators=(",", ":")), time.time())
+                )
+                db.execute("DELETE FROM volumes_fts WHERE id = ?", (details["id"],))
+                db.execute("INSERT INTO volumes_fts (id, title, authors) VALUES (?, ?, ?)",
+                           (details["id"], _catalog_key(details["title"]), authors))
+            self.added += 1
+        except sqlite3.Error as e:
+            log.warning("Book Catalog: Failed to index volume %s - %s", details.get('id'), e)
+
+    def _candidates(self, db: sqlite3.Connection, title_key: str) -> List[tuple]:
+        rows = db.execute(
+            "SELECT id, title_key, author_key, details, updated_at FROM volumes WHERE title_key = ?", (title_key,)
+        ).fetchall()
+        if rows:
+            return rows
+        tokens = [token for token in title_key.split() if len(token) > 1]
+        if not tokens:
+            return []
+        match_query = " ".join('"' + token.replace('"', '') + '"' for token in tokens)
+        return db.execute(
+            """SELECT v.id, v.title_key, v.author_key, v.details, v.updated_at
+               FROM volumes_fts f JOIN volumes v ON v.id = f.id
+               WHERE volumes_fts MATCH ? ORDER BY bm25(volumes_fts) LIMIT 10""",
+            (f"title : ({match_query})",)
+        ).fetchall()
+
+    def get(self, volume_id: str, allow_stale: bool = True) -> Optional[Dict[str, Any]]:
+        """Returns a volume's catalogued details (only if fresh, without `allow_stale`), or None."""
+        db = self._connect()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT details, updated_at FROM volumes WHERE id = ?", (volume_id,)).fetchone()
+        except sqlite3.Error as e:
+            log.warning("Book Catalog: Lookup failed for volume %s - %s", volume_id, e)
+            return None
+        if row is None or (not allow_stale and row[1] < time.time() - self.max_age):
+            return None
+        return json.loads(row[0])
+
+    def resolve(self, title: str, author: Any = None, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Returns the catalogued details of the best fuzzy match for an LLM idea,
+        or None if no fresh entry (any entry, with `allow_stale`) matches closely enough.
+        """
+        db = self._connect()
+        title_key = _catalog_title_key(title)
+        if db is None or not title_key:
+            return None
+        author_key = _catalog_author_key(author)
+        best_score, best_details = 0.0, None
+        try:
+            rows = self._candidates(db, title_key)
+        except sqlite3.Error as e:
+            log.warning("Book Catalog: Lookup failed for '%s' - %s", title, e)
+            rows = []
+        fresh_after = 0.0 if allow_stale else time.time() - self.max_age
+        for _, candidate_title, candidate_author, details, updated_at in rows:
+            if updated_at < fresh_after:
+                continue
+            score = difflib.SequenceMatcher(None, title_key, candidate_title).ratio()
+            if author_key:
+                score = min(score, _author_similarity(author_key, candidate_author) + 0.1)
+            if score > best_score:
+                best_score, best_details = score, details
+        if best_details is None or best_score < self.min_score:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(best_details)
 
-            if book_results:
-                bot_message = "Based on your new request, here are some recommendations:"
-                user_state["details"]["last_recommendations"] = book_results
-                response_suggestions = ["Tell me more about #1", "Show different recommendations", "Start Over"]
-                user_state["stage"] = "SHOWING_RECOMMENDATIONS"
-            else:
-                bot_message = "Sorry, I couldn't find specific details for that new request..."
-                response_suggestions = ["Try Fantasy genre", "Suggest popular Sci-Fi"]
-                user_state["stage"] = "AWAITING_PREFERENCES" # Go back
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": not self._disabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "added": self.added,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
 
-    else:
-        # IMPROVED FALLBACK LOGIC:
-        # Check if the message matches any of our common suggestion buttons
-        # This acts as a safety net in case our NLP process failed to catch the intent
-        lower_message = request.message.lower()
-        suggestion_matches = [
-            "suggest fantasy books", "recommend sci-fi", "books like the hobbit",
-            "mystery novels", "contemporary fiction", "bestsellers this year",
-            "historical fiction", "books by female authors", "popular mystery novels"
-        ]
-        if any(suggestion.lower() == lower_message for suggestion in suggestion_matches):
-            # This is a button click that our NLP missed - treat it as a recommendation request
-            print(f"Fallback logic: Recognized '{request.message}' as a suggestion button click")
-            bot_message = f"Looking for {request.message}, one moment..."
-            # Extract appropriate entities based on the message
-            if "fantasy" in lower_message:
-                entities["genre"] = "Fantasy"
-            elif "sci-fi" in lower_message:
-                entities["genre"] = "Science Fiction"
-            elif "hobbit" in lower_message:
-                entities["similar_to"] = "The Hobbit"
-            elif "mystery" in lower_message:
-                entities["genre"] = "Mystery"
-            elif "contemporary" in lower_message:
-                entities["genre"] = "Contemporary Fiction"
-            elif "bestseller" in lower_message or "this year" in lower_message:
-                entities["category"] = "Bestsellers"
-            elif "historical" in lower_message:
-                entities["genre"] = "Historical Fiction"
-            elif "female" in lower_message and "author" in lower_message:
-                entities["author_attribute"] = "Female"
-            # Process as a recommendation request with the extracted entity
-            user_state["details"]["preferences_text"] = request.message
-            user_state["details"]["nlp_entities"] = entities
-            # Use helper function for recommendations
-            book_results = await _fetch_and_process_recommendations(
-                entities or {"raw_query": request.message},
-                user_state["history"],
-                5,
-                os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
-            )
-            if book_results:
-                bot_message = f"Here are some {request.message} that you might enjoy:"
-                user_state["details"]["last_recommendations"] = book_results
-                response_suggestions = ["Tell me more about #1", "Show different recommendations", "Start Over"]
-                user_state["stage"] = "SHOWING_RECOMMENDATIONS"
-            else:
-                bot_message = f"I'm sorry, I couldn't find specific {request.message} at the moment. Could you try another category?"
-                response_suggestions = ["Fantasy Books", "Mystery Novels", "Books by Female Authors"]
-                user_state["stage"] = "AWAITING_PREFERENCES"
-        else:
-            # Default / Real Fallback for any unhandled stage/intent combination
-            bot_message = "Sorry, I wasn't sure how to proceed from there. Could you clarify? You can ask for recommendations by genre, author, or similar books."
-            # Provide more diverse options to maintain a better chat flow
-            response_suggestions = [
-                "Suggest Fantasy Books", 
-                "Recommend Sci-Fi", 
-                "Books like The Hobbit",
-                "Popular mystery novels"
-            ]
-            user_state["stage"] = "AWAITING_PREFERENCES" # Default back to expecting preferences
-    # Prepare final response
-    final_books_data = user_state["details"].get("last_recommendations", []) if user_state["stage"] == "SHOWING_RECOMMENDATIONS" else []
-    # Append bot response to history
-    user_state["history"].append({"role": "assistant", "content": bot_message})
-    # Save updated state
-    session_states[session_id] = user_state
-    print(f"User {session_id} - Saving New State: {user_state}")
-    return ChatResponse(
-        user_id=session_id,
-        bot_message=bot_message,
-        suggestions=response_suggestions,
-        books=final_books_data  # Send book data only when showing recommendations
-    )
+book_catalog = BookCatalog(BOOK_CATALOG_PATH)
+
+# --- End Local Book Catalog ---
 
 # --- Mocked Google Books API Interface ---
 # These functions simulate calls to the Google Books API.
 # Their internal logic will be replaced with actual API calls in Prompt 12.
 
-async def search_google_books(query: str, max_results: int = 5) -> List[Dict[str, Any]]:
-    """
-    Searches the Google Books API v1 for books matching a query.
-    Returns a list of book summaries (id, title, authors).
-    """
-    if not google_books_api_key:
-        print("Error: Google Books API key not configured.")
-        return []
+# Partial-response selectors trimming volumes to exactly what _volume_details maps
+GOOGLE_BOOKS_VOLUME_FIELDS = (
+    "id,volumeInfo(title,authors,description,imageLinks(thumbnail,smallThumbnail),industryIdentifiers,categories)"
+)
+GOOGLE_BOOKS_SEARCH_FIELDS = f"items({GOOGLE_BOOKS_VOLUME_FIELDS})"
 
-    search_url = "https://www.googleapis.com/books/v1/volumes"
-    params = {
-        'q': query,
-        'key': google_books_api_key,
-        'maxResults': min(max_results, 40),  # Google API max is 40
-        'projection': 'lite'  # Request less data for search results
-    }
-    print(f"Google Books API: Searching for '{query}'")
+def _volume_details(volume: Dict[str, Any]) -> Dict[str, Any]:
+    """Maps a Google Books volume resource onto our book details dict."""
+    volume_info = volume.get('volumeInfo', {})
+    isbn13 = None
+    identifiers = volume_info.get('industryIdentifiers', [])
+    for identifier in identifiers:
+        if identifier.get('type') == 'ISBN_13':
+            isbn13 = identifier.get('identifier')
+            break  # Prefer ISBN_13
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(search_url, params=params) as response:
-                response.raise_for_status()  # Raise exception for bad status codes (4xx or 5xx)
-                data = await response.json()
-
-                items = data.get('items', [])
-                results = []
-                for item in items:
-                    volume_info = item.get('volumeInfo', {})
-                    results.append({
-                        'id': item.get('id'),
-                        'title': volume_info.get('title'),
-                        'authors': volume_info.get('authors', []),  # Authors is a list
-                    })
-                print(f"Google Books API: Found {len(results)} results.")
-                return results[:max_results]  # Limit to requested number
+    return {
+        'id': volume.get('id'),
+        'title': volume_info.get('title'),
+        'authors': volume_info.get('authors', []),
+        'description': volume_info.get('description'),
+        'thumbnail': volume_info.get('imageLinks', {}).get('thumbnail') or \
+                    volume_info.get('imageLinks', {}).get('smallThumbnail'),  # Get best available thumbnail
+        'isbn13': isbn13,
+        'categories': volume_info.get('categories', [])
+        # Add other fields if needed e.g., publishedDate, averageRating etc.
+    }
 
-    except aiohttp.ClientResponseError as e:
-        print(f"Google Books API Error (Search): HTTP Status {e.status} - {e.message}")
-    except aiohttp.ClientConnectionError as e:
-        print(f"Google Books API Error (Search): Connection Error - {e}")
-    except json.JSONDecodeError:
-        print(f"Google Books API Error (Search): Could not decode JSON response")
-    except Exception as e:
-        print(f"Google Books API Error (Search): An unexpected error occurred: {e}")
+def _log_google_books_error(label: str, call: str, error: Exception):
+    """Logs (and counts, for connection errors and timeouts) a failed Google Books call."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        log.error("Google Books API Error (%s): HTTP Status %s - %s", label, error.status, error.message)
+    elif isinstance(error, CircuitOpenError):
+        log.debug("Google Books API (%s): %s", label, error)
+    elif isinstance(error, aiohttp.ClientConnectionError):
+        UPSTREAM_RESPONSES.inc("google_books", call, "connection_error")
+        log.error("Google Books API Error (%s): Connection Error - %s", label, error)
+    elif isinstance(error, asyncio.TimeoutError):
+        UPSTREAM_RESPONSES.inc("google_books", call, "timeout")
+        log.error("Google Books API Error (%s): Request timed out", label)
+    elif isinstance(error, json.JSONDecodeError):
+        log.error("Google Books API Error (%s): Could not decode JSON response", label)
+    else:
+        log.error("Google Books API Error (%s): An unexpected error occurred: %s", label, error)
 
-    return []  # Return empty list on error
+async def _google_books_get(url: str, params: Dict[str, Any], call: str) -> Dict[str, Any]:
+    """One Google Books GET attempt; retries, hedging and deadlines are left to call_upstream."""
+    async with get_http_session().get(url, params=params) as response:
+        UPSTREAM_RESPONSES.inc("google_books", call, str(response.status))
+        response.raise_for_status()  # Raise exception for bad status codes (4xx or 5xx)
+        return await response.json()
 
+@timed_stage("google_books_volume")
+@coalesce("gb_volume", lambda book_id: book_id, dict)
 async def get_book_details_by_id(book_id: str) -> Optional[Dict[str, Any]]:
     """
     Fetches detailed information for a specific book ID from Google Books API v1.
     Returns a dictionary with details or None if not found or error.
     """
     if not google_books_api_key:
-        print("Error: Google Books API key not configured.")
+        log.error("Error: Google Books API key not configured.")
         return None
     if not book_id:  # Prevent calling with empty ID
         return None
 
-    detail_url = f"https://www.googleapis.com/books/v1/volumes/{book_id}"
-    params = {'key': google_books_api_key}
-    print(f"Google Books API: Getting details for book_id '{book_id}'")
+    detail_url = f"{google_books_base_url}/volumes/{book_id}"
+    params = {'key': google_books_api_key, 'fields': GOOGLE_BOOKS_VOLUME_FIELDS}
+    cached = await google_books_volume_cache.get(book_id)
+    if cached is not _CACHE_MISS:
+        log.debug("Google Books API: Cache hit for book_id '%s'", book_id)
+        return dict(cached) if cached is not None else None
+    # Books resolved from the catalog never went through Google, so they aren't cached yet
+    catalogued = book_catalog.get(book_id, allow_stale=False)
+    if catalogued is not None:
+        log.debug("Google Books API: Catalog hit for book_id '%s'", book_id)
+        await google_books_volume_cache.set(book_id, catalogued)
+        return dict(catalogued)
+
+    log.debug("Google Books API: Getting details for book_id '%s'", book_id)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(detail_url, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-
-                volume_info = data.get('volumeInfo', {})
-                isbn13 = None
-                identifiers = volume_info.get('industryIdentifiers', [])
-                for identifier in identifiers:
-                    if identifier.get('type') == 'ISBN_13':
-                        isbn13 = identifier.get('identifier')
-                        break  # Prefer ISBN_13
-
-                details = {
-                    'id': data.get('id'),
-                    'title': volume_info.get('title'),
-                    'authors': volume_info.get('authors', []),
-                    'description': volume_info.get('description'),
-                    'thumbnail': volume_info.get('imageLinks', {}).get('thumbnail') or \
-                                volume_info.get('imageLinks', {}).get('smallThumbnail'),  # Get best available thumbnail
-                    'isbn13': isbn13,
-                    'categories': volume_info.get('categories', [])
-                    # Add other fields if needed e.g., publishedDate, averageRating etc.
-                }
-                print(f"Google Books API: Details found for {book_id}.")
-                return details
+        data = await call_upstream(
+            google_books_breaker,
+            lambda: _google_books_get(detail_url, params, "volume"),
+            HTTP_READ_TIMEOUT,
+            google_books_volume_latency
+        )
+        details = _volume_details(data)
+        log.debug("Google Books API: Details found for %s.", book_id)
+        await google_books_volume_cache.set(book_id, details)
+        await book_catalog.add(details)
+        return dict(details)
 
     except aiohttp.ClientResponseError as e:
         # Specifically handle 404 Not Found if needed
         if e.status == 404:
-            print(f"Google Books API: Book ID '{book_id}' not found (404).")
+            log.info("Google Books API: Book ID '%s' not found (404).", book_id)
+            await google_books_volume_cache.set(book_id, None)  # Negative cache
+            return None
         else:
-            print(f"Google Books API Error (Details): HTTP Status {e.status} - {e.message}")
+            log.error("Google Books API Error (Details): HTTP Status %s - %s", e.status, e.message)
+    except CircuitOpenError as e:
+        log.debug("Google Books API (Details): %s", e)
     except aiohttp.ClientConnectionError as e:
-        print(f"Google Books API Error (Details): Connection Error - {e}")
+        UPSTREAM_RESPONSES.inc("google_books", "volume", "connection_error")
+        log.error("Google Books API Error (Details): Connection Error - %s", e)
+    except asyncio.TimeoutError:
+        UPSTREAM_RESPONSES.inc("google_books", "volume", "timeout")
+        log.error("Google Books API Error (Details): Request timed out")
     except json.JSONDecodeError:
-        print(f"Google Books API Error (Details): Could not decode JSON response")
+        log.error("Google Books API Error (Details): Could not decode JSON response")
     except Exception as e:
-        print(f"Google Books API Error (Details): An unexpected error occurred: {e}")
+        log.error("Google Books API Error (Details): An unexpected error occurred: %s", e)
 
+    # Upstream unavailable: serve the catalogued copy, however old, rather than nothing
+    stale_details = book_catalog.get(book_id)
+    if stale_details is not None:
+        resilience_stats["stale_served"] += 1
+        return stale_details
     return None  # Return None if details not found or error occurs
 
+def _resolve_query(title: str, author: Any = None) -> str:
+    if isinstance(author, (list, tuple)):
+        author = " ".join(str(name) for name in author)
+    return f"{title or ''} {author or ''}".strip()
+
+def _resolve_cache_key(query: str) -> str:
+    return f"resolve:{_normalize_search_query(query)}"
+
+async def _remember_resolved(cache_key: str, details: Optional[Dict[str, Any]]):
+    """Caches a resolution (negatively when None) and indexes the volume for later lookups."""
+    await google_books_search_cache.set(cache_key, details)
+    if details is not None:
+        await google_books_volume_cache.set(details['id'], details)
+        await book_catalog.add(details)
+
+@timed_stage("google_books_resolve")
+@coalesce("gb_resolve", lambda title, author=None: _normalize_search_query(_resolve_query(title, author)), dict)
+async def resolve_google_book(title: str, author: Any = None) -> Optional[Dict[str, Any]]:
+    """
+    Resolves an LLM idea to full book details with a single Google Books search: full
+    projection, trimmed by a `fields=` selector to what the details dict uses (instead
+    of a lite search followed by a volume lookup).
+    Returns the details dict, or None if nothing matched or on error.
+    """
+    if not google_books_api_key:
+        log.error("Error: Google Books API key not configured.")
+        return None
+    query = _resolve_query(title, author)
+    if not query:
+        return None
+    cache_key = _resolve_cache_key(query)
+    cached = await google_books_search_cache.get(cache_key)
+    if cached is not _CACHE_MISS:
+        log.debug("Google Books API: Cache hit for resolve '%s'", query)
+        return dict(cached) if cached is not None else None
+
+    search_url = f"{google_books_base_url}/volumes"
+    params = {
+        'q': query,
+        'key': google_books_api_key,
+        'maxResults': 1,
+        'projection': 'full',
+        'fields': GOOGLE_BOOKS_SEARCH_FIELDS
+    }
+    log.debug("Google Books API: Resolving '%s'", query)
+    try:
+        data = await call_upstream(
+            google_books_breaker,
+            lambda: _google_books_get(search_url, params, "resolve"),
+            HTTP_READ_TIMEOUT,
+            google_books_search_latency
+        )
+    except Exception as e:
+        _log_google_books_error("Resolve", "resolve", e)
+        return None
+    items = data.get('items', [])
+    details = _volume_details(items[0]) if items else None
+    await _remember_resolved(cache_key, details)
+    return details
+
+def _idea_match_score(idea: Dict[str, Any], details: Dict[str, Any]) -> float:
+    """How well a returned volume matches an idea, scored like BookCatalog.resolve."""
+    title_key = _catalog_title_key(idea.get('title', ''))
+    if not title_key:
+        return 0.0
+    score = difflib.SequenceMatcher(None, title_key, _catalog_title_key(details.get('title') or '')).ratio()
+    author_key = _catalog_author_key(idea.get('author'))
+    if author_key:
+        score = min(score, _author_similarity(author_key, _catalog_author_key(details.get('authors'))) + 0.1)
+    return score
+
+@timed_stage("google_books_resolve")
+async def resolve_google_books_batch(ideas: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Resolves several ideas with OR-combined title searches (GB_BATCH_MAX_IDEAS titles per
+    query), matching the returned volumes back to ideas by fuzzy title and author.
+    Cached ideas are answered from the cache. Returns details aligned with `ideas`;
+    None where the batch found no confident match (callers fall back to resolve_google_book).
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(ideas)
+    if not google_books_api_key:
+        return results
+    pending = []
+    for index, idea in enumerate(ideas):
+        query = _resolve_query(idea.get('title', ''), idea.get('author'))
+        if not query:
+            continue
+        cache_key = _resolve_cache_key(query)
+        cached = await google_books_search_cache.get(cache_key)
+        if cached is _CACHE_MISS:
+            pending.append((index, idea, cache_key))
+        elif cached is not None:
+            results[index] = dict(cached)
+
+    search_url = f"{google_books_base_url}/volumes"
+    for start in range(0, len(pending), max(1, GB_BATCH_MAX_IDEAS)):
+        chunk = pending[start:start + max(1, GB_BATCH_MAX_IDEAS)]
+        if len(chunk) < 2:
+            break  # A lone idea is better served by a precise single search
+        titles = [" ".join((idea.get('title') or '').replace('"', ' ').split()) for _, idea, _ in chunk]
+        params = {
+            'q': " OR ".join(f'intitle:"{title}"' for title in titles if title),
+            'key': google_books_api_key,
+            'maxResults': min(40, len(chunk) * 4),
+            'projection': 'full',
+            'fields': GOOGLE_BOOKS_SEARCH_FIELDS
+        }
+        try:
+            data = await call_upstream(
+                google_books_breaker,
+                lambda: _google_books_get(search_url, params, "resolve_batch"),
+                HTTP_READ_TIMEOUT,
+                google_books_search_latency
+            )
+        except Exception as e:
+            _log_google_books_error("Batch Resolve", "resolve_batch", e)
+            break
+        volumes = [_volume_details(item) for item in data.get('items', [])]
+        for index, idea, cache_key in chunk:
+            best_score, best_details = 0.0, None
+            for details in volumes:  # The first (most relevant) volume wins ties
+                score = _idea_match_score(idea, details)
+                if score > best_score:
+                    best_score, best_details = score, details
+            if best_details is not None and best_score >= BOOK_CATALOG_MIN_SCORE:
+                await _remember_resolved(cache_key, best_details)
+                results[index] = dict(best_details)
+        log.debug("Google Books API: Batch resolved %s of %s ideas", sum(results[i] is not None for i, _, _ in chunk), len(chunk))
+    return results
+
 # --- End Mocked Interface ---
 
-async def get_chatgpt_recommendations(
-    preferences: Dict[str, Any],
-    history: List[Dict[str, str]],
-    max_recommendations: int = 5
-) -> List[Dict[str, Any]]:
+# --- Thumbnail Proxy ---
+# Book covers are served from /api/thumbnail instead of straight from Google's image
+# servers. Cached details keep the source URL; chat responses rewrite `thumbnail` to
+# the proxy as books are shaped. Each source image is fetched once through the shared
+# HTTP session and kept in a content-addressed disk cache, along with resized and
+# recompressed variants (with Pillow installed). Responses carry long-lived cache
+# headers and an ETag, so browsers revalidate with If-None-Match and get a 304.
+
+def _image_media_type(data: bytes) -> Optional[str]:
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+class ThumbnailCache:
     """
-    Calls ChatGPT to get book recommendation ideas based on user preferences and history.
-    Input:
-        preferences: Dict containing extracted entities like {'genre': 'sci-fi', 'liked_book': 'Dune'}
-        history: List of recent conversation turns [{'role': 'user', 'content': '...'}, ...]
-        max_recommendations: How many distinct book ideas to ask for.
-    Output:
-        List of dictionaries, each containing 'title', 'author', and 'reasoning' fields.
-        Returns empty list on error.
+    Content-addressed disk cache. Source images are stored under the SHA-256 of their
+    bytes (with a small per-URL index file pointing at it) and variants under that
+    digest plus width and format. An in-memory LRU index of the files (loaded with one
+    directory scan on first use) keeps the running size; once it grows past
+    `max_bytes`, the least recently used files are evicted down to 90% of it.
+    Disk access runs in worker threads so it never blocks the event loop.
     """
-    if not client:  # Handle missing API key case
-        print("Error: OpenAI client not initialized.")
-        return []
 
-    print(f"LLM: Getting recommendations based on preferences: {preferences}")
-    
+    def __init__(self, directory: str, max_bytes: int = THUMBNAIL_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: Optional["OrderedDict[str, int]"] = None  # path -> size, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()  # Guards the index; methods run on worker threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        """Called with the lock held."""
+        if self._index is None:
+            files = []
+            try:
+                for shard in os.scandir(self.directory):
+                    if not shard.is_dir():
+                        continue
+                    for entry in os.scandir(shard.path):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((stat.st_mtime, entry.path, stat.st_size))
+            except OSError:
+                pass  # No cache directory yet
+            self._index = OrderedDict((path, size) for _, path, size in sorted(files))
+            self._size = sum(self._index.values())
+        return self._index
+
+    def _read(self, name: str) -> Optional[bytes]:
+        path = self._path(name)
+        try:
+            with open(path, "rb") as cached_file:
+                data = cached_file.read()
+            os.utime(path)  # Recency for the index rebuilt after a restart
+        except OSError:
+            return None
+        with self._lock:
+            index = self._load_index()
+            if path in index:
+                index.move_to_end(path)
+        return data
+
+    def _write(self, name: str, data: bytes):
+        path = self._path(name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as cached_file:
+                cached_file.write(data)
+            os.replace(temp_path, path)  # Readers never see a partial file
+        except OSError as e:
+            log.warning("Thumbnail Cache: Could not write %s - %s", name, e)
+            return
+        evicted = []
+        with self._lock:
+            index = self._load_index()
+            self._size += len(data) - index.pop(path, 0)
+            index[path] = len(data)
+            if self._size > self.max_bytes:
+                target = self.max_bytes * 0.9
+                while index and self._size > target:
+                    evicted_path, evicted_size = index.popitem(last=False)
+                    self._size -= evicted_size
+                    evicted.append(evicted_path)
+                self.evictions += len(evicted)
+        for evicted_path in evicted:
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass  # Already gone
+
+    @staticmethod
+    def _source_key(url: str) -> str:
+        return "u" + hashlib.sha1(url.encode()).hexdigest()
+
+    def _cached_source(self, url: str) -> Optional[tuple]:
+        digest = self._read(self._source_key(url))
+        if not digest:
+            return None
+        data = self._read(digest.decode())
+        return (digest.decode(), data) if data else None
+
+    def _store_source(self, url: str, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(digest, data)
+        self._write(self._source_key(url), digest.encode())
+        return digest
+
+    async def source(self, url: str) -> Optional[tuple]:
+        """Returns (digest, bytes) of a cached source image, or None."""
+        if not self.directory:
+            return None
+        return await asyncio.to_thread(self._cached_source, url)
+
+    async def store_source(self, url: str, data: bytes) -> str:
+        if not self.directory:
+            return hashlib.sha256(data).hexdigest()
+        return await asyncio.to_thread(self._store_source, url, data)
+
+    async def variant(self, digest: str, width: int, image_format: str) -> Optional[bytes]:
+        """A cached variant; b"" records that the source itself is served at this width."""
+        if not self.directory:
+            return None
+        return await asyncio.to_thread(self._read, f"{digest}.{width}.{image_format}")
+
+    async def store_variant(self, digest: str, width: int, image_format: str, data: bytes):
+        if self.directory:
+            await asyncio.to_thread(self._write, f"{digest}.{width}.{image_format}", data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": bool(self.directory),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR)
+
+def _is_allowed_thumbnail_source(url: str) -> bool:
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    return parts.scheme in ("http", "https") and any(
+        host == allowed or host.endswith("." + allowed) for allowed in THUMBNAIL_ALLOWED_HOSTS
+    )
+
+def thumbnail_base_url(request: Request) -> Optional[str]:
+    """Base URL rewritten thumbnails point at, or None when the proxy is off."""
+    if not THUMBNAIL_PROXY_ENABLED:
+        return None
+    return THUMBNAIL_PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+
+def proxied_thumbnail_url(url: str, base_url: str, width: int = THUMBNAIL_DEFAULT_WIDTH) -> str:
+    if not _is_allowed_thumbnail_source(url):
+        return url
+    return f"{base_url}/api/thumbnail?src={quote(url, safe='')}&w={width}"
+
+@coalesce("thumbnail", lambda url: url)
+async def _fetch_thumbnail_source(url: str) -> tuple:
+    """Returns (digest, bytes) of a source image, from the disk cache or fetched once."""
+    cached = await thumbnail_cache.source(url)
+    if cached is not None:
+        thumbnail_cache.hits += 1
+        return cached
+    thumbnail_cache.misses += 1
+    source = url
+    for _ in range(THUMBNAIL_MAX_REDIRECTS + 1):
+        # Redirects are followed by hand so every hop is checked against the allow-list
+        async with get_http_session().get(source, allow_redirects=False) as response:
+            UPSTREAM_RESPONSES.inc("google_images", "thumbnail", str(response.status))
+            if response.status in (301, 302, 303, 307, 308):
+                source = urljoin(source, response.headers.get("Location", ""))
+                if not _is_allowed_thumbnail_source(source):
+                    raise ValueError(f"redirected to a disallowed host ({urlsplit(source).hostname})")
+                continue
+            response.raise_for_status()
+            data = await response.content.read(THUMBNAIL_MAX_SOURCE_BYTES + 1)
+            break
+    else:
+        raise ValueError("too many redirects")
+    if len(data) > THUMBNAIL_MAX_SOURCE_BYTES or _image_media_type(data) is None:
+        raise ValueError(f"not a usable image ({len(data)} bytes)")
+    return await thumbnail_cache.store_source(url, data), data
+
+def _render_thumbnail_variant(data: bytes, width: int, image_format: str) -> bytes:
+    """Downscales (never upscales) and recompresses; b"" when the source is already small enough."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width <= width:
+            return b""
+        height = max(1, round(image.height * width / image.width))
+        resized = image.convert("RGB").resize((width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    if image_format == "webp":
+        resized.save(output, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+    else:
+        resized.save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+async def _thumbnail_variant(digest: str, data: bytes, width: int, image_format: str) -> Optional[bytes]:
+    variant = await thumbnail_cache.variant(digest, width, image_format)
+    if variant is None:
+        try:
+            variant = await asyncio.to_thread(_render_thumbnail_variant, data, width, image_format)
+        except Exception as e:
+            log.warning("Thumbnail: Could not resize %s to %spx - %s", digest[:12], width, e)
+            return None
+        await thumbnail_cache.store_variant(digest, width, image_format, variant)
+    return variant or None
+
+@router.get("/api/thumbnail")
+async def thumbnail(request: Request, src: str, w: Optional[int] = None):
+    """Serves a book cover through the disk cache, resized to the nearest configured width at or above `w`."""
+    if not THUMBNAIL_PROXY_ENABLED:
+        raise HTTPException(status_code=404, detail="Thumbnail proxy disabled")
+    if not _is_allowed_thumbnail_source(src):
+        raise HTTPException(status_code=400, detail="Unsupported thumbnail source")
+    width = None
+    if w is not None and THUMBNAIL_WIDTHS and PIL_AVAILABLE:
+        width = next((allowed for allowed in THUMBNAIL_WIDTHS if allowed >= w), THUMBNAIL_WIDTHS[-1])
+    image_format = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+
+    try:
+        digest, data = await _fetch_thumbnail_source(src)
+    except Exception as e:
+        log.warning("Thumbnail: Could not fetch %s - %s", src, e)
+        raise HTTPException(status_code=502, detail="Thumbnail unavailable")
+
+    etag = f'"{digest[:24]}-{width}-{image_format}"' if width else f'"{digest[:24]}"'
+    headers = {"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}, immutable", "ETag": etag}
+    if width:
+        headers["Vary"] = "Accept"  # The variant's format follows the Accept header
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    body, media_type = data, _image_media_type(data)
+    if width:
+        variant = await _thumbnail_variant(digest, data, width, image_format)
+        if variant:
+            body, media_type = variant, f"image/{image_format}"
+    return Response(content=body, media_type=media_type, headers=headers)
+
+# --- End Thumbnail Proxy ---
+
+def _build_recommendation_messages(
+    preferences: Dict[str, Any],
+    max_recommendations: int,
+    exclude_titles: Optional[List[str]] = None
+) -> List[Dict[str, str]]:
+    """
+    Builds the chat messages asking ChatGPT for recommendations in JSON form.
+    Titles in `exclude_titles` are ones the user has already been offered.
+    """
     # Convert preferences to a string for the prompt
     preferences_str = json.dumps(preferences)
     
@@ -612,27 +3962,124 @@ Each object in the array must have the following keys:
     user_prompt = f"""Based ONLY on the following user preferences: {preferences_str}
 Suggest {max_recommendations} diverse book recommendations. Provide the title, author, and reasoning for each suggestion in the specified JSON format.
 Make sure your response is a valid parsable JSON object with a 'recommendations' key containing the array of book recommendations."""
+    if exclude_titles:
+        user_prompt += f"\nDo NOT suggest any of these books: {json.dumps(exclude_titles)}"
 
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
 
-    print(f"LLM: Sending prompt to ChatGPT requesting JSON structure")
+def _unexcluded_ideas(ideas: List[Dict[str, Any]], excluded: set) -> List[Dict[str, Any]]:
+    return [idea for idea in ideas if _catalog_title_key(idea.get("title", "")) not in excluded]
+
+def _exclusions_key(exclude_titles: Optional[List[str]]) -> str:
+    return hashlib.sha1(json.dumps(exclude_titles).encode()).hexdigest()[:12] if exclude_titles else ""
+
+def _recommendation_request_size(max_recommendations: int, excluded: set) -> int:
+    """Ideas to ask the LLM for: the page plus a few spares when some may be repeats."""
+    return max_recommendations + min(SEEN_OVERGENERATE_MAX, len(excluded))
+
+@timed_stage("recommendations")
+async def get_chatgpt_recommendations(
+    preferences: Dict[str, Any],
+    history: List[Dict[str, str]],
+    max_recommendations: int = 5,
+    variant: int = 0,
+    exclude_titles: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Calls ChatGPT to get book recommendation ideas based on user preferences and history.
+    Input:
+        preferences: Dict containing extracted entities like {'genre': 'sci-fi', 'liked_book': 'Dune'}
+        history: List of recent conversation turns [{'role': 'user', 'content': '...'}, ...]
+        max_recommendations: How many distinct book ideas to ask for.
+        variant: Which cached result set to serve for these preferences (see Recommendation Cache).
+        exclude_titles: Titles the user has already been shown. They are left out, and a
+            cached variant that can't fill the page without them is regenerated.
+    Output:
+        List of dictionaries, each containing 'title', 'author', and 'reasoning' fields.
+        Returns empty list on error; raises AdmissionRejected if the call is shed.
+    """
+    client = get_openai_client()
+    if not client:  # Handle missing API key case
+        log.error("Error: OpenAI client not initialized.")
+        return []
+
+    cache_key = _recommendation_cache_key(preferences, max_recommendations)
+    excluded = {_catalog_title_key(title) for title in exclude_titles or []}
+    cached = _pick_recommendation_variant(await _load_recommendation_variants(cache_key), variant)
+    if cached is not None and len(_unexcluded_ideas(cached, excluded)) >= max_recommendations:
+        recommendation_cache_stats["served_cached"] += 1
+        log.debug("LLM: Serving cached recommendations (variant %s) for preferences: %s", variant, preferences)
+        return [dict(idea) for idea in _unexcluded_ideas(cached, excluded)[:max_recommendations]]
+
+    # Every caller is charged and waits within its own budget, even when the call is shared
+    cost = llm_admission.charge("recommendations")
+    budget = remaining_budget(OPENAI_TIMEOUT_SECONDS) if _request_deadline.get() is not None else None
+    try:
+        return await asyncio.wait_for(
+            _generate_chatgpt_recommendations(preferences, history, max_recommendations, variant, exclude_titles),
+            budget
+        )
+    except AdmissionRejected:
+        llm_admission.refund(cost)
+        raise
+    except asyncio.TimeoutError:
+        log.warning("LLM: OpenAI call ran out of time budget")
+        return []
+
+@coalesce(
+    "recommendations",
+    lambda preferences, history, max_recommendations=5, variant=0, exclude_titles=None:
+        f"{_recommendation_cache_key(preferences, max_recommendations)}:{variant}:{_exclusions_key(exclude_titles)}",
+    _copy_dict_list
+)
+async def _generate_chatgpt_recommendations(
+    preferences: Dict[str, Any],
+    history: List[Dict[str, str]],
+    max_recommendations: int,
+    variant: int,
+    exclude_titles: Optional[List[str]]
+) -> List[Dict[str, Any]]:
+    """
+    The OpenAI call behind get_chatgpt_recommendations, shared by concurrent callers
+    (see Single-Flight Request Coalescing for the budget it runs with).
+    """
+    client = get_openai_client()
+    cache_key = _recommendation_cache_key(preferences, max_recommendations)
+    excluded = {_catalog_title_key(title) for title in exclude_titles or []}
+    cached_variants = await _load_recommendation_variants(cache_key)
+
+    log.debug("LLM: Getting recommendations based on preferences: %s", preferences)
+    recommendation_cache_stats["generated"] += 1
+    request_size = _recommendation_request_size(max_recommendations, excluded)
+    
+    # Steer new variants away from books already cached for these preferences (and seen ones)
+    prompt_exclusions = [idea.get("title") for ideas in cached_variants for idea in ideas if idea.get("title")]
+    prompt_exclusions += [title for title in exclude_titles or [] if title not in prompt_exclusions]
+    messages = _build_recommendation_messages(preferences, request_size, prompt_exclusions)
+
+    log.debug("LLM: Sending prompt to ChatGPT requesting JSON structure")
     
     # --- Call OpenAI API with JSON mode ---
     try:
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",  # Model with JSON mode support
-            response_format={"type": "json_object"},  # Enable JSON mode
-            messages=messages,
-            temperature=0.6,  # Slightly lower temperature for more structured output
-            max_tokens=250 * max_recommendations,  # Adjust tokens based on expected output size
-            n=1,
-            stop=None
-        )
+        async with llm_admission.slot("recommendations", charge=False):
+            response = await call_upstream(
+                openai_breaker,
+                lambda: client.chat.completions.create(
+                    model="gpt-3.5-turbo-1106",  # Model with JSON mode support
+                    response_format={"type": "json_object"},  # Enable JSON mode
+                    messages=messages,
+                    temperature=0.6,  # Slightly lower temperature for more structured output
+                    max_tokens=250 * request_size,  # Adjust tokens based on expected output size
+                    n=1,
+                    stop=None
+                ),
+                OPENAI_TIMEOUT_SECONDS
+            )
+        record_openai_response("recommendations", response)
         content = response.choices[0].message.content
-        print(f"LLM Raw JSON Response: {content}")
 
         # --- Parse JSON Response ---
         try:
@@ -640,28 +4087,326 @@ Make sure your response is a valid parsable JSON object with a 'recommendations'
             data = json.loads(content)
             # Extract the recommendations list
             recommendations = data.get("recommendations", [])
-            print(f"LLM Parsed Recommendations (JSON): {recommendations}")
+            log_payload("LLM Parsed Recommendations (JSON)", recommendations)
             # Return the list of recommendation dictionaries
-            return recommendations[:max_recommendations]
+            recommendations = recommendations[:request_size]
+            if recommendations:
+                await _store_recommendation_variant(cache_key, recommendations)
+            recommendations = _unexcluded_ideas(recommendations, excluded)[:max_recommendations]
+            return recommendations
             
         except json.JSONDecodeError:
-            print("LLM Error: Failed to parse JSON response from LLM")
+            log.error("LLM Error: Failed to parse JSON response from LLM: %s", content)
             # Fallback to empty list if JSON parsing fails
         except TypeError:
-            print("LLM Error: Response content might not be JSON string.")
+            log.error("LLM Error: Response content might not be JSON string.")
 
     except openai.APIError as e:
-        print(f"LLM Error: OpenAI API returned an API Error: {e}")
+        record_openai_response("recommendations", error=e)
+        log.error("LLM Error: OpenAI API returned an API Error: %s", e)
+    except CircuitOpenError as e:
+        log.warning("LLM: Skipping OpenAI call - %s", e)
+    except asyncio.TimeoutError:
+        log.warning("LLM: OpenAI call ran out of time budget")
+    except AdmissionRejected:
+        raise
     except Exception as e:
-        print(f"LLM Error: An unexpected error occurred: {e}")
+        log.error("LLM Error: An unexpected error occurred: %s", e)
 
     return []  # Return empty list on error
 
-@app.post("/api/webhook")
+class RecommendationStreamParser:
+    """
+    Incrementally extracts recommendation objects from a streamed JSON completion
+    of the form {"recommendations": [{...}, {...}]}. Each object is returned by
+    `feed` as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.in_array = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self.buffer += text
+        objects = []
+        if not self.in_array:
+            key_at = self.buffer.find('"recommendations"')
+            bracket_at = self.buffer.find("[", key_at) if key_at != -1 else -1
+            if bracket_at == -1:
+                return objects
+            self.in_array = True
+            self.pos = bracket_at + 1
+
+        while self.pos < len(self.buffer) and not self.finished:
+            char = self.buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.object_start = self.pos
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0 and self.object_start is not None:
+                    try:
+                        parsed = json.loads(self.buffer[self.object_start:self.pos + 1])
+                        if isinstance(parsed, dict):
+                            objects.append(parsed)
+                    except json.JSONDecodeError:
+                        log.warning("LLM Error: Skipping unparsable streamed recommendation")
+                    self.object_start = None
+            elif char == "]" and self.depth == 0:
+                self.finished = True
+            self.pos += 1
+        return objects
+
+async def stream_chatgpt_recommendations(
+    preferences: Dict[str, Any],
+    history: List[Dict[str, str]],
+    max_recommendations: int = 5,
+    variant: int = 0,
+    exclude_titles: Optional[List[str]] = None
+):
+    """
+    Streaming variant of get_chatgpt_recommendations.
+    Yields each recommendation dict ('title', 'author', 'reasoning') as soon as it has
+    been fully generated, so enrichment can start before the completion finishes.
+    Cached variants are yielded straight away. Yields nothing on error.
+    """
+    client = get_openai_client()
+    if not client:  # Handle missing API key case
+        log.error("Error: OpenAI client not initialized.")
+        return
+
+    cache_key = _recommendation_cache_key(preferences, max_recommendations)
+    excluded = {_catalog_title_key(title) for title in exclude_titles or []}
+    cached_variants = await _load_recommendation_variants(cache_key)
+    cached = _pick_recommendation_variant(cached_variants, variant)
+    if cached is not None and len(_unexcluded_ideas(cached, excluded)) >= max_recommendations:
+        recommendation_cache_stats["served_cached"] += 1
+        log.debug("LLM: Serving cached recommendations (variant %s) for preferences: %s", variant, preferences)
+        for idea in _unexcluded_ideas(cached, excluded)[:max_recommendations]:
+            yield dict(idea)
+        return
+
+    log.debug("LLM: Streaming recommendations based on preferences: %s", preferences)
+    recommendation_cache_stats["generated"] += 1
+    request_size = _recommendation_request_size(max_recommendations, excluded)
+    prompt_exclusions = [idea.get("title") for ideas in cached_variants for idea in ideas if idea.get("title")]
+    prompt_exclusions += [title for title in exclude_titles or [] if title not in prompt_exclusions]
+    messages = _build_recommendation_messages(preferences, request_size, prompt_exclusions)
+    parser = RecommendationStreamParser()
+    recommendations = []
+    yielded = 0
+    stream = None
+    admitted_at = None
+
+    try:
+        admitted_at = await llm_admission.acquire("recommendations")  # Held until the stream is done
+        stream = await call_upstream(
+            openai_breaker,
+            lambda: client.chat.completions.create(
+                model="gpt-3.5-turbo-1106",  # Model with JSON mode support
+                response_format={"type": "json_object"},  # Enable JSON mode
+                messages=messages,
+                temperature=0.6,
+                max_tokens=250 * request_size,
+                n=1,
+                stop=None,
+                stream=True,
+                timeout=remaining_budget(OPENAI_TIMEOUT_SECONDS)  # Bounds each streamed read
+            ),
+            OPENAI_TIMEOUT_SECONDS
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            for recommendation in parser.feed(delta):
+                recommendations.append(recommendation)
+                if _catalog_title_key(recommendation.get("title", "")) not in excluded:
+                    yield recommendation
+                    yielded += 1
+                if yielded >= max_recommendations or len(recommendations) >= request_size:
+                    break
+            if yielded >= max_recommendations or len(recommendations) >= request_size or parser.finished:
+                break
+            if remaining_budget(OPENAI_TIMEOUT_SECONDS) <= 0:
+                # Out of budget: keep what has streamed so far, but don't cache a partial set
+                log.warning("LLM: Request deadline reached after %s streamed recommendations", len(recommendations))
+                return
+        record_openai_response("recommendations_stream")  # Streamed chunks carry no usage
+        if recommendations:
+            await _store_recommendation_variant(cache_key, [dict(idea) for idea in recommendations])
+    except openai.APIError as e:
+        record_openai_response("recommendations_stream", error=e)
+        log.error("LLM Error: OpenAI API returned an API Error: %s", e)
+    except AdmissionRejected:
+        raise
+    except CircuitOpenError as e:
+        log.warning("LLM: Skipping OpenAI call - %s", e)
+    except asyncio.TimeoutError:
+        log.warning("LLM: OpenAI call ran out of time budget")
+    except Exception as e:
+        log.error("LLM Error: An unexpected error occurred: %s", e)
+    finally:
+        if admitted_at is not None:
+            llm_admission.release(admitted_at)
+        if stream is not None:
+            await stream.close()  # Release the connection if we stopped reading early
+
+# --- Webhook Ingestion ---
+# /api/webhook only verifies the signature, parses the body once and queues its
+# events, acknowledging with 202 (or 429 while the bounded queue is full). Background
+# workers drain the queue in batches and skip event IDs they have already processed.
+# A body is one event object or a list of them; an event's ID is its "event_id"
+# field or, for single-event bodies, the X-BookGPT-Event-Id header. With Redis
+# configured, event IDs are claimed there (SET NX) so every instance shares the dedupe.
+
+webhook_stats: Dict[str, int] = {"accepted": 0, "rejected": 0, "duplicates": 0, "processed": 0, "failed": 0, "batches": 0}
+_webhook_queue: Optional[asyncio.Queue] = None  # Created on the serving loop by start_webhook_workers
+_webhook_workers: List[asyncio.Task] = []
+_webhook_seen: "OrderedDict[str, float]" = OrderedDict()  # Processed event ID -> when
+_webhook_redis = get_redis_client if CACHE_REDIS_ENABLED else None
+_webhook_redis_retry_at = 0.0
+
+def _webhook_already_seen(event_id: str, now: float) -> bool:
+    while _webhook_seen:
+        oldest_id, seen_at = next(iter(_webhook_seen.items()))
+        if now - seen_at < WEBHOOK_DEDUPE_TTL and len(_webhook_seen) <= WEBHOOK_DEDUPE_MAX_ENTRIES:
+            break
+        del _webhook_seen[oldest_id]
+    return event_id in _webhook_seen
+
+def _webhook_redis_key(event_id: str) -> str:
+    return f"bookgpt:webhook:seen:{event_id}"
+
+def _webhook_redis_failed(e: Exception):
+    global _webhook_redis_retry_at
+    log.warning("Webhooks: Redis unavailable, deduping locally for %ss - %s", CACHE_REDIS_RETRY_SECONDS, e)
+    _webhook_redis_retry_at = time.monotonic() + CACHE_REDIS_RETRY_SECONDS
+
+async def _claim_webhook_event(event_id: str, now: float) -> bool:
+    """
+    Returns False if the event ID was already processed (or is being processed by
+    another instance). Falls back to this process's memory while Redis is unreachable.
+    """
+    if _webhook_already_seen(event_id, now):
+        return False
+    if _webhook_redis is not None and time.monotonic() >= _webhook_redis_retry_at:
+        try:
+            claimed = await _webhook_redis().set(
+                _webhook_redis_key(event_id), "1", nx=True, ex=max(1, int(WEBHOOK_DEDUPE_TTL))
+            )
+            return bool(claimed)
+        except Exception as e:
+            _webhook_redis_failed(e)
+    return True
+
+async def _release_webhook_event(event_id: str):
+    """Drops the Redis claim on an event that failed, so a redelivery is processed."""
+    if _webhook_redis is not None and time.monotonic() >= _webhook_redis_retry_at:
+        try:
+            await _webhook_redis().delete(_webhook_redis_key(event_id))
+        except Exception as e:
+            _webhook_redis_failed(e)
+
+async def _handle_webhook_event(event_id: Optional[str], event: Dict[str, Any]):
+    # Add your logic to handle the webhook data here
+    log.info("Webhook received", extra={"fields": {"event_id": event_id, "type": event.get("type") or event.get("api_type")}})
+    log_payload("Webhook payload", event, level=logging.INFO, event_id=event_id)
+
+async def _process_webhook_batch(batch: List[tuple]):
+    """Processes queued (event_id, event, enqueued_at) entries, skipping duplicate IDs."""
+    started = time.perf_counter()
+    now = time.time()
+    processed = duplicates = 0
+    for event_id, event, enqueued_at in batch:
+        WEBHOOK_LATENCY.observe(started - enqueued_at, "queue_wait")
+        if event_id is not None and not await _claim_webhook_event(event_id, now):
+            duplicates += 1
+            continue
+        try:
+            await _handle_webhook_event(event_id, event)
+        except Exception as e:
+            webhook_stats["failed"] += 1
+            WEBHOOK_EVENTS.inc("failed")
+            log.error("Webhook Error: Failed to process event %s - %s", event_id, e)
+            if event_id is not None:
+                await _release_webhook_event(event_id)
+            continue
+        if event_id is not None:
+            _webhook_seen[event_id] = now  # Only once processed, so a failed event can be redelivered
+        processed += 1
+    webhook_stats["batches"] += 1
+    webhook_stats["processed"] += processed
+    webhook_stats["duplicates"] += duplicates
+    WEBHOOK_EVENTS.inc("processed", amount=processed)
+    WEBHOOK_EVENTS.inc("duplicate", amount=duplicates)
+    WEBHOOK_LATENCY.observe(time.perf_counter() - started, "batch")
+    log.debug("Webhooks: Processed %s events (%s duplicates)", processed, duplicates)
+
+async def _webhook_worker(queue: asyncio.Queue):
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < WEBHOOK_BATCH_SIZE:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        WEBHOOK_QUEUE_DEPTH.set(value=queue.qsize())
+        try:
+            await _process_webhook_batch(batch)
+        except Exception as e:
+            log.error("Webhook Error: Batch of %s events failed - %s", len(batch), e)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+def start_webhook_workers():
+    """Creates the ingestion queue and its workers on the running loop; a no-op once started."""
+    global _webhook_queue
+    if _webhook_queue is None:
+        _webhook_queue = asyncio.Queue(maxsize=max(1, WEBHOOK_QUEUE_SIZE))
+    if not _webhook_workers:
+        for _ in range(max(1, WEBHOOK_WORKERS)):
+            _webhook_workers.append(asyncio.create_task(_webhook_worker(_webhook_queue)))
+
+async def stop_webhook_workers(drain_timeout: float = WEBHOOK_DRAIN_SECONDS):
+    """Gives queued events `drain_timeout` seconds to be processed, then stops the workers."""
+    global _webhook_queue
+    queue = _webhook_queue
+    if queue is not None and _webhook_workers:
+        try:
+            await asyncio.wait_for(queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("Webhooks: Dropping %s queued events at shutdown", queue.qsize())
+    for task in _webhook_workers:
+        task.cancel()
+    await asyncio.gather(*_webhook_workers, return_exceptions=True)
+    _webhook_workers.clear()
+    _webhook_queue = None
+
+@router.post("/api/webhook", status_code=202)
 async def handle_webhook(request: Request):
     """
     Handle incoming webhook requests from WordPress.
-    Verifies the webhook signature and processes the payload.
+    Verifies the webhook signature and queues the events for background processing.
     """
     # Verify webhook signature
     webhook_secret = os.getenv("WEBHOOK_SECRET")
@@ -678,12 +4423,213 @@ async def handle_webhook(request: Request):
     if not hmac.compare_digest(expected_signature, signature):
         raise HTTPException(status_code=403, detail="Invalid webhook signature")
 
-    # Process the webhook payload
-    data = await request.json()
-    # Add your logic to handle the webhook data here
-    print(f"Webhook received: {data}")
+    # Parse the body we already hold (request.json() would decode it a second time)
+    try:
+        data = fast_json_loads(payload)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    events = data if isinstance(data, list) else [data]
+    if not all(isinstance(event, dict) for event in events):
+        raise HTTPException(status_code=400, detail="Webhook events must be JSON objects")
+
+    start_webhook_workers()  # No-op once started; covers servers run without the lifespan
+    queue = _webhook_queue
+    if queue.maxsize - queue.qsize() < len(events):
+        webhook_stats["rejected"] += len(events)
+        WEBHOOK_EVENTS.inc("rejected", amount=len(events))
+        raise HTTPException(
+            status_code=429,
+            detail="Webhook queue is full, retry later",
+            headers={"Retry-After": str(WEBHOOK_RETRY_AFTER_SECONDS)}
+        )
+    header_event_id = request.headers.get("X-BookGPT-Event-Id") if len(events) == 1 else None
+    enqueued_at = time.perf_counter()
+    for event in events:
+        event_id = event.get("event_id") or header_event_id
+        queue.put_nowait((str(event_id) if event_id is not None else None, event, enqueued_at))
+    WEBHOOK_QUEUE_DEPTH.set(value=queue.qsize())
+    webhook_stats["accepted"] += len(events)
+    WEBHOOK_EVENTS.inc("accepted", amount=len(events))
+
+    return {"status": "accepted", "events": len(events)}
+
+# --- End Webhook Ingestion ---
+
+# --- Batch Recommendation Runner ---
+# Offline pre-generation of recommendation lists (newsletters, landing pages):
+#   python main.py batch input.jsonl output.jsonl [--concurrency 8] [--max-recs 5] [--resume]
+# Each input line is a JSON object, either {"id": ..., "preferences": {...}} or a bare
+# preferences dict. Each output line is {"id", "preferences", "books"} (or "error").
+# The output file doubles as the checkpoint: with --resume, failed records are dropped
+# from it and retried, and records already in it are skipped.
+
+def _batch_record_preferences(record: Dict[str, Any]) -> Dict[str, Any]:
+    if isinstance(record.get("preferences"), dict):
+        return record["preferences"]
+    return {key: value for key, value in record.items() if key not in ("id", "max_recommendations")}
+
+def _load_batch_checkpoint(output_path: str) -> set:
+    """
+    Rewrites the output file with only its first successful result per record ID, so
+    retried records don't end up with a second line, and returns those IDs.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    kept_lines = []
+    with open(output_path, "r", encoding="utf-8") as output_file:
+        for line in output_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A partially written last line from an interrupted run
+            if not isinstance(result, dict) or "id" not in result or "error" in result:
+                continue
+            if str(result["id"]) not in completed:
+                completed.add(str(result["id"]))
+                kept_lines.append(line if line.endswith("\n") else line + "\n")
+    temp_path = f"{output_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as temp_file:
+        temp_file.writelines(kept_lines)
+    os.replace(temp_path, output_path)
+    return completed
+
+async def run_batch_recommendations(
+    input_path: str,
+    output_path: str,
+    concurrency: int = 8,
+    max_recommendations: int = 5,
+    resume: bool = False,
+    progress_every: int = 50
+) -> Dict[str, Any]:
+    """
+    Streams preference records from `input_path` through get_chatgpt_recommendations and
+    Google Books enrichment, at most `concurrency` records at a time, appending enriched
+    results to `output_path` as JSONL. Returns throughput statistics.
+    """
+    amazon_tag = os.getenv('AMAZON_ASSOCIATE_TAG', 'bookgpt-20')
+    completed = _load_batch_checkpoint(output_path) if resume else set()
+    stats = {"processed": 0, "skipped": 0, "failed": 0, "books": 0}
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    started = time.perf_counter()
+
+    def report(final: bool = False):
+        elapsed = time.perf_counter() - started
+        rate = stats["processed"] / elapsed if elapsed else 0.0
+        label = "Batch: Finished" if final else "Batch: Progress"
+        log.info(
+            "%s - processed=%d failed=%d skipped=%d books=%d elapsed=%.1fs throughput=%.2f records/s",
+            label, stats["processed"], stats["failed"], stats["skipped"], stats["books"], elapsed, rate
+        )
+
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as output_file:
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record_id, record = item
+                preferences = _batch_record_preferences(record)
+                result: Dict[str, Any] = {"id": record_id, "preferences": preferences}
+                try:
+                    ideas = await get_chatgpt_recommendations(
+                        preferences=preferences,
+                        history=[],
+                        max_recommendations=int(record.get("max_recommendations", max_recommendations))
+                    )
+                    if not ideas:  # get_chatgpt_recommendations logs the cause and returns []
+                        raise RuntimeError("No recommendation ideas were generated")
+                    books = await _enrich_recommendation_ideas(ideas, amazon_tag)
+                    if not books:
+                        raise RuntimeError("No recommended books could be resolved")
+                    result["books"] = books
+                    stats["books"] += len(books)
+                except Exception as e:
+                    log.error("Batch Error: Record %s failed - %s", record_id, e)
+                    result["error"] = str(e)
+                    stats["failed"] += 1
+                output_file.write(json.dumps(result, separators=(",", ":")) + "\n")
+                output_file.flush()  # Each written line is a checkpoint
+                stats["processed"] += 1
+                if progress_every and stats["processed"] % progress_every == 0:
+                    report()
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+        try:
+            with open(input_path, "r", encoding="utf-8") as input_file:
+                for line_number, line in enumerate(input_file, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        log.warning("Batch Error: Line %s is not valid JSON, skipping", line_number)
+                        stats["failed"] += 1
+                        continue
+                    if not isinstance(record, dict):
+                        log.warning("Batch Error: Line %s is not a JSON object, skipping", line_number)
+                        stats["failed"] += 1
+                        continue
+                    record_id = str(record.get("id", f"line-{line_number}"))
+                    if record_id in completed:
+                        stats["skipped"] += 1
+                        continue
+                    await queue.put((record_id, record))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    report(final=True)
+    elapsed = time.perf_counter() - started
+    return {**stats, "elapsed_seconds": round(elapsed, 3),
+            "records_per_second": round(stats["processed"] / elapsed, 3) if elapsed else 0.0}
 
-    return {"status": "success"}
+async def _batch_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Pre-generate enriched recommendations from a JSONL file.")
+    parser.add_argument("input", help="JSONL file of preference records")
+    parser.add_argument("output", help="JSONL file to write enriched results to")
+    parser.add_argument("--concurrency", type=int, default=8, help="Records processed at once")
+    parser.add_argument("--max-recs", type=int, default=5, help="Recommendations per record")
+    parser.add_argument("--resume", action="store_true", help="Skip records already present in the output file")
+    args = parser.parse_args(argv)
+    start_log_listener()
+    try:
+        await run_batch_recommendations(args.input, args.output, args.concurrency, args.max_recs, args.resume)
+    finally:
+        await close_http_session()
+        await _close_redis_client()
+        stop_log_listener()
+
+# --- End Batch Recommendation Runner ---
+
+def create_app() -> FastAPI:
+    """
+    Builds the FastAPI application. Cheap: upstream clients, Redis and the catalog are
+    all created on first use or by the background warm-up, never here.
+    """
+    application = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    application.add_middleware(CompressionMiddleware)
+    application.add_middleware(MetricsMiddleware)  # Outermost, so CORS preflights are timed too
+    application.include_router(router)
+    return application
+
+app = create_app()
+startup_timings["import_seconds"] = round(time.perf_counter() - _IMPORT_STARTED, 4)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8005, reload=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        asyncio.run(_batch_main(sys.argv[2:]))
+    else:
+        import uvicorn
+        uvicorn.run("main:app", host="0.0.0.0", port=8005, reload=True)
@@ -0,0 +1,57 @@
+"""
+Shared fixtures. The backend runs with in-process caches and sessions only, against
+the benchmark's local OpenAI and Google Books stubs, so no API keys or network are used.
+"""
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.update({
+    "OPENAI_API_KEY": "test-openai-key",
+    "GOOGLE_BOOKS_API_KEY": "test-google-key",
+    "CACHE_REDIS_ENABLED": "false",
+    "SESSION_STORE": "memory",
+    "PREWARM_ENABLED": "false",
+    "PREFETCH_ENABLED": "false",
+    "BOOK_CATALOG_PATH": "",
+    "THUMBNAIL_PROXY_ENABLED": "false",
+    "LOG_LEVEL": "WARNING",
+})
+
+import benchmark  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def upstream():
+    """Benchmark upstream stubs served from a background event loop."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    stubs = benchmark.UpstreamStubs(0.0, 0.0, 0.0, 0.0, 0.0)
+    url = asyncio.run_coroutine_threadsafe(stubs.start(), loop).result()
+    previous_base_url = os.environ.get("OPENAI_BASE_URL")
+    os.environ["OPENAI_BASE_URL"] = f"{url}/v1"
+    main.google_books_base_url = f"{url}/books/v1"
+    main._openai_client = None  # Rebuilt on first use against the stub
+    yield stubs
+    asyncio.run_coroutine_threadsafe(stubs.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    if previous_base_url is None:
+        os.environ.pop("OPENAI_BASE_URL", None)
+    else:
+        os.environ["OPENAI_BASE_URL"] = previous_base_url
+
+
+@pytest.fixture(scope="session")
+def client(upstream):
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as test_client:
+        yield test_client
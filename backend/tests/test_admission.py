@@ -0,0 +1,201 @@
+import asyncio
+import json
+import types
+import uuid
+
+import pytest
+
+import main
+
+
+class FakeCompletions:
+    """Stands in for client.chat.completions: one JSON recommendations payload per call."""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        ideas = [{"title": f"Book {i}", "author": f"Author {i}", "reasoning": "Fits."} for i in range(5)]
+        message = types.SimpleNamespace(content=json.dumps({"recommendations": ideas}))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    completions = FakeCompletions()
+    monkeypatch.setattr(main, "_openai_client", types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions)))
+    return completions
+
+
+async def _as_user(user_id, coroutine_factory):
+    token = main.start_llm_user(user_id)
+    try:
+        return await coroutine_factory()
+    finally:
+        main._llm_user.reset(token)
+
+
+def test_user_over_rate_is_rejected_while_others_are_admitted():
+    controller = main.AdmissionController(max_concurrency=4, calls_per_minute=60, burst=2)
+
+    async def scenario():
+        main.start_llm_user("spammer")
+        for _ in range(2):
+            controller.release(await controller.acquire("nlp"))
+        with pytest.raises(main.AdmissionRejected) as rejected:
+            await controller.acquire("nlp")
+        main.start_llm_user("innocent")
+        controller.release(await controller.acquire("nlp"))
+        return rejected.value
+
+    rejected = asyncio.run(scenario())
+    assert rejected.reason == "rate_limited"
+    assert rejected.status_code == 429
+    assert rejected.retry_after >= 1
+    assert controller.counters["rate_limited"] == 1
+    assert controller.counters["admitted"] == 3
+
+
+def test_waiting_calls_are_served_by_priority_then_round_robin_across_users():
+    controller = main.AdmissionController(max_concurrency=1, calls_per_minute=0)
+    order = []
+
+    async def call(user_id, kind, hold=0.01):
+        main.start_llm_user(user_id)
+        async with controller.slot(kind):
+            order.append((user_id, kind))
+            await asyncio.sleep(hold)
+
+    async def scenario():
+        first = asyncio.ensure_future(call("a", "recommendations", 0.05))
+        await asyncio.sleep(0)  # "a" holds the only slot; everything below queues
+        queued = [asyncio.ensure_future(call("a", "recommendations")) for _ in range(3)]
+        queued.append(asyncio.ensure_future(call("b", "recommendations")))
+        queued.append(asyncio.ensure_future(call(None, "recommendations")))
+        queued.append(asyncio.ensure_future(call("c", "nlp")))
+        await asyncio.gather(first, *queued)
+
+    asyncio.run(scenario())
+    assert order == [
+        ("a", "recommendations"),
+        ("c", "nlp"),  # Cheap turns first
+        ("a", "recommendations"),
+        ("b", "recommendations"),  # Not behind all of "a"'s backlog
+        ("a", "recommendations"),
+        ("a", "recommendations"),
+        (None, "recommendations"),  # Background work last
+    ]
+
+
+def test_call_that_cannot_be_served_in_time_is_shed_immediately():
+    controller = main.AdmissionController(max_concurrency=1, calls_per_minute=0)
+    controller._service_ewma = 5.0
+
+    async def scenario():
+        main.start_request_deadline(2.0)
+        main.start_llm_user("someone")
+        held = await controller.acquire("nlp")
+        with pytest.raises(main.AdmissionRejected) as rejected:
+            await controller.acquire("nlp")
+        controller.release(held)
+        return rejected.value
+
+    rejected = asyncio.run(scenario())
+    assert (rejected.reason, rejected.status_code) == ("deadline", 503)
+    assert controller.stats()["waiting"] == 0
+    assert controller.active == 0
+
+
+def test_call_that_times_out_in_the_queue_gets_its_tokens_back():
+    controller = main.AdmissionController(max_concurrency=1, calls_per_minute=60, burst=2)
+
+    async def scenario():
+        main.start_llm_user("holder")
+        held = await controller.acquire("nlp")
+        main.start_request_deadline(main.UPSTREAM_MIN_BUDGET_SECONDS + 0.05)
+        main.start_llm_user("queued")
+        with pytest.raises(main.AdmissionRejected) as rejected:
+            await controller.acquire("recommendations")
+        controller.release(held)
+        return rejected.value
+
+    rejected = asyncio.run(scenario())
+    assert rejected.reason == "deadline"
+    assert controller.counters["queued"] == 1
+    assert controller._buckets["queued"][0] == pytest.approx(2, abs=0.1)  # Nothing ran, nothing charged
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    controller = main.AdmissionController(max_concurrency=1, calls_per_minute=0)
+
+    async def scenario():
+        main.start_llm_user("someone")
+        held = await controller.acquire("nlp")
+        abandoned = asyncio.ensure_future(controller.acquire("nlp"))
+        next_in_line = asyncio.ensure_future(controller.acquire("nlp"))
+        await asyncio.sleep(0)
+        abandoned.cancel()
+        controller.release(held)
+        controller.release(await asyncio.wait_for(next_in_line, 1.0))
+
+    asyncio.run(scenario())
+    assert controller.active == 0
+    assert controller.stats()["waiting"] == 0
+
+
+def test_rate_limited_user_does_not_fail_a_shared_recommendation_call(monkeypatch, fake_openai):
+    controller = main.AdmissionController(max_concurrency=4, calls_per_minute=1, burst=2)
+    monkeypatch.setattr(main, "llm_admission", controller)
+    preferences = {"genre": f"shared-{uuid.uuid4()}"}
+
+    async def recommendations():
+        return await main.get_chatgpt_recommendations(preferences, [], 5)
+
+    async def scenario():
+        main.start_request_deadline()
+        main.start_llm_user("spammer")
+        controller.charge("recommendations")  # Drains the spammer's bucket
+        return await asyncio.gather(
+            _as_user("spammer", recommendations),
+            _as_user("innocent", recommendations),
+            return_exceptions=True
+        )
+
+    spammer, innocent = asyncio.run(scenario())
+    assert isinstance(spammer, main.AdmissionRejected) and spammer.status_code == 429
+    assert [idea["title"] for idea in innocent] == [f"Book {i}" for i in range(5)]
+    assert fake_openai.calls == 1
+
+
+def test_coalesced_recommendation_callers_are_each_charged(monkeypatch, fake_openai):
+    controller = main.AdmissionController(max_concurrency=4, calls_per_minute=1, burst=4)
+    monkeypatch.setattr(main, "llm_admission", controller)
+    preferences = {"genre": f"charged-{uuid.uuid4()}"}
+
+    async def recommendations():
+        return await main.get_chatgpt_recommendations(preferences, [], 5)
+
+    async def scenario():
+        main.start_request_deadline()
+        await asyncio.gather(_as_user("first", recommendations), _as_user("second", recommendations))
+
+    asyncio.run(scenario())
+    assert fake_openai.calls == 1
+    assert controller._buckets["first"][0] == pytest.approx(2, abs=0.1)
+    assert controller._buckets["second"][0] == pytest.approx(2, abs=0.1)
+
+
+def test_chat_returns_429_with_retry_after_when_user_is_over_rate(client, monkeypatch):
+    controller = main.AdmissionController(calls_per_minute=1, burst=1)
+    monkeypatch.setattr(main, "llm_admission", controller)
+
+    response = client.post("/api/chat", json={
+        "user_id": f"limited-{uuid.uuid4()}",
+        "message": "something thoughtful about grief and rebuilding after loss"
+    })
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import main
+
+
+def _write_records(path, ids):
+    path.write_text("".join(json.dumps({"id": record_id, "genre": record_id}) + "\n" for record_id in ids))
+
+
+def _read_results(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_failed_records_are_reported_and_retried_on_resume(tmp_path, monkeypatch):
+    failing = {"b"}
+
+    async def fake_recommendations(preferences, history, max_recommendations=5, variant=0, exclude_titles=None):
+        if preferences["genre"] in failing:
+            return []  # What get_chatgpt_recommendations returns on an OpenAI error
+        return [{"title": f"{preferences['genre']} book", "author": "Someone", "reasoning": "Fits."}]
+
+    async def fake_enrich(ideas, amazon_tag, on_book=None):
+        return [{"title": idea["title"], "author": idea["author"]} for idea in ideas]
+
+    monkeypatch.setattr(main, "get_chatgpt_recommendations", fake_recommendations)
+    monkeypatch.setattr(main, "_enrich_recommendation_ideas", fake_enrich)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_records(input_path, ["a", "b", "c"])
+
+    stats = asyncio.run(main.run_batch_recommendations(str(input_path), str(output_path), concurrency=2, progress_every=0))
+
+    assert (stats["processed"], stats["failed"]) == (3, 1)
+    results = {result["id"]: result for result in _read_results(output_path)}
+    assert "error" in results["b"] and "books" not in results["b"]
+    assert main._load_batch_checkpoint(str(output_path)) == {"a", "c"}
+
+    failing.clear()
+    stats = asyncio.run(main.run_batch_recommendations(
+        str(input_path), str(output_path), concurrency=2, resume=True, progress_every=0
+    ))
+
+    assert (stats["processed"], stats["skipped"], stats["failed"]) == (1, 2, 0)
+    results = _read_results(output_path)
+    assert sorted(result["id"] for result in results) == ["a", "b", "c"]
+    assert all("error" not in result for result in results)
@@ -0,0 +1,65 @@
+import uuid
+
+import main
+
+BOOK = {
+    "id": "v1", "title": "Dune", "authors": ["Frank Herbert"], "description": "Spice.",
+    "thumbnail": "http://books.google.com/books/content?id=v1", "isbn13": "9780441013593"
+}
+
+
+def test_fields_projection_keeps_id_and_etag():
+    fields = main.parse_book_fields(" title, nonsense ,")
+
+    shaped = main.shape_book(BOOK, fields)
+
+    assert shaped == {"id": "v1", "title": "Dune", "etag": main.book_etag(BOOK)}
+    assert main.parse_book_fields("") is None
+    assert set(main.shape_book(BOOK)) == set(BOOK) | {"etag"}
+
+
+def test_etag_follows_the_content_not_the_key_order():
+    reordered = dict(reversed(list(BOOK.items())))
+
+    assert main.book_etag(reordered) == main.book_etag(BOOK)
+    assert main.book_etag({**BOOK, "description": "Revised."}) != main.book_etag(BOOK)
+
+
+def test_books_the_client_holds_shrink_to_stubs():
+    etag = main.book_etag(BOOK)
+    stub = {"id": "v1", "etag": etag, "unchanged": True}
+
+    assert main.shape_book(BOOK, known={"v1"}) == stub
+    assert main.shape_book(BOOK, known={etag}) == stub
+    assert main.shape_book(BOOK, known={"other"})["title"] == "Dune"
+
+
+def test_proxied_thumbnail_points_at_our_endpoint():
+    shaped = main.shape_book(BOOK, thumbnail_base="https://api.example")
+
+    assert shaped["thumbnail"].startswith("https://api.example/api/thumbnail?src=http%3A%2F%2Fbooks.google.com")
+    assert shaped["etag"] == main.book_etag(BOOK)  # The ETag is of the data, not the rewritten URL
+
+
+def _recommend(client, known_books=(), params=None):
+    user_id = f"shape-{uuid.uuid4()}"
+    assert client.post("/api/chat", json={"user_id": user_id, "message": "hello"}).status_code == 200
+    response = client.post(
+        "/api/chat", params=params,
+        json={"user_id": user_id, "message": "Suggest Science Fiction Books", "known_books": list(known_books)}
+    )
+    assert response.status_code == 200
+    return response.json()["books"]
+
+
+def test_chat_endpoint_sends_only_what_the_client_is_missing(client):
+    full = _recommend(client, params={"fields": "title"})
+    assert full and all(set(book) == {"id", "title", "etag"} for book in full)
+
+    held = [full[0]["id"], full[1]["etag"]]
+    delta = _recommend(client, known_books=held)
+
+    assert [book["id"] for book in delta] == [book["id"] for book in full]
+    assert delta[0] == {"id": full[0]["id"], "etag": full[0]["etag"], "unchanged": True}
+    assert delta[1] == {"id": full[1]["id"], "etag": full[1]["etag"], "unchanged": True}
+    assert all("title" in book and "unchanged" not in book for book in delta[2:])
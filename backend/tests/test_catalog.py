@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import main
+
+DUNE = {"id": "catalog-dune-1", "title": "Dune", "authors": ["Frank Herbert"], "description": "Spice."}
+
+
+def test_catalogued_volume_is_served_without_calling_google(tmp_path, monkeypatch):
+    catalog = main.BookCatalog(str(tmp_path / "catalog.db"))
+    asyncio.run(catalog.add(DUNE))
+    monkeypatch.setattr(main, "book_catalog", catalog)
+    upstream_calls = []
+
+    async def no_upstream(url, params, call):
+        upstream_calls.append(url)
+        raise AssertionError("Google Books should not be called")
+
+    monkeypatch.setattr(main, "_google_books_get", no_upstream)
+
+    details = asyncio.run(main.get_book_details_by_id(DUNE["id"]))
+    cached = asyncio.run(main.google_books_volume_cache.get(DUNE["id"]))
+
+    assert details["title"] == "Dune"
+    assert upstream_calls == []
+    assert cached is not main._CACHE_MISS and cached["id"] == DUNE["id"]
+
+
+def test_stale_catalog_entry_is_only_a_fallback(tmp_path):
+    catalog = main.BookCatalog(str(tmp_path / "catalog.db"), max_age=0)
+    asyncio.run(catalog.add(DUNE))
+
+    assert catalog.get(DUNE["id"], allow_stale=False) is None
+    assert catalog.get(DUNE["id"])["title"] == "Dune"
+
+
+def test_catalog_writes_run_off_the_event_loop(tmp_path, monkeypatch):
+    catalog = main.BookCatalog(str(tmp_path / "catalog.db"))
+    threads = []
+    real_add = catalog._add
+
+    def recording_add(details):
+        threads.append(threading.get_ident())
+        real_add(details)
+
+    monkeypatch.setattr(catalog, "_add", recording_add)
+
+    async def scenario():
+        await catalog.add(DUNE)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+
+    assert threads and threads[0] != loop_thread
+    assert catalog.get(DUNE["id"])["title"] == "Dune"
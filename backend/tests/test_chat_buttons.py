@@ -0,0 +1,42 @@
+import uuid
+
+import pytest
+
+import main
+
+GREETING_BUTTONS = [
+    "Suggest Fantasy Books",
+    "Recommend Sci-Fi",
+    "Books like The Hobbit",
+    "Mystery Novels",
+    "Contemporary Fiction",
+    "Bestsellers This Year",
+    "Historical Fiction",
+    "Books by Female Authors",
+]
+
+
+def test_greeting_offers_the_known_buttons(client):
+    response = client.post("/api/chat", json={"user_id": f"greet-{uuid.uuid4()}", "message": "hi"})
+    assert response.status_code == 200
+    assert response.json()["suggestions"] == GREETING_BUTTONS
+    for button in GREETING_BUTTONS:
+        assert main._normalize_button_text(button) in main.SUGGESTION_BUTTON_ENTITIES
+
+
+@pytest.mark.parametrize("button", GREETING_BUTTONS)
+def test_greeting_button_returns_recommendations(client, button):
+    user_id = f"button-{uuid.uuid4()}"
+    assert client.post("/api/chat", json={"user_id": user_id, "message": "hello"}).status_code == 200
+
+    response = client.post("/api/chat", json={"user_id": user_id, "message": button})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["books"], body["bot_message"]
+    assert "tell me a bit more" not in body["bot_message"]
+
+
+def test_button_entities_alone_would_be_judged_vague():
+    # The reason buttons bypass the vagueness check: their entities aren't ones it counts
+    assert main._is_vague_request("Bestsellers This Year", {"category": "Bestsellers"})
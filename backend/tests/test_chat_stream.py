@@ -0,0 +1,45 @@
+import json
+import uuid
+
+import main
+
+IDEAS = [{"title": f"Stream Book {i}", "author": "Someone", "reasoning": "Fits."} for i in range(5)]
+UNRESOLVABLE = {"Stream Book 1", "Stream Book 3"}
+
+
+def _events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_streamed_book_indexes_are_positions_in_the_final_list(client, monkeypatch):
+    async def streamed_ideas(preferences, history, max_recommendations=5, variant=0, exclude_titles=None):
+        for idea in IDEAS:
+            yield dict(idea)
+
+    async def resolve(title, author=None):
+        if title in UNRESOLVABLE:
+            return None
+        return {"id": title.replace(" ", "-").lower(), "title": title, "authors": [author], "isbn13": None}
+
+    monkeypatch.setattr(main, "stream_chatgpt_recommendations", streamed_ideas)
+    monkeypatch.setattr(main, "resolve_google_book", resolve)
+    user_id = f"stream-{uuid.uuid4()}"
+    assert client.post("/api/chat", json={"user_id": user_id, "message": "hello"}).status_code == 200
+
+    response = client.post("/api/chat/stream", json={"user_id": user_id, "message": "Suggest Fantasy Books"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _events(response.text)
+    names = [name for name, _ in events]
+    assert names[-1] == "done" and "error" not in names
+    books = [data for name, data in events if name == "book"]
+    final = events[-1][1]["books"]
+    assert [book["index"] for book in books] == list(range(len(final))) == [0, 1, 2]
+    for event in books:
+        assert final[event["index"]]["id"] == event["book"]["id"]
+    assert {book["title"] for book in final} == {"Stream Book 0", "Stream Book 2", "Stream Book 4"}
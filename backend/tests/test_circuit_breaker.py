@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import main
+
+
+def _breaker(threshold=3, reset=60.0):
+    return main.CircuitBreaker("test", failure_threshold=threshold, reset_seconds=reset)
+
+
+def _expire(breaker):
+    breaker.opened_at = time.monotonic() - breaker.reset_seconds - 1
+
+
+def test_opens_after_consecutive_failures_and_fails_fast():
+    breaker = _breaker()
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats()["rejected"] == 1
+    assert breaker.stats()["times_opened"] == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    _expire(breaker)
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # Only one probe at a time
+
+
+def test_probe_success_closes_and_probe_failure_reopens():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    _expire(breaker)
+    breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.stats()["times_opened"] == 2
+
+    _expire(breaker)
+    breaker.allow()
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_released_probe_lets_the_next_call_probe():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    _expire(breaker)
+    breaker.allow()
+
+    breaker.release_probe()  # Probe cancelled before it had an outcome
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def _slow_attempts(started):
+    async def attempt():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+    return attempt
+
+
+def test_slow_call_is_hedged_while_closed():
+    started = []
+
+    result = asyncio.run(main._hedged(_breaker(), _slow_attempts(started), budget=2.0, hedge_delay=0.01))
+
+    assert result == "ok"
+    assert len(started) == 2
+
+
+def test_half_open_probe_is_not_hedged():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    _expire(breaker)
+    assert breaker.allow()
+    started = []
+
+    asyncio.run(main._hedged(breaker, _slow_attempts(started), budget=2.0, hedge_delay=0.01))
+
+    assert len(started) == 1
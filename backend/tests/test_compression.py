@@ -0,0 +1,36 @@
+import types
+
+import pytest
+
+import main
+
+FAKE_BROTLI = types.SimpleNamespace(compress=lambda body, quality=None: b"br:" + body)
+
+
+@pytest.mark.parametrize("header, with_brotli, expected", [
+    ("gzip, deflate, br", True, "br"),
+    ("gzip, deflate, br", False, "gzip"),
+    ("br;q=0, gzip", True, "gzip"),
+    ("gzip;q=0.5, br;q=0.8", True, "br"),
+    ("gzip;q=1.0, br;q=0.8", True, "gzip"),
+    ("BR;Q=0.9", True, "br"),
+    ("*", True, "br"),
+    ("*;q=0.3, br;q=0", True, "gzip"),
+    ("gzip;q=0", True, None),
+    ("identity", True, None),
+    ("gzip;q=abc", True, None),
+    ("", True, None),
+])
+def test_negotiates_the_best_accepted_coding(monkeypatch, header, with_brotli, expected):
+    monkeypatch.setattr(main, "brotli", FAKE_BROTLI if with_brotli else None)
+
+    assert main.negotiate_encoding(header) == expected
+
+
+def test_client_refusing_brotli_gets_gzip(client, monkeypatch):
+    monkeypatch.setattr(main, "brotli", FAKE_BROTLI)
+
+    response = client.get("/api/cache/stats", headers={"Accept-Encoding": "br;q=0, gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()  # httpx decoded the gzip body
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import main
+
+IDEAS = [{"title": f"Book {i}", "author": "Someone", "reasoning": "Fits."} for i in range(3)]
+
+
+def test_batch_resolve_is_bounded_by_the_enrichment_deadline(monkeypatch):
+    async def slow_batch(ideas):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(main, "GB_BATCH_RESOLVE", True)
+    monkeypatch.setattr(main, "_prefetch_idea_details", slow_batch)
+
+    started = time.perf_counter()
+    books = asyncio.run(main._enrich_recommendation_ideas(list(IDEAS), "tag", deadline=0.1))
+
+    assert books == []
+    assert time.perf_counter() - started < 1.0
+
+
+def test_failed_batch_resolve_falls_back_to_single_lookups(monkeypatch):
+    async def failing_batch(ideas):
+        raise RuntimeError("batch unavailable")
+
+    async def resolve(title, author=None):
+        return {"id": title, "title": title}
+
+    monkeypatch.setattr(main, "GB_BATCH_RESOLVE", True)
+    monkeypatch.setattr(main, "_prefetch_idea_details", failing_batch)
+    monkeypatch.setattr(main, "resolve_google_book", resolve)
+
+    books = asyncio.run(main._enrich_recommendation_ideas(list(IDEAS), "tag", deadline=1.0))
+
+    assert [book["title"] for book in books] == ["Book 0", "Book 1", "Book 2"]
+
+
+def test_ideas_resolve_concurrently_within_the_limit_and_keep_their_order(monkeypatch):
+    running = [0, 0]  # Now, peak
+    delays = [0.06, 0.01, 0.03, 0.02, 0.04]
+
+    async def resolve(title, author=None):
+        running[0] += 1
+        running[1] = max(running[1], running[0])
+        await asyncio.sleep(delays[int(title.split()[-1])])
+        running[0] -= 1
+        return {"id": title, "title": title, "isbn13": "9780000000001"}
+
+    monkeypatch.setattr(main, "GB_BATCH_RESOLVE", False)
+    monkeypatch.setattr(main, "resolve_google_book", resolve)
+    ideas = [{"title": f"Book {i}", "author": "Someone", "reasoning": f"Reason {i}"} for i in range(5)]
+
+    started = time.perf_counter()
+    books = asyncio.run(main._enrich_recommendation_ideas(ideas, "tag-20", concurrency=3, deadline=2.0))
+
+    assert [book["title"] for book in books] == [f"Book {i}" for i in range(5)]
+    assert running[1] == 3
+    assert time.perf_counter() - started < sum(delays)
+    assert books[2]["reasoning"] == "Reason 2"
+    assert books[0]["amazon_link"] == "https://www.amazon.com/s?k=9780000000001&tag=tag-20"
+
+
+def test_ideas_still_unresolved_at_the_deadline_are_dropped(monkeypatch):
+    async def resolve(title, author=None):
+        if title == "Book 1":
+            await asyncio.sleep(5)
+        return {"id": title, "title": title}
+
+    monkeypatch.setattr(main, "GB_BATCH_RESOLVE", False)
+    monkeypatch.setattr(main, "resolve_google_book", resolve)
+
+    started = time.perf_counter()
+    books = asyncio.run(main._enrich_recommendation_ideas(list(IDEAS), "tag", deadline=0.1))
+
+    assert [book["title"] for book in books] == ["Book 0", "Book 2"]
+    assert time.perf_counter() - started < 1.0
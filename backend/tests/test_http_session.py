@@ -0,0 +1,52 @@
+import asyncio
+
+import main
+
+
+def test_shared_session_is_reused_until_closed(monkeypatch):
+    monkeypatch.setattr(main, "http_session", None)  # Not the one the test client's lifespan opened
+
+    async def scenario():
+        first = main.get_http_session()
+        again = main.get_http_session()
+        await main.close_http_session()
+        reopened = main.get_http_session()
+        await main.close_http_session()
+        return first, again, reopened
+
+    first, again, reopened = asyncio.run(scenario())
+
+    assert first is again
+    assert first.closed and reopened is not first
+    assert main.http_session is None
+
+
+def test_session_pools_connections_as_configured(monkeypatch):
+    monkeypatch.setattr(main, "http_session", None)
+    monkeypatch.setattr(main, "HTTP_POOL_LIMIT", 7)
+    monkeypatch.setattr(main, "HTTP_POOL_LIMIT_PER_HOST", 3)
+
+    async def scenario():
+        session = main.get_http_session()
+        try:
+            return session.connector.limit, session.connector.limit_per_host, session.connector.use_dns_cache
+        finally:
+            await main.close_http_session()
+
+    assert asyncio.run(scenario()) == (7, 3, True)
+
+
+def test_chat_turns_reuse_the_lifespan_session(client, monkeypatch):
+    session = main.http_session
+    assert session is not None and not session.closed
+
+    def no_new_session():
+        raise AssertionError("a chat turn opened its own HTTP session")
+
+    monkeypatch.setattr(main, "_create_http_session", no_new_session)
+    for message in ("hello", "Suggest Fantasy Books"):
+        response = client.post("/api/chat", json={"user_id": "http-session", "message": message})
+        assert response.status_code == 200
+
+    assert response.json()["books"]
+    assert main.http_session is session
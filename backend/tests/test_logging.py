@@ -0,0 +1,59 @@
+import logging
+import os
+import queue
+import subprocess
+import sys
+
+import main
+
+LIFESPAN = """
+import threading
+from fastapi.testclient import TestClient
+import main
+print(threading.active_count())
+with TestClient(main.app):
+    print(main._log_listener is not None)
+print(main._log_listener is None)
+"""
+
+
+def _run(code):
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(main.__file__),
+        env=dict(os.environ), capture_output=True, text=True, timeout=60
+    )
+    return [line for line in result.stdout.splitlines() if not line.startswith("{")], result.stderr
+
+
+def test_import_starts_no_threads_and_the_lifespan_runs_the_log_listener():
+    output, stderr = _run(LIFESPAN)
+
+    assert output == ["1", "True", "True"], stderr
+
+
+def _record(msg, *args):
+    return logging.LogRecord("bookgpt", logging.INFO, __file__, 1, msg, args, None)
+
+
+def test_full_queue_drops_the_record_without_blocking(monkeypatch):
+    monkeypatch.setitem(main.log_stats, "dropped", 0)
+    handler = main.DroppingQueueHandler(queue.Queue(maxsize=1))
+
+    handler.handle(_record("kept"))
+    handler.handle(_record("dropped"))
+
+    assert handler.queue.qsize() == 1
+    assert handler.queue.get_nowait().getMessage() == "kept"
+    assert main.log_stats["dropped"] == 1
+
+
+def test_queued_arguments_are_snapshotted_redacted_and_truncated(monkeypatch):
+    monkeypatch.setattr(main, "LOG_MAX_FIELD_CHARS", 10)
+    handler = main.DroppingQueueHandler(queue.Queue())
+    payload = {"api_key": "sk-secret", "note": "x" * 25}
+
+    handler.handle(_record("payload %s %d", payload, 3))
+    payload["note"] = "changed"  # Later mutation must not reach the queued record
+
+    record = handler.queue.get_nowait()
+    assert record.args == ({"api_key": "[redacted]", "note": "xxxxxxxxxx...(+15 chars)"}, 3)
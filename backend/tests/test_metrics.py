@@ -0,0 +1,50 @@
+import main
+
+
+def test_registry_renders_prometheus_text():
+    registry = main.MetricsRegistry()
+    requests = registry.register(main.Counter("app_requests_total", "Requests.", ("route",)))
+    latency = registry.register(main.Histogram("app_latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0)))
+    requests.inc('/a"b', amount=2)
+    latency.observe(0.05, "/x")
+    latency.observe(0.5, "/x")
+    latency.observe(3.0, "/x")
+
+    lines = registry.render().splitlines()
+
+    assert lines[:3] == [
+        "# HELP app_requests_total Requests.",
+        "# TYPE app_requests_total counter",
+        'app_requests_total{route="/a\\"b"} 2.0',
+    ]
+    assert lines[3:] == [
+        "# HELP app_latency_seconds Latency.",
+        "# TYPE app_latency_seconds histogram",
+        'app_latency_seconds_bucket{route="/x",le="0.1"} 1',
+        'app_latency_seconds_bucket{route="/x",le="1.0"} 2',
+        'app_latency_seconds_bucket{route="/x",le="+Inf"} 3',
+        'app_latency_seconds_sum{route="/x"} 3.55',
+        'app_latency_seconds_count{route="/x"} 3',
+    ]
+
+
+def test_collectors_fill_gauges_at_scrape_time_and_a_failing_one_is_skipped():
+    registry = main.MetricsRegistry()
+    queued = registry.register(main.Gauge("app_queued", "Queued items."))
+
+    def broken():
+        raise RuntimeError("stats unavailable")
+        yield
+
+    registry.collectors.extend([broken, lambda: [(queued, (), 7)]])
+
+    assert "app_queued 7\n" in registry.render()
+
+
+def test_metrics_endpoint_serves_the_text_format(client):
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE bookgpt_stage_duration_seconds histogram" in response.text
+    assert 'bookgpt_component_stat{component="logging",stat="dropped"}' in response.text
@@ -0,0 +1,52 @@
+import asyncio
+
+import main
+
+MESSAGE = "I want a slow burning gothic mystery set on the moors"
+
+
+def test_speculative_call_uses_the_sessions_variant_and_seen_titles(monkeypatch):
+    calls = []
+
+    async def fake_recommendations(preferences, history, max_recommendations=5, variant=0, exclude_titles=None):
+        calls.append((preferences, variant, exclude_titles))
+        return [{"title": "Rebecca", "author": "Daphne du Maurier", "reasoning": "Gothic."}]
+
+    async def fake_nlp(text, current_stage):
+        return {"intent": "REQUEST_RECOMMENDATION", "entities": {}, "refined_message": text}
+
+    monkeypatch.setattr(main, "NLP_PIPELINE_MODE", "speculative")
+    monkeypatch.setattr(main, "get_chatgpt_recommendations", fake_recommendations)
+    monkeypatch.setattr(main, "process_nlp", fake_nlp)
+    seen = main.SeenSet()
+    seen.add_book({"id": "v1", "title": "Jane Eyre", "authors": ["Charlotte Bronte"]})
+    served = {main.recommendation_preferences_key({"raw_query": MESSAGE}): 2}
+
+    async def scenario():
+        _, pending = await main._analyze_message(MESSAGE, "AWAITING_PREFERENCES", [], 5, served, seen)
+        return pending, await pending.take()
+
+    pending, ideas = asyncio.run(scenario())
+
+    assert calls == [({"raw_query": MESSAGE}, 2, ["Jane Eyre"])]
+    assert pending.variant == 2
+    assert ideas[0]["title"] == "Rebecca"
+
+
+def test_pending_ideas_for_another_variant_are_discarded(monkeypatch):
+    fetched = []
+
+    async def fake_recommendations(preferences, history, max_recommendations=5, variant=0, exclude_titles=None):
+        fetched.append(variant)
+        return []
+
+    monkeypatch.setattr(main, "get_chatgpt_recommendations", fake_recommendations)
+    pending = main.PendingRecommendations("fused", ideas=[{"title": "Already Shown", "author": "A"}])
+
+    books = asyncio.run(main._fetch_and_process_recommendations(
+        {"genre": "Gothic"}, [], 5, "tag", pending=pending, variant=1
+    ))
+
+    assert books == []
+    assert fetched == [1]  # Fetched for the variant the turn asked for instead
+    assert pending.settled
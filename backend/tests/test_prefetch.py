@@ -0,0 +1,114 @@
+import asyncio
+import uuid
+
+import main
+
+
+def _showing_state():
+    return {
+        "history": [{"role": "user", "content": "gothic mysteries"}],
+        "stage": "SHOWING_RECOMMENDATIONS",
+        "details": {"nlp_entities": {"genre": "Gothic"}},
+    }
+
+
+def test_prefetch_is_off_unless_enabled(monkeypatch):
+    monkeypatch.setattr(main, "PREFETCH_ENABLED", False)
+
+    async def scenario():
+        main.start_page_prefetch("prefetch-off", _showing_state())
+        return "prefetch-off" in main._page_prefetches
+
+    assert asyncio.run(scenario()) is False
+
+
+def test_prefetch_only_runs_for_the_sampled_share_of_pages(monkeypatch):
+    monkeypatch.setattr(main, "PREFETCH_ENABLED", True)
+    monkeypatch.setattr(main, "PREFETCH_SAMPLE_RATE", 0.0)
+    sampled_out = main.prefetch_stats["sampled_out"]
+
+    async def scenario():
+        main.start_page_prefetch("prefetch-sampled", _showing_state())
+        return "prefetch-sampled" in main._page_prefetches
+
+    assert asyncio.run(scenario()) is False
+    assert main.prefetch_stats["sampled_out"] == sampled_out + 1
+
+
+PAGE = [{"id": "next-1", "title": "Prefetched Book", "authors": ["Someone"]}]
+
+
+def _enable_prefetch(monkeypatch, page_fetch):
+    monkeypatch.setattr(main, "PREFETCH_ENABLED", True)
+    monkeypatch.setattr(main, "PREFETCH_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(main, "_prefetch_page", page_fetch)
+
+
+def test_next_page_is_taken_once_for_matching_preferences(monkeypatch):
+    requested = []
+
+    async def page_fetch(preferences, history, variant, seen, amazon_tag):
+        requested.append(variant)
+        return PAGE
+
+    _enable_prefetch(monkeypatch, page_fetch)
+    preferences = _showing_state()["details"]["nlp_entities"]
+
+    async def scenario():
+        main.start_page_prefetch("prefetch-take", _showing_state())
+        return [await main.take_page_prefetch("prefetch-take", preferences) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [PAGE, None]
+    assert requested == [0]
+
+
+def test_page_for_other_preferences_is_discarded(monkeypatch):
+    async def page_fetch(preferences, history, variant, seen, amazon_tag):
+        await asyncio.sleep(1)
+        return PAGE
+
+    _enable_prefetch(monkeypatch, page_fetch)
+    expired = main.prefetch_stats["expired"]
+
+    async def scenario():
+        main.start_page_prefetch("prefetch-mismatch", _showing_state())
+        task = main._page_prefetches["prefetch-mismatch"]["task"]
+        taken = await main.take_page_prefetch("prefetch-mismatch", {"genre": "Romance"})
+        await asyncio.sleep(0)
+        return taken, task.cancelled()
+
+    assert asyncio.run(scenario()) == (None, True)
+    assert main.prefetch_stats["expired"] == expired + 1
+
+
+def test_start_over_cancels_the_pending_page(client, monkeypatch):
+    async def page_fetch(preferences, history, variant, seen, amazon_tag):
+        await asyncio.sleep(30)
+        return PAGE
+
+    _enable_prefetch(monkeypatch, page_fetch)
+    user_id = f"prefetch-{uuid.uuid4()}"
+    for message in ("hello", "Suggest Fantasy Books"):
+        assert client.post("/api/chat", json={"user_id": user_id, "message": message}).status_code == 200
+    assert user_id in main._page_prefetches
+    task = main._page_prefetches[user_id]["task"]
+
+    response = client.post("/api/chat", json={"user_id": user_id, "message": "Start Over"})
+
+    assert response.status_code == 200
+    assert user_id not in main._page_prefetches
+    assert task.cancelling() or task.cancelled()
+
+
+def test_show_different_is_answered_from_the_prefetched_page(client, monkeypatch):
+    async def page_fetch(preferences, history, variant, seen, amazon_tag):
+        return PAGE
+
+    _enable_prefetch(monkeypatch, page_fetch)
+    user_id = f"prefetch-{uuid.uuid4()}"
+    for message in ("hello", "Suggest Fantasy Books"):
+        assert client.post("/api/chat", json={"user_id": user_id, "message": message}).status_code == 200
+
+    response = client.post("/api/chat", json={"user_id": user_id, "message": "Show different recommendations"})
+
+    assert [book["id"] for book in response.json()["books"]] == ["next-1"]
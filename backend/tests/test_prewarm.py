@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+
+
+def test_stale_hit_refresh_runs_outside_the_triggering_turn(monkeypatch):
+    observed = {}
+
+    async def fake_recommendations(preferences, history, max_recommendations=5, variant=0, exclude_titles=None):
+        observed["user"] = main._llm_user.get()
+        observed["budget"] = main.remaining_budget(1000)
+        return [{"title": "Dune", "author": "Frank Herbert"}]
+
+    async def fake_enrich(ideas, amazon_tag, on_book=None):
+        return [{"id": "dune", "title": "Dune"}]
+
+    monkeypatch.setattr(main, "get_chatgpt_recommendations", fake_recommendations)
+    monkeypatch.setattr(main, "_enrich_recommendation_ideas", fake_enrich)
+    entities = {"genre": "Prewarm Test"}
+
+    async def scenario():
+        main.start_request_deadline(0.01)  # A turn that is almost out of time
+        main.start_llm_user("stale-hit-user")
+        main._revalidate_prewarmed(entities)
+        await asyncio.gather(*main._prewarm_background)
+
+    asyncio.run(scenario())
+
+    assert observed["user"] is None
+    assert observed["budget"] > 1.0
+    assert main.prewarmed_results[main.recommendation_preferences_key(entities)]["books"][0]["title"] == "Dune"
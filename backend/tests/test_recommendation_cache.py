@@ -0,0 +1,75 @@
+import asyncio
+import json
+import types
+import uuid
+
+import pytest
+
+import main
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        ideas = [{"title": f"Call {self.calls} Book {i}", "author": "A", "reasoning": "Fits."} for i in range(5)]
+        message = types.SimpleNamespace(content=json.dumps({"recommendations": ideas}))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(main, "_openai_client", types.SimpleNamespace(chat=types.SimpleNamespace(completions=fake)))
+    return fake
+
+
+def test_equivalent_preferences_share_a_key():
+    assert main.recommendation_preferences_key({"Genre": " Fantasy  ", "Liked-Book": "The Hobbit"}) == \
+        main.recommendation_preferences_key({"liked_book": "the   hobbit", "genre": "fantasy"})
+    assert main.recommendation_preferences_key({"genre": "fantasy"}) != \
+        main.recommendation_preferences_key({"genre": "sci-fi"})
+    assert main.canonicalize_preferences({"Moods": ["Dark", " Cozy "]}) == {"moods": ["dark", "cozy"]}
+
+
+def test_variants_are_generated_until_the_slots_are_full_then_cycle(monkeypatch):
+    monkeypatch.setattr(main, "REC_CACHE_VARIANTS", 2)
+    variants = [["first"], ["second"]]
+
+    assert main._pick_recommendation_variant([], 0) is None
+    assert main._pick_recommendation_variant(variants[:1], 0) == ["first"]
+    assert main._pick_recommendation_variant(variants[:1], 1) is None  # Room for a new one
+    assert main._pick_recommendation_variant(variants, 3) == ["second"]
+
+
+def test_session_variant_counter_advances_per_preferences():
+    state = {"details": {}}
+
+    served = [main._next_recommendation_variant(state, {"genre": "Fantasy"}) for _ in range(3)]
+    other = main._next_recommendation_variant(state, {"genre": "Horror"})
+    same = main._next_recommendation_variant(state, {"GENRE": "fantasy"})
+
+    assert served == [0, 1, 2]
+    assert other == 0
+    assert same == 3
+
+
+def test_repeat_request_is_served_from_cache_and_the_next_variant_is_new(completions):
+    preferences = {"genre": f"cache-test-{uuid.uuid4()}"}
+    equivalent = {"Genre": preferences["genre"].upper()}
+
+    async def scenario():
+        first = await main.get_chatgpt_recommendations(preferences, [], 5, variant=0)
+        repeat = await main.get_chatgpt_recommendations(equivalent, [], 5, variant=0)
+        calls_after_repeat = completions.calls
+        second = await main.get_chatgpt_recommendations(preferences, [], 5, variant=1)
+        return first, repeat, calls_after_repeat, second
+
+    first, repeat, calls_after_repeat, second = asyncio.run(scenario())
+
+    assert repeat == first
+    assert calls_after_repeat == 1
+    assert completions.calls == 2
+    assert {idea["title"] for idea in second}.isdisjoint(idea["title"] for idea in first)
@@ -0,0 +1,57 @@
+import json
+
+import main
+
+
+def _filled(n):
+    seen = main.SeenSet()
+    for i in range(n):
+        seen.add(f"id:seen-{i}")
+    return seen
+
+
+def _false_positive_rate(seen, probes=20000):
+    return sum(f"id:unseen-{i}" in seen for i in range(probes)) / probes
+
+
+def test_exact_while_small():
+    seen = _filled(main.SEEN_SET_EXACT_MAX)
+
+    assert seen.bloom is None
+    assert all(f"id:seen-{i}" in seen for i in range(main.SEEN_SET_EXACT_MAX))
+    assert _false_positive_rate(seen) == 0
+
+
+def test_bloom_false_positive_rate_stays_near_target_at_capacity():
+    capacity = main.SeenSet._bloom_capacity()
+    seen = _filled(capacity)
+
+    assert seen.bloom is not None
+    assert all(f"id:seen-{i}" in seen for i in range(capacity))  # No false negatives
+    assert _false_positive_rate(seen) <= main.SEEN_SET_BLOOM_ERROR_RATE * 2
+
+
+def test_overfull_filter_starts_over_instead_of_degrading():
+    capacity = main.SeenSet._bloom_capacity()
+    seen = _filled(capacity * 3)
+
+    assert seen.count <= capacity
+    assert _false_positive_rate(seen) <= main.SEEN_SET_BLOOM_ERROR_RATE * 2
+
+
+def test_state_round_trips_through_json():
+    for size in (3, main.SEEN_SET_EXACT_MAX + 10):
+        seen = _filled(size)
+        seen.add_book({"id": "v1", "title": "Dune", "authors": ["Frank Herbert"]})
+
+        restored = main.SeenSet.from_state(json.loads(json.dumps(seen.to_state())))
+
+        assert restored.to_state() == seen.to_state()
+        assert all(f"id:seen-{i}" in restored for i in range(size))
+        assert restored.has_seen_idea({"title": "Dune", "author": "Frank Herbert"})
+        assert restored.recent_titles == ["Dune"]
+
+
+def test_missing_or_corrupt_state_starts_empty():
+    assert main.SeenSet.from_state(None).to_state() == main.SeenSet().to_state()
+    assert main.SeenSet.from_state("not a dict").count == 0
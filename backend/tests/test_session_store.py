@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class FakeRedis:
+    """Just the SET NX / compare-and-delete subset the session lock uses."""
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, px=None, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def eval(self, script, numkeys, key, token):
+        if self.values.get(key) == token:
+            del self.values[key]
+            return 1
+        return 0
+
+
+def test_redis_lock_fails_the_turn_instead_of_proceeding_unlocked(monkeypatch):
+    monkeypatch.setattr(main, "SESSION_LOCK_WAIT", 0.2)
+    redis = FakeRedis()
+    store = main.RedisSessionStore(lambda: redis)
+    entered = []
+
+    async def scenario():
+        async with store.lock("busy"):
+            with pytest.raises(main.SessionBusyError):
+                async with store.lock("busy"):
+                    entered.append("second")
+        async with store.lock("busy"):  # Released once the holder is done
+            entered.append("third")
+
+    asyncio.run(scenario())
+    assert entered == ["third"]
+    assert redis.values == {}
+
+
+def test_waiting_turn_gets_the_lock_when_it_is_released(monkeypatch):
+    monkeypatch.setattr(main, "SESSION_LOCK_WAIT", 2.0)
+    redis = FakeRedis()
+    store = main.RedisSessionStore(lambda: redis)
+    order = []
+
+    async def turn(name, hold):
+        async with store.lock("shared"):
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def scenario():
+        first = asyncio.ensure_future(turn("first", 0.2))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(first, turn("second", 0))
+
+    asyncio.run(scenario())
+    assert order == ["first", "second"]
+
+
+def _state(text="hi", books=None):
+    state = {"history": [{"role": "user", "content": text}], "stage": "INIT", "details": {}}
+    if books is not None:
+        state["stage"] = "SHOWING_RECOMMENDATIONS"
+        state["details"]["last_recommendations"] = books
+    return state
+
+
+def test_memory_store_evicts_the_least_recently_used_session():
+    store = main.InMemorySessionStore(max_entries=2, max_bytes=10 ** 6, ttl=60)
+
+    async def scenario():
+        await store.save("a", _state())
+        await store.save("b", _state())
+        await store.load("a")  # "b" is now the least recently used
+        await store.save("c", _state())
+        return [await store.load(session_id) is not None for session_id in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+    assert store.evictions == 1
+
+
+def test_memory_store_expires_idle_sessions(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    store = main.InMemorySessionStore(max_entries=10, max_bytes=10 ** 6, ttl=60)
+
+    async def scenario():
+        await store.save("idle", _state())
+        clock[0] += 61
+        return await store.load("idle")
+
+    assert asyncio.run(scenario()) is None
+    assert store.total_bytes == 0
+
+
+def test_memory_store_keeps_within_its_byte_budget():
+    one = main.CompactSessionState.from_state(_state("x" * 1000)).size
+    store = main.InMemorySessionStore(max_entries=100, max_bytes=int(one * 2.5), ttl=60)
+
+    async def scenario():
+        for session_id in ("a", "b", "c", "d"):
+            await store.save(session_id, _state("x" * 1000))
+
+    asyncio.run(scenario())
+
+    assert list(store.sessions) == ["c", "d"]
+    assert store.total_bytes <= store.max_bytes
+
+
+def test_loading_recommendations_needs_no_lookups(monkeypatch):
+    async def no_lookup(book_id):
+        raise AssertionError("session load should not fetch book details")
+
+    monkeypatch.setattr(main, "get_book_details_by_id", no_lookup)
+    book = {
+        "id": "v1", "title": "Dune", "authors": ["Frank Herbert"], "description": None,
+        "thumbnail": "http://books.google.com/t.jpg", "isbn13": "9780441013593", "categories": ["Fiction"],
+        "reasoning": "Classic.", "amazon_link": "https://amazon.example/dune", "source": "catalog"
+    }
+    store = main.InMemorySessionStore()
+
+    async def scenario():
+        await store.save("s", _state(books=[book]))
+        return await store.load("s")
+
+    loaded = asyncio.run(scenario())["details"]["last_recommendations"][0]
+
+    assert loaded == book
+    assert main.book_etag(loaded) == main.book_etag(book)
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    flight = main.SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"title": "Dune"}
+
+    async def scenario():
+        return await asyncio.gather(*(flight.do("search", "dune", fetch) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert len(calls) == 1
+    assert all(result == {"title": "Dune"} for result in results)
+    assert flight.stats["search"] == {"calls": 5, "coalesced": 4}
+
+
+def test_exception_reaches_every_waiter_and_frees_the_key():
+    flight = main.SingleFlight()
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def succeeding():
+        attempts.append(1)
+        return "ok"
+
+    async def scenario():
+        results = await asyncio.gather(
+            *(flight.do("search", "key", failing) for _ in range(3)), return_exceptions=True
+        )
+        return results, await flight.do("search", "key", succeeding)
+
+    results, retried = asyncio.run(scenario())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retried == "ok"  # The failed call isn't cached, the next one runs
+    assert len(attempts) == 2
+
+
+def test_cancelling_one_waiter_leaves_the_shared_call_running():
+    flight = main.SingleFlight()
+    started = []
+
+    async def fetch():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("search", "key", fetch))
+        second = asyncio.ensure_future(flight.do("search", "key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "done"
+    assert len(started) == 1
+
+
+def test_shared_call_is_cancelled_once_every_waiter_has_gone():
+    flight = main.SingleFlight()
+    finished = []
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        finished.append(1)
+
+    async def scenario():
+        waiters = [asyncio.ensure_future(flight.do("search", "key", fetch)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.08)
+        return dict(flight._calls)
+
+    assert asyncio.run(scenario()) == {}
+    assert finished == []
+
+
+def test_shared_call_has_its_own_budget_and_each_waiter_keeps_its_own():
+    flight = main.SingleFlight()
+    observed = {}
+
+    async def fetch():
+        observed["user"] = main._llm_user.get()
+        observed["interactive"] = main._llm_interactive.get()
+        observed["budget"] = main.remaining_budget(1000)
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def caller(user_id, budget):
+        main.start_request_deadline(budget)
+        main.start_llm_user(user_id)
+        return await flight.do("search", "key", fetch)
+
+    async def scenario():
+        hurried = asyncio.ensure_future(caller("hurried", 0.02))
+        await asyncio.sleep(0)
+        patient = asyncio.ensure_future(caller("patient", 5.0))
+        return await asyncio.gather(hurried, patient, return_exceptions=True)
+
+    hurried, patient = asyncio.run(scenario())
+
+    assert isinstance(hurried, asyncio.TimeoutError)  # Gave up at its own deadline...
+    assert patient == "done"  # ...without cutting the shared call short for the other caller
+    assert observed["user"] is None and observed["interactive"] is True
+    assert observed["budget"] > 1.0
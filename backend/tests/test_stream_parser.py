@@ -0,0 +1,43 @@
+import json
+
+import main
+
+BOOKS = [
+    {"title": "Dune", "author": "Frank Herbert", "reasoning": "Sand {and} \"spice\"."},
+    {"title": "Hyperion", "author": "Dan Simmons", "reasoning": "Pilgrims, [shrike]."},
+]
+COMPLETION = json.dumps({"recommendations": BOOKS})
+
+
+def _feed_in_chunks(text, size):
+    parser = main.RecommendationStreamParser()
+    emitted = []
+    for start in range(0, len(text), size):
+        emitted.append(parser.feed(text[start:start + size]))
+    return parser, emitted
+
+
+def test_objects_split_across_any_chunk_boundary_are_parsed():
+    for size in (1, 2, 3, 7, 16, len(COMPLETION)):
+        parser, emitted = _feed_in_chunks(COMPLETION, size)
+
+        assert [book for chunk in emitted for book in chunk] == BOOKS, size
+        assert parser.finished
+
+
+def test_each_object_is_emitted_as_soon_as_it_closes():
+    first = json.dumps(BOOKS[0])
+    first_end = COMPLETION.index(first) + len(first)
+    parser = main.RecommendationStreamParser()
+
+    assert parser.feed(COMPLETION[:first_end - 1]) == []
+    assert parser.feed(COMPLETION[first_end - 1:first_end]) == [BOOKS[0]]
+    assert not parser.finished
+
+
+def test_text_after_the_array_is_ignored():
+    parser = main.RecommendationStreamParser()
+    parser.feed(COMPLETION[:-1])
+
+    assert parser.finished
+    assert parser.feed(', "extra": [{"title": "Ignored"}]}') == []
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+
+
+def test_evicts_least_recently_used_files_without_rescanning(tmp_path, monkeypatch):
+    cache = main.ThumbnailCache(str(tmp_path), max_bytes=1000)
+    scans = []
+    real_scandir = os.scandir
+
+    def counting_scandir(path):
+        scans.append(path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(main.os, "scandir", counting_scandir)
+
+    async def scenario():
+        for name in ("aa1", "bb2", "cc3"):
+            await cache.store_variant(name, 100, "webp", b"x" * 300)
+        assert await cache.variant("aa1", 100, "webp") == b"x" * 300  # Now most recently used
+        scans_before_eviction = len(scans)
+        await cache.store_variant("dd4", 100, "webp", b"x" * 300)
+        return scans_before_eviction
+
+    scans_before_eviction = asyncio.run(scenario())
+
+    assert len(scans) == scans_before_eviction  # Only the first write scanned the directory
+    assert cache.evictions == 1
+    assert cache.stats()["bytes"] == 900
+    assert not os.path.exists(cache._path("bb2.100.webp"))
+    assert os.path.exists(cache._path("aa1.100.webp"))
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    asyncio.run(main.ThumbnailCache(str(tmp_path)).store_source("https://books.google.com/cover", b"\x89PNG" + b"0" * 96))
+
+    reopened = main.ThumbnailCache(str(tmp_path))
+    cached = asyncio.run(reopened.source("https://books.google.com/cover"))
+
+    assert cached is not None and cached[1].startswith(b"\x89PNG")
+    assert reopened.stats()["bytes"] == 100 + len(cached[0])
+
+
+class FakeResponse:
+    def __init__(self, status, location=None, body=b""):
+        self.status = status
+        self.headers = {"Location": location} if location else {}
+        self.content = self
+        self._body = body
+
+    async def read(self, limit):
+        return self._body[:limit]
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(self.status)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requested = []
+
+    def get(self, url, allow_redirects=True):
+        assert allow_redirects is False
+        self.requested.append(url)
+        return self.responses[url]
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"0" * 92
+
+
+def _fetch(tmp_path, monkeypatch, responses, url):
+    session = FakeSession(responses)
+    monkeypatch.setattr(main, "thumbnail_cache", main.ThumbnailCache(str(tmp_path)))
+    monkeypatch.setattr(main, "get_http_session", lambda: session)
+    return session, asyncio.run(main._fetch_thumbnail_source(url))
+
+
+def test_redirect_to_an_allowed_host_is_followed(tmp_path, monkeypatch):
+    start = "http://books.google.com/books/content?id=1"
+    final = "https://books.googleusercontent.com/cover/1"
+    responses = {start: FakeResponse(302, final), final: FakeResponse(200, body=PNG)}
+
+    session, (_, data) = _fetch(tmp_path, monkeypatch, responses, start)
+
+    assert data == PNG
+    assert session.requested == [start, final]
+
+
+def test_redirect_off_the_allow_list_is_refused(tmp_path, monkeypatch):
+    start = "http://books.google.com/books/content?id=2"
+    responses = {start: FakeResponse(302, "http://169.254.169.254/latest/meta-data")}
+
+    with pytest.raises(ValueError, match="disallowed host"):
+        _fetch(tmp_path, monkeypatch, responses, start)
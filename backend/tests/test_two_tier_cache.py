@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+import main
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.values = {}
+        self.fail = fail
+        self.calls = 0
+
+    async def get(self, key):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis down")
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis down")
+        self.values[key] = value
+
+
+def _clock(monkeypatch, start=1000.0):
+    now = [start]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_negative_entries_are_cached_with_their_own_ttl(monkeypatch):
+    now = _clock(monkeypatch)
+    cache = main.TwoTierCache("test", max_entries=10, ttl=100, negative_ttl=10)
+
+    async def scenario():
+        await cache.set("missing", None)
+        await cache.set("found", {"id": "v1"})
+        cached_none = await cache.get("missing")
+        now[0] += 11  # Past the negative TTL, within the positive one
+        return cached_none, await cache.get("missing"), await cache.get("found")
+
+    cached_none, expired, found = asyncio.run(scenario())
+
+    assert cached_none is None  # A cached "not found", distinct from a miss
+    assert expired is main._CACHE_MISS
+    assert found == {"id": "v1"}
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    now = _clock(monkeypatch)
+    cache = main.TwoTierCache("test", max_entries=10, ttl=100, negative_ttl=10)
+
+    async def scenario():
+        await cache.set("key", [1])
+        now[0] += 101
+        return await cache.get("key")
+
+    assert asyncio.run(scenario()) is main._CACHE_MISS
+    assert cache.stats()["misses"] == 1
+
+
+def test_local_tier_evicts_the_least_recently_used_entry():
+    cache = main.TwoTierCache("test", max_entries=2, ttl=100, negative_ttl=10)
+
+    async def scenario():
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        await cache.get("a")  # "b" is now the least recently used
+        await cache.set("c", 3)
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == [1, main._CACHE_MISS, 3]
+    assert cache.stats()["entries"] == 2
+
+
+def test_redis_tier_fills_the_local_tier():
+    redis = FakeRedis()
+    writer = main.TwoTierCache("shared", max_entries=10, ttl=100, negative_ttl=10, redis_factory=lambda: redis)
+    reader = main.TwoTierCache("shared", max_entries=10, ttl=100, negative_ttl=10, redis_factory=lambda: redis)
+
+    async def scenario():
+        await writer.set("key", {"id": "v1"})
+        first = await reader.get("key")
+        calls = redis.calls
+        second = await reader.get("key")
+        return first, second, redis.calls - calls
+
+    first, second, redis_calls = asyncio.run(scenario())
+
+    assert first == second == {"id": "v1"}
+    assert redis_calls == 0  # Served from the local tier the second time
+    assert reader.stats()["redis_hits"] == 1 and reader.stats()["local_hits"] == 1
+    assert json.loads(redis.values["bookgpt:cache:shared:key"]) == {"id": "v1"}
+
+
+def test_unreachable_redis_is_skipped_until_the_retry_interval(monkeypatch):
+    now = _clock(monkeypatch)
+    redis = FakeRedis(fail=True)
+    cache = main.TwoTierCache("test", max_entries=10, ttl=100, negative_ttl=10, redis_factory=lambda: redis)
+
+    async def scenario():
+        await cache.get("a")
+        await cache.get("b")
+        now[0] += main.CACHE_REDIS_RETRY_SECONDS + 1
+        await cache.get("c")
+
+    asyncio.run(scenario())
+
+    assert redis.calls == 2  # One failure, then backed off until the retry interval passed
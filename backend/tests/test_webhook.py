@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+import main
+
+
+class FakeRedis:
+    """Shared SET NX / DELETE store standing in for Redis across instances."""
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _batch(*event_ids):
+    return [(event_id, {"event_id": event_id, "type": "usage"}, time.perf_counter()) for event_id in event_ids]
+
+
+def test_every_accepted_event_is_logged(monkeypatch):
+    monkeypatch.setattr(main, "_webhook_redis", None)
+    monkeypatch.setattr(main, "LOG_PAYLOAD_SAMPLE_RATE", 0.0)
+    handler = ListHandler()
+    main.log.addHandler(handler)
+    level = main.log.level
+    main.log.setLevel(logging.INFO)
+    try:
+        asyncio.run(main._process_webhook_batch(_batch("log-1", "log-2")))
+    finally:
+        main.log.removeHandler(handler)
+        main.log.setLevel(level)
+
+    received = [r.fields["event_id"] for r in handler.records if r.getMessage() == "Webhook received"]
+    assert received == ["log-1", "log-2"]
+
+
+def test_redis_dedupes_events_across_instances(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(main, "_webhook_redis", lambda: redis)
+    monkeypatch.setattr(main, "_webhook_redis_retry_at", 0.0)
+    handled = []
+
+    async def handle(event_id, event):
+        handled.append(event_id)
+
+    monkeypatch.setattr(main, "_handle_webhook_event", handle)
+
+    asyncio.run(main._process_webhook_batch(_batch("shared-1")))
+    main._webhook_seen.clear()  # Another instance: nothing in its own memory
+    asyncio.run(main._process_webhook_batch(_batch("shared-1", "shared-2")))
+
+    assert handled == ["shared-1", "shared-2"]
+
+
+def test_failed_event_is_released_for_redelivery(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(main, "_webhook_redis", lambda: redis)
+    monkeypatch.setattr(main, "_webhook_redis_retry_at", 0.0)
+    attempts = []
+
+    async def flaky(event_id, event):
+        attempts.append(event_id)
+        if len(attempts) == 1:
+            raise RuntimeError("downstream unavailable")
+
+    monkeypatch.setattr(main, "_handle_webhook_event", flaky)
+
+    asyncio.run(main._process_webhook_batch(_batch("retry-1")))
+    asyncio.run(main._process_webhook_batch(_batch("retry-1")))
+
+    assert attempts == ["retry-1", "retry-1"]
+    assert main._webhook_redis_key("retry-1") in redis.values
+
+
+def test_webhook_is_acknowledged_with_202(client, monkeypatch):
+    monkeypatch.setenv("WEBHOOK_SECRET", "test-secret")
+    body = json.dumps([{"event_id": "ack-1"}, {"event_id": "ack-2"}]).encode()
+    signature = hmac.new(b"test-secret", body, hashlib.sha256).hexdigest()
+
+    response = client.post("/api/webhook", content=body, headers={"X-BookGPT-Signature": signature})
+
+    assert response.status_code == 202
+    assert response.json() == {"status": "accepted", "events": 2}
@@ -24,6 +24,11 @@ self.addEventListener('message', function(e) {
       // Track analytics event
       trackAnalytics(data.event);
       break;
+
+    case 'stream_chat':
+      // Stream a chat turn from the backend's server-sent events endpoint
+      streamChat(data.apiUrl, data.userId, data.message);
+      break;
       
     default:
       // Send back an error for unknown message types
@@ -95,6 +100,79 @@ function fetchRecommendations(query) {
   }, 300);
 }
 
+/**
+ * Stream a chat turn from /api/chat/stream and relay each server-sent event
+ * to the main thread as it arrives:
+ *   chat_stream_message - the bot's interim reply
+ *   chat_stream_book    - one enriched book, with its position in the final list
+ *                         (books arrive in that order: index 0, 1, 2, ...)
+ *   chat_stream_done    - the final response (bot_message, suggestions, books, stage)
+ *   chat_stream_error   - the stream failed
+ * @param {string} apiUrl - The streaming endpoint URL
+ * @param {string} userId - The session ID
+ * @param {string} message - The user's message
+ */
+async function streamChat(apiUrl, userId, message) {
+  try {
+    const response = await fetch(apiUrl, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+      body: JSON.stringify({ user_id: userId, message: message })
+    });
+
+    if (!response.ok || !response.body) {
+      throw new Error(`Server error: ${response.status} ${response.statusText}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Events are separated by a blank line
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        relayStreamEvent(rawEvent);
+      }
+    }
+  } catch (error) {
+    self.postMessage({
+      type: 'chat_stream_error',
+      error: `Stream error: ${error.message}`
+    });
+  }
+}
+
+/**
+ * Parse one server-sent event block and post it to the main thread
+ * @param {string} rawEvent - The event lines, without the trailing blank line
+ */
+function relayStreamEvent(rawEvent) {
+  let eventName = 'message';
+  let dataText = '';
+
+  rawEvent.split('\n').forEach(line => {
+    if (line.startsWith('event:')) {
+      eventName = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      dataText += line.slice(5).trim();
+    }
+  });
+
+  if (!dataText) return;
+
+  self.postMessage({
+    type: `chat_stream_${eventName}`,
+    data: JSON.parse(dataText)
+  });
+}
+
 /**
  * Track analytics event
  * @param {Object} event - The event data to track